@@ -0,0 +1,117 @@
+# Compares shrinking oversized images by scale alone, re-saved the way the resize used to (quality=100, first frame
+# only), with utils.image.shrink_to_limit and its per-format encoders: bytes, pixels and frames kept, encodes and time.
+#
+# Run from the repo root:
+#   python -m benchmarks.encoder_benchmark [--size-limit 8126464]
+import argparse
+import io
+import math
+import os
+import time
+import typing
+
+from PIL import Image
+from PIL import ImageDraw
+
+from utils import image
+
+
+def scale_only(data: bytes, size_limit: int) -> typing.Tuple[bytes, int]:
+    """
+    The search shrink_to_limit used before it had encoders: predict or bisect the scale, always saving at quality 100.
+
+    :return: the result and how many encodes it took
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        image_format = original.format
+        original.load()
+        lower, upper, best, passes = 0.0, 1.0, None, 0
+        scale = min(1.0, math.sqrt(size_limit * image.TARGET_FILL / len(data)))
+        while True:
+            passes += 1
+            resized = original.resize(
+                (max(1, int(original.width * scale)), max(1, int(original.height * scale))), resample=Image.LANCZOS
+            )
+            buffer = io.BytesIO()
+            resized.save(buffer, format=image_format, quality=100)
+            encoded = buffer.getvalue()
+            if len(encoded) <= size_limit:
+                best, lower = encoded, scale
+                if len(encoded) >= size_limit * image.ACCEPT_FILL:
+                    break
+            else:
+                upper = scale
+            if best is not None and (passes >= image.MAX_PASSES or upper - lower < image.SCALE_TOLERANCE):
+                break
+            scale = image._next_scale(scale, len(encoded), size_limit, lower, upper)
+    return best, passes
+
+
+def photo(width: int, height: int) -> Image.Image:
+    # Upscaled noise, about as hard to compress as a photo.
+    noise = Image.frombytes("RGB", (width // 4, height // 4), os.urandom(width // 4 * height // 4 * 3))
+    return noise.resize((width, height), resample=Image.BICUBIC)
+
+
+def screenshot(width: int, height: int) -> Image.Image:
+    text = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(text)
+    for top in range(0, height, 14):
+        draw.text((5, top), "a line of chat in a screenshot " * 20, fill=(top % 256, 0, 0))
+    # A little noise, like scaling and JPEG round trips leave behind.
+    return Image.blend(text, photo(width, height), 0.08)
+
+
+def encode(picture: Image.Image, image_format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    picture.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def corpus(size_limit: int) -> typing.Dict[str, bytes]:
+    frames = [photo(800, 600) for _ in range(40)]
+    images = {
+        "photo.jpg": encode(photo(6000, 4000), "JPEG", quality=100),
+        "screenshot.png": encode(screenshot(5000, 3000), "PNG"),
+        "animation.gif": encode(frames[0], "GIF", save_all=True, append_images=frames[1:], duration=40, loop=0),
+        "animation.webp": encode(
+            frames[0], "WEBP", save_all=True, append_images=frames[1:], duration=40, loop=0, quality=100
+        ),
+    }
+    return {name: data for name, data in images.items() if len(data) > size_limit}
+
+
+def describe(data: bytes) -> typing.Tuple[int, int]:
+    with Image.open(io.BytesIO(data)) as result:
+        return result.width * result.height, getattr(result, "n_frames", 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare scale-only shrinking with the per-format encoders")
+    parser.add_argument("--size-limit", type=int, default=8388608 - 256 * 1024)
+    arguments = parser.parse_args()
+
+    print("{:<16} {:>8} | {:>8} {:>8} {:>7} {:>7} {:>8} | {:>8} {:>8} {:>7} {:>7} {:>8}".format(
+        "file", "MB", "old MB", "pixels", "frames", "passes", "seconds", "new MB", "pixels", "frames", "passes",
+        "seconds"
+    ))
+    for name, data in corpus(arguments.size_limit).items():
+        original_pixels, original_frames = describe(data)
+        row = [name, len(data) / 1000000]
+        started = time.perf_counter()
+        old, old_passes = scale_only(data, arguments.size_limit)
+        old_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        new = image.shrink_to_limit(data, arguments.size_limit)
+        new_seconds = time.perf_counter() - started
+        for result, passes, seconds in ((old, old_passes, old_seconds), (new.data, new.passes, new_seconds)):
+            pixels, frames = describe(result)
+            row += [len(result) / 1000000, "{:.0%}".format(pixels / original_pixels),
+                    "{}/{}".format(frames, original_frames), passes, seconds]
+        print(
+            "{:<16} {:>8.2f} | {:>8.2f} {:>8} {:>7} {:>7} {:>8.2f} | {:>8.2f} {:>8} {:>7} {:>7} {:>8.2f}".format(*row)
+        )
+
+
+if __name__ == '__main__':
+    main()
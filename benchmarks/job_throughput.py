@@ -0,0 +1,109 @@
+# Measures how fast the pin job queue drains against a local stand-in for the Discord HTTP API
+# (tests.discord_stub), with the real discord.py HTTP client, for a few worker counts.  Also checks that every message
+# ended up posted exactly once per pin channel.
+#
+# Run from the repo root:
+#   python -m benchmarks.job_throughput [--messages 200] [--latency 0.02] [--error-rate 0.0] [--workers 1 4 8 16]
+import argparse
+import asyncio
+import pathlib
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import main as pinbot
+from tests import discord_stub
+from tests import fakes
+from utils import db
+
+
+async def setup(
+    stub: discord_stub.DiscordStub, messages: int, pin_channel_count: int
+) -> types.SimpleNamespace:
+    user = fakes.FakeUser()
+    source_channel = stub.add_channel("source")
+    pin_channels = [stub.add_channel("pins-{}".format(index)) for index in range(pin_channel_count)]
+    for pin_channel in pin_channels:
+        channel_key = str(uuid.uuid4())
+        await pinbot.DATABASE.add_connection(channel_key, source_channel, user.id)
+        await pinbot.DATABASE.set_pin_channel(channel_key, pin_channel)
+    message_ids = [
+        stub.add_message(source_channel, [("image-{}.png".format(index), b"x" * 50000)]) for index in range(messages)
+    ]
+    return types.SimpleNamespace(
+        user=user, source_channel=source_channel, pin_channels=pin_channels, messages=message_ids
+    )
+
+
+def posted_once(stub: discord_stub.DiscordStub, scenario: types.SimpleNamespace) -> bool:
+    return all(len(stub.posts[pin_channel]) == len(scenario.messages) for pin_channel in scenario.pin_channels)
+
+
+async def run_throughput(stub: discord_stub.DiscordStub, arguments: argparse.Namespace, workers: int) -> bool:
+    scenario = await setup(stub, arguments.messages, arguments.pin_channels)
+    pinbot.SETTINGS.pin_workers = workers
+    await pinbot.setup_hook()
+
+    started = time.perf_counter()
+    for message_id in scenario.messages:
+        await pinbot.on_raw_reaction_add(stub.reaction_payload(scenario.source_channel, message_id, scenario.user))
+    enqueued = time.perf_counter()
+    await pinbot.PIN_JOBS.drain()
+    drained = time.perf_counter()
+    await pinbot.PIN_JOBS.stop()
+
+    print("{:>8} {:>14.1f} {:>12.1f} {:>10} {:>8}".format(
+        workers,
+        (enqueued - started) / len(scenario.messages) * 1000000,
+        len(scenario.messages) / (drained - started),
+        pinbot.PIN_JOBS.retried,
+        "ok" if posted_once(stub, scenario) else "WRONG"
+    ))
+    return posted_once(stub, scenario)
+
+
+async def run(arguments: argparse.Namespace, temp_directory: pathlib.Path) -> bool:
+    stub = discord_stub.DiscordStub(latency=arguments.latency, error_rate=arguments.error_rate)
+    await stub.start()
+    await stub.use(pinbot.BOT)
+    # Failed sends would otherwise back off for seconds.
+    pinbot.SETTINGS.pin_job_backoff = 0.05
+
+    passed = True
+    try:
+        print("{:>8} {:>14} {:>12} {:>10} {:>8}".format("workers", "enqueue us", "jobs / sec", "retries", "posts"))
+        for index, workers in enumerate(arguments.workers):
+            pinbot.DATABASE = db.Database(str(temp_directory.joinpath("throughput-{}.db".format(index))))
+            pinbot.DATABASE.open()
+            try:
+                passed = await run_throughput(stub, arguments, workers) and passed
+            finally:
+                pinbot.DATABASE.close()
+
+    finally:
+        await pinbot.DOWNLOADER.close()
+        await pinbot.BOT.http.close()
+        await stub.stop()
+    return passed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure pin job throughput against a local Discord API stand-in")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--pin-channels", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of posts answered with a 500")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        passed = asyncio.run(run(arguments, pathlib.Path(temp_directory)))
+
+    print("PASS" if passed else "FAIL")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
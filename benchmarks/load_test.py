@@ -0,0 +1,396 @@
+# Replays a trace of reactions through PinBot's reaction handler against a local stand-in for the Discord API and CDN
+# (tests.discord_stub), with the real discord.py HTTP client and download session, while more channels are
+# registered through !register_source_channel and !register_pin_channel.  Reports pin latency (from the first 📌 on a
+# message to its pin being posted) at p50 and p99, throughput and peak RSS, and checks every pinned message was posted
+# exactly once per pin channel.  Save a run's results with --save and check later runs against them with --baseline;
+# exits non-zero on a regression past --tolerance, or a wrong post or registration.
+#
+# A trace is JSON lines, one reaction each, in time order, t being seconds since the start of the trace:
+#   {"t": 0.125, "channel_id": 1, "message_id": 10, "user_id": 100, "emoji": "📌"}
+# Each channel in it becomes a registered source channel with --pin-channels pin channels (only the --sources busiest,
+# if given) and each message one with --attachments attachments.  Without --trace one is generated, --write-trace
+# saves it.
+#
+# Run from the repo root:
+#   python -m benchmarks.load_test [--trace reactions.jsonl] [--speed 1.0 | --rate 500] [--latency 0.02]
+#       [--rate-limit-rate 0.02] [--registrations 20] [--save results.json] [--baseline results.json]
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import pathlib
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import types
+import typing
+
+import main as pinbot
+from tests import discord_stub
+from tests import fakes
+from utils import content
+from utils import db
+
+Event = typing.Dict[str, typing.Any]
+
+# The original message's ID, from the jump URL in a pin
+_PINNED_MESSAGE = re.compile(r"/channels/\d+/\d+/(\d+)")
+_CONNECTION_KEY = re.compile(r"register_pin_channel (\S+)`")
+_OTHER_EMOJI = ("👍", "😂", "❤️", "🎉", "👀")
+
+# result -> whether bigger is better, for comparing against a baseline
+COMPARED = {
+    "latency_p50": False,
+    "latency_p99": False,
+    "pins_per_second": True,
+    "registration_p99": False,
+    "peak_rss_mb": False,
+}
+
+
+def generate_trace(
+    events: int, rate: float, channels: int, messages: int, users: int, pin_fraction: float, seed: int
+) -> typing.List[Event]:
+    """
+    Reactions arriving at random at the given average rate.  A few channels and messages get most of them, so popular
+    messages are pinned by several people, often at nearly the same time.
+    """
+    generator = random.Random(seed)
+    channel_weights = [1 / (index + 1) for index in range(channels)]
+    message_weights = [1 / (index + 1) for index in range(messages)]
+    trace = []
+    t = 0.0
+    for _ in range(events):
+        t += generator.expovariate(rate)
+        channel = generator.choices(range(channels), channel_weights)[0]
+        message = generator.choices(range(messages), message_weights)[0]
+        trace.append({
+            "t": round(t, 6),
+            "channel_id": channel + 1,
+            "message_id": channel * messages + message + 1,
+            "user_id": generator.randrange(users) + 1,
+            "emoji": "📌" if generator.random() < pin_fraction else generator.choice(_OTHER_EMOJI),
+        })
+    return trace
+
+
+def read_trace(path: str) -> typing.List[Event]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_trace(path: str, trace: typing.Iterable[Event]) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        for event in trace:
+            file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def percentile(values: typing.Sequence[float], quantile: float) -> typing.Optional[float]:
+    # Nearest rank.
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(quantile * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def add_channel(stub: discord_stub.DiscordStub, channels: typing.Dict[int, typing.Any], name: str) -> int:
+    """
+    Add a channel to the stub and to the bot's channel cache, like the gateway would have.
+    """
+    channel_id = stub.add_channel(name)
+    channels[channel_id] = await pinbot.BOT.fetch_channel(channel_id)
+    return channel_id
+
+
+async def register(
+    guild: fakes.FakeGuild, source_channel: int, pin_channel: int, user: fakes.FakeUser
+) -> typing.Tuple[float, bool]:
+    """
+    Run !register_source_channel in the source channel, then !register_pin_channel in the pin channel with the key
+    that was DMed.
+
+    :return: how long both took in seconds, and whether the connection was registered
+    """
+    started = time.perf_counter()
+    await pinbot.register_source_channel.callback(
+        fakes.FakeContext(fakes.FakeChannel(guild, "source", channel_id=source_channel), user)
+    )
+    key = _CONNECTION_KEY.search(user.direct_messages[-1]).group(1)
+    context = fakes.FakeContext(fakes.FakeChannel(guild, "pins", channel_id=pin_channel), user)
+    await pinbot.register_pin_channel.callback(context, key)
+    return time.perf_counter() - started, context.replies[-1].startswith("Registered pinning")
+
+
+async def setup(
+    stub: discord_stub.DiscordStub, trace: typing.Sequence[Event], arguments: argparse.Namespace
+) -> types.SimpleNamespace:
+    channels: typing.Dict[int, typing.Any] = {}
+    pinbot.BOT.get_channel = channels.get
+    guild = fakes.FakeGuild()
+    user = fakes.FakeUser()
+
+    busiest = [channel for channel, _ in collections.Counter(event["channel_id"] for event in trace).most_common()]
+    registered = set(busiest[:arguments.sources] if arguments.sources is not None else busiest)
+    blobs = [os.urandom(arguments.attachment_size) for _ in range(8)]
+
+    # trace ID -> stub ID
+    source_channels: typing.Dict[int, int] = {}
+    messages: typing.Dict[int, int] = {}
+    # stub source channel ID -> stub pin channel IDs
+    pin_channels: typing.Dict[int, typing.List[int]] = {}
+    registrations_ok = True
+    for event in trace:
+        if event["channel_id"] not in source_channels:
+            source_channel = await add_channel(stub, channels, "source-{}".format(event["channel_id"]))
+            source_channels[event["channel_id"]] = source_channel
+            if event["channel_id"] in registered:
+                pin_channels[source_channel] = []
+                for index in range(arguments.pin_channels):
+                    pin_channel = await add_channel(stub, channels, "pins-{}-{}".format(event["channel_id"], index))
+                    pin_channels[source_channel].append(pin_channel)
+                    _, ok = await register(guild, source_channel, pin_channel, user)
+                    registrations_ok = registrations_ok and ok
+        if event["message_id"] not in messages:
+            messages[event["message_id"]] = stub.add_message(source_channels[event["channel_id"]], [
+                ("image-{}-{}.png".format(event["message_id"], index),
+                 blobs[(event["message_id"] + index) % len(blobs)], "image/png")
+                for index in range(arguments.attachments)
+            ])
+    return types.SimpleNamespace(
+        channels=channels, guild=guild, user=user, source_channels=source_channels, messages=messages,
+        pin_channels=pin_channels, registrations_ok=registrations_ok
+    )
+
+
+async def register_during(
+    stub: discord_stub.DiscordStub, world: types.SimpleNamespace, count: int, duration: float
+) -> typing.List[typing.Tuple[float, bool]]:
+    """
+    Register count new connections spread over the replay, each by a different user, without waiting for one to
+    finish before starting the next.
+    """
+    if not count:
+        return []
+    pairs = []
+    for index in range(count):
+        source_channel = await add_channel(stub, world.channels, "new-source-{}".format(index))
+        pin_channel = await add_channel(stub, world.channels, "new-pins-{}".format(index))
+        pairs.append((source_channel, pin_channel))
+
+    registrations = []
+    for source_channel, pin_channel in pairs:
+        registrations.append(
+            asyncio.create_task(register(world.guild, source_channel, pin_channel, fakes.FakeUser()))
+        )
+        await asyncio.sleep(duration / count)
+    return list(await asyncio.gather(*registrations))
+
+
+async def replay(
+    stub: discord_stub.DiscordStub, trace: typing.Sequence[Event], world: types.SimpleNamespace,
+    arguments: argparse.Namespace
+) -> types.SimpleNamespace:
+    """
+    Hand each reaction to the handler at its time in the trace (scaled by --speed), or --rate a second, each as its
+    own task like discord.py dispatches events.
+    """
+    # stub message ID -> when it was first reacted to with 📌
+    first_pins: typing.Dict[int, float] = {}
+    handlers = set()
+    late = 0.0
+    duration = len(trace) / arguments.rate if arguments.rate else trace[-1]["t"] / arguments.speed
+    registering = asyncio.create_task(register_during(stub, world, arguments.registrations, duration))
+
+    started = time.perf_counter()
+    for index, event in enumerate(trace):
+        delay = started + (index / arguments.rate if arguments.rate else event["t"] / arguments.speed)
+        delay -= time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            late = max(late, -delay)
+
+        source_channel = world.source_channels[event["channel_id"]]
+        message_id = world.messages[event["message_id"]]
+        if event["emoji"] == "📌" and source_channel in world.pin_channels:
+            first_pins.setdefault(message_id, time.perf_counter())
+        payload = types.SimpleNamespace(
+            emoji=types.SimpleNamespace(name=event["emoji"], id=None), guild_id=stub.guild_id,
+            channel_id=source_channel, message_id=message_id, user_id=event["user_id"], member=world.user
+        )
+        handler = asyncio.create_task(pinbot.on_raw_reaction_add(payload))
+        handlers.add(handler)
+        handler.add_done_callback(handlers.discard)
+    replayed = time.perf_counter()
+
+    await asyncio.gather(*handlers)
+    registrations = await registering
+    await pinbot.PIN_JOBS.drain()
+    return types.SimpleNamespace(
+        first_pins=first_pins, started=started, seconds=replayed - started, late=late, registrations=registrations
+    )
+
+
+def check_posts(
+    stub: discord_stub.DiscordStub, world: types.SimpleNamespace, first_pins: typing.Dict[int, float]
+) -> typing.Tuple[typing.List[float], typing.List[float], bool]:
+    """
+    :return: the latency of every pin, when each was posted, and whether each pinned message was posted once to each
+             of its pin channels and nothing else was
+    """
+    latencies, posted, correct = [], [], True
+    for source_channel, pin_channels in world.pin_channels.items():
+        expected = collections.Counter(
+            message_id for message_id in first_pins
+            if int(stub.messages[message_id]["channel_id"]) == source_channel
+        )
+        for pin_channel in pin_channels:
+            pinned = collections.Counter()
+            for text, posted_at in zip(stub.post_contents[pin_channel], stub.post_times[pin_channel]):
+                message_id = int(_PINNED_MESSAGE.search(text).group(1))
+                pinned[message_id] += 1
+                if message_id in first_pins:
+                    latencies.append(posted_at - first_pins[message_id])
+                    posted.append(posted_at)
+            correct = correct and pinned == expected
+    return latencies, posted, correct
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    passed = True
+    for name, bigger_is_better in COMPARED.items():
+        if results.get(name) is None or baseline.get(name) is None:
+            continue
+        change = (results[name] - baseline[name]) / baseline[name] if baseline[name] else 0.0
+        regressed = change < -tolerance if bigger_is_better else change > tolerance
+        print("{:<18} {:>10.4g} -> {:>10.4g} {:>+8.1%}  {}".format(
+            name, baseline[name], results[name], change, "REGRESSED" if regressed else "ok"
+        ))
+        passed = passed and not regressed
+    return passed
+
+
+async def run(
+    trace: typing.Sequence[Event], arguments: argparse.Namespace, temp_directory: pathlib.Path
+) -> typing.Tuple[dict, bool]:
+    stub = discord_stub.DiscordStub(
+        latency=arguments.latency, error_rate=arguments.error_rate, rate_limit_rate=arguments.rate_limit_rate,
+        retry_after=arguments.retry_after
+    )
+    await stub.start()
+    await stub.use(pinbot.BOT)
+    if arguments.workers is not None:
+        pinbot.SETTINGS.pin_workers = arguments.workers
+    # Failed sends would otherwise back off for seconds, and a running bot may have the metrics port.
+    pinbot.SETTINGS.pin_job_backoff = 0.05
+    pinbot.SETTINGS.metrics_port = None
+    pinbot.DATABASE = db.Database(str(temp_directory.joinpath("load.db")))
+    pinbot.DATABASE.open()
+    pinbot.RESIZE_CACHE = content.ResizeCache(temp_directory.joinpath("resize_cache"), 0)
+
+    try:
+        await pinbot.setup_hook()
+        world = await setup(stub, trace, arguments)
+        outcome = await replay(stub, trace, world, arguments)
+        await pinbot.PIN_JOBS.stop()
+    finally:
+        await pinbot.DOWNLOADER.close()
+        await pinbot.BOT.http.close()
+        await stub.stop()
+        pinbot.DATABASE.close()
+
+    latencies, posted, posts_ok = check_posts(stub, world, outcome.first_pins)
+    registration_seconds = [seconds for seconds, _ in outcome.registrations]
+    registrations_ok = world.registrations_ok and all(ok for _, ok in outcome.registrations)
+    results = {
+        "reactions": len(trace),
+        "reactions_per_second": len(trace) / outcome.seconds if outcome.seconds else None,
+        "replay_late_seconds": outcome.late,
+        "pins": len(latencies),
+        "pins_per_second": len(posted) / (max(posted) - outcome.started) if posted else None,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies, default=None),
+        "registrations": len(registration_seconds),
+        "registration_p50": percentile(registration_seconds, 0.5),
+        "registration_p99": percentile(registration_seconds, 0.99),
+        "rate_limits": stub.rate_limits_sent,
+        "errors": stub.errors_sent,
+        "retries": pinbot.PIN_JOBS.retried,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print("posts {}, registrations {}".format(
+        "ok" if posts_ok else "WRONG", "ok" if registrations_ok else "WRONG"
+    ))
+    return results, posts_ok and registrations_ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a reaction trace against a local Discord API stand-in")
+    parser.add_argument("--trace", help="JSON lines reaction trace to replay, generated if not given")
+    parser.add_argument("--write-trace", help="save the trace that's replayed here")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than the trace")
+    parser.add_argument("--rate", type=float, help="replay this many reactions a second, ignoring the trace's times")
+
+    generated = parser.add_argument_group("generated trace")
+    generated.add_argument("--events", type=int, default=5000)
+    generated.add_argument("--event-rate", type=float, default=250.0, help="average reactions per second")
+    generated.add_argument("--channels", type=int, default=10)
+    generated.add_argument("--messages", type=int, default=100, help="messages per channel")
+    generated.add_argument("--users", type=int, default=200)
+    generated.add_argument("--pin-fraction", type=float, default=0.2, help="fraction of reactions that are 📌")
+    generated.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--sources", type=int, help="register only the busiest this many channels of the trace")
+    parser.add_argument("--pin-channels", type=int, default=2, help="pin channels per source channel")
+    parser.add_argument("--attachments", type=int, default=1, help="attachments per message")
+    parser.add_argument("--attachment-size", type=int, default=200000)
+    parser.add_argument("--registrations", type=int, default=20, help="connections registered during the replay")
+    parser.add_argument("--workers", type=int, help="pin workers, pin_workers from the settings if not given")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API and CDN request")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.02, help="fraction of posts answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="seconds the 429s say to wait")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of posts answered with a 500")
+    parser.add_argument("--save", help="save the results here, as JSON")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline is a regression")
+    arguments = parser.parse_args()
+
+    if arguments.trace:
+        trace = read_trace(arguments.trace)
+    else:
+        trace = generate_trace(
+            arguments.events, arguments.event_rate, arguments.channels, arguments.messages, arguments.users,
+            arguments.pin_fraction, arguments.seed
+        )
+    if arguments.write_trace:
+        write_trace(arguments.write_trace, trace)
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        results, passed = asyncio.run(run(trace, arguments, pathlib.Path(temp_directory)))
+
+    for name, value in results.items():
+        print("{:<22} {}".format(name, "-" if value is None else "{:.4g}".format(value)))
+    if arguments.save:
+        with open(arguments.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            passed = compare(results, json.load(file), arguments.tolerance) and passed
+
+    print("PASS" if passed else "FAIL")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
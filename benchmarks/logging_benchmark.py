@@ -0,0 +1,88 @@
+# Measures the logging overhead of a single pin: the debug lines pin_message logs, the old eager way (format first,
+# str() it, then check the level) against the deferred utils.log API, with DEBUG off and on.  With DEBUG on, output
+# goes to /dev/null through a plain StreamHandler, directly or through the queue listener.
+#
+# Run from the repo root:
+#   python -m benchmarks.logging_benchmark [--reactions 100000]
+import argparse
+import logging
+import os
+import time
+import types
+
+from utils import log
+
+
+def legacy_debug(message, stack_level: int = log.STACK_LEVEL_DEFAULT) -> None:
+    log.importer_logger.debug(str(message), stacklevel=stack_level)
+
+
+def legacy_reaction(user, message, channel) -> None:
+    legacy_debug(
+        "User [{}] ({}) pinned [{}] in [{}] ({}) in server [{}] ({})".format(
+            user.display_name, user.id, message.id, channel.name, channel.id, channel.guild.name, channel.guild.id
+        )
+    )
+    legacy_debug("Got [{}] connections for source channel [{}]".format(3, channel.id))
+    legacy_debug("Pinned [{}] to [{}]".format(message.id, 1234))
+
+
+def deferred_reaction(user, message, channel) -> None:
+    if log.is_debug_enabled():
+        log.debug(
+            "User [{}] ({}) pinned [{}] in [{}] ({}) in server [{}] ({})",
+            user.display_name, user.id, message.id, channel.name, channel.id, channel.guild.name, channel.guild.id
+        )
+        log.debug("Got [{}] connections for source channel [{}]", 3, channel.id)
+    log.debug(
+        "Pinned [{}] to [{}]", message.id, 1234,
+        guild_id=channel.guild.id, channel_id=channel.id, message_id=message.id, latency_ms=12.5
+    )
+
+
+def time_reactions(function, reactions: int) -> float:
+    guild = types.SimpleNamespace(name="guild", id=1)
+    channel = types.SimpleNamespace(name="channel", id=2, guild=guild)
+    user = types.SimpleNamespace(display_name="user", id=3)
+    message = types.SimpleNamespace(id=4)
+
+    start = time.perf_counter()
+    for _ in range(reactions):
+        function(user, message, channel)
+    return (time.perf_counter() - start) / reactions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure per-reaction logging overhead")
+    parser.add_argument("--reactions", type=int, default=100000)
+    arguments = parser.parse_args()
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    devnull = open(os.devnull, "w")
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter("[%(levelname)8s]  [%(filename)s/%(funcName)s:%(lineno)s] - %(message)s"))
+    root_logger.addHandler(handler)
+
+    results = []
+    root_logger.setLevel(logging.INFO)
+    results.append(("DEBUG off, eager", time_reactions(legacy_reaction, arguments.reactions)))
+    results.append(("DEBUG off, deferred", time_reactions(deferred_reaction, arguments.reactions)))
+
+    root_logger.setLevel(logging.DEBUG)
+    results.append(("DEBUG on, eager, direct", time_reactions(legacy_reaction, arguments.reactions)))
+    results.append(("DEBUG on, deferred, direct", time_reactions(deferred_reaction, arguments.reactions)))
+    log.start_queue_listener()
+    # Only the time spent in the caller (i.e. on the event loop) counts, the listener thread does the writing.
+    results.append(("DEBUG on, deferred, queued", time_reactions(deferred_reaction, arguments.reactions)))
+    log.stop_queue_listener()
+    devnull.close()
+
+    print("{:<30} {:>14}".format("scenario", "us / reaction"))
+    for name, seconds in results:
+        print("{:<30} {:>14.2f}".format(name, seconds * 1000000))
+
+
+if __name__ == '__main__':
+    main()
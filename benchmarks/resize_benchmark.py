@@ -0,0 +1,117 @@
+# Compares the old step-down resize loop with utils.image.shrink_to_limit.
+#
+# Run from the repo root:
+#   python -m benchmarks.resize_benchmark [corpus_dir]
+#
+# If no corpus directory is given, a synthetic corpus of oversized JPEG/PNG/WebP images is generated in a temp dir.
+import argparse
+import os
+import pathlib
+import tempfile
+import time
+import typing
+
+from PIL import Image
+
+from utils import image
+
+SIZE_LIMIT = 8000000
+CORPUS_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def legacy_resize(source: pathlib.Path) -> typing.Tuple[int, int]:
+    """
+    The resize loop main.py used to run: shrink by another 5% of the original each pass, re-save at quality 100, and
+    check the size on disk.
+
+    :param source: the oversized image
+    :return: the final size in bytes and the number of passes it took
+    """
+    with tempfile.TemporaryDirectory() as work_directory:
+        local_file = pathlib.Path(work_directory).joinpath(source.name)
+        local_file.write_bytes(source.read_bytes())
+        final_file = pathlib.Path(work_directory).joinpath("reduce_{}".format(source.name))
+        final_file.write_bytes(local_file.read_bytes())
+
+        passes = 0
+        reduction_factor = 0.95
+        while final_file.stat().st_size > SIZE_LIMIT:
+            passes += 1
+            with Image.open(local_file) as legacy_image:
+                new_width = int(legacy_image.width * reduction_factor)
+                new_height = int(legacy_image.height * reduction_factor)
+                legacy_image.thumbnail((new_width, new_height), resample=Image.LANCZOS)
+                legacy_image.save(final_file, quality=100)
+            reduction_factor -= 0.05
+
+        return final_file.stat().st_size, passes
+
+
+def generate_corpus(directory: pathlib.Path) -> typing.List[pathlib.Path]:
+    """
+    Write a handful of noisy (i.e. hard to compress) images that are over the size limit.
+
+    :param directory: where to write the corpus
+    :return: paths to the generated images
+    """
+    corpus = []
+    for image_format, suffix, dimensions in (
+        ("JPEG", ".jpg", (4000, 3000)),
+        ("JPEG", ".jpg", (6000, 4000)),
+        ("PNG", ".png", (2400, 1800)),
+        ("PNG", ".png", (3200, 2400)),
+        ("WEBP", ".webp", (4000, 3000)),
+    ):
+        noise = Image.frombytes("RGB", dimensions, os.urandom(dimensions[0] * dimensions[1] * 3))
+        # Blur a little so the result looks a bit more like a photo than pure noise.
+        noise = noise.resize((dimensions[0] // 2, dimensions[1] // 2)).resize(dimensions, resample=Image.BICUBIC)
+        path = directory.joinpath("corpus_{}x{}{}".format(dimensions[0], dimensions[1], suffix))
+        noise.save(path, format=image_format, quality=100)
+        if path.stat().st_size > SIZE_LIMIT:
+            corpus.append(path)
+        else:
+            path.unlink()
+    return corpus
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the legacy resize loop with shrink_to_limit")
+    parser.add_argument("corpus", nargs="?", type=pathlib.Path, help="directory of oversized images")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus_directory:
+        if arguments.corpus:
+            corpus = sorted(
+                path for path in arguments.corpus.iterdir()
+                if path.suffix.lower() in CORPUS_SUFFIXES and path.stat().st_size > SIZE_LIMIT
+            )
+        else:
+            corpus = generate_corpus(pathlib.Path(corpus_directory))
+
+        print("{:<32} {:>9} | {:>7} {:>9} {:>10} | {:>7} {:>9} {:>10}".format(
+            "file", "size MB", "legacy", "passes", "seconds", "new", "passes", "seconds"
+        ))
+        legacy_total = 0.0
+        new_total = 0.0
+        for path in corpus:
+            start = time.perf_counter()
+            legacy_size, legacy_passes = legacy_resize(path)
+            legacy_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = image.shrink_to_limit(path.read_bytes(), SIZE_LIMIT)
+            new_seconds = time.perf_counter() - start
+
+            legacy_total += legacy_seconds
+            new_total += new_seconds
+            print("{:<32} {:>9.2f} | {:>7.2f} {:>9} {:>10.2f} | {:>7.2f} {:>9} {:>10.2f}".format(
+                path.name, path.stat().st_size / 1000000,
+                legacy_size / 1000000, legacy_passes, legacy_seconds,
+                len(result.data) / 1000000, result.passes, new_seconds,
+            ))
+
+        print("Total wall time: legacy [{:.2f}s], new [{:.2f}s]".format(legacy_total, new_total))
+
+
+if __name__ == '__main__':
+    main()
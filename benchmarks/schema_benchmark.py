@@ -0,0 +1,96 @@
+# Times the pinned_attachments / pinned_embeds dedupe lookups on the unindexed version 1 schema, and again after
+# migrating the same DB to the latest schema.
+#
+# Run from the repo root:
+#   python -m benchmarks.schema_benchmark [--rows 1000000] [--lookups 200]
+import argparse
+import pathlib
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from utils import migrations
+
+CONNECTIONS = 50
+
+
+def populate(connection: sqlite3.Connection, rows: int) -> list:
+    """
+    Fill a version 1 DB with connections and rows pinned attachments/embeds spread across them.
+
+    :param connection: connection to an empty DB
+    :param rows: how many pinned attachments (and a tenth as many embeds) to insert
+    :return: the channel keys created
+    """
+    connection.executescript(migrations.MIGRATIONS[0][2])
+    connection.execute("PRAGMA user_version = 1")
+    channel_keys = [str(uuid.uuid4()) for _ in range(CONNECTIONS)]
+    with connection:
+        connection.executemany(
+            "INSERT INTO channel_connections VALUES(?,?,?,?)",
+            ((channel_key, 1000 + index, 2000 + index, 1) for index, channel_key in enumerate(channel_keys))
+        )
+        connection.executemany(
+            "INSERT INTO pinned_attachments VALUES(?,?)",
+            ((row + 1, channel_keys[row % CONNECTIONS]) for row in range(rows))
+        )
+        connection.executemany(
+            "INSERT INTO pinned_embeds VALUES(?,?)",
+            (("https://discord.com/channels/1/2/{}".format(row), channel_keys[row % CONNECTIONS])
+             for row in range(rows // 10))
+        )
+    return channel_keys
+
+
+def time_lookups(connection: sqlite3.Connection, channel_keys: list, rows: int, lookups: int) -> tuple:
+    rng = random.Random(0)
+    attachment_queries = [(rng.randint(1, rows * 2), rng.choice(channel_keys)) for _ in range(lookups)]
+    embed_queries = [
+        ("https://discord.com/channels/1/2/{}".format(rng.randint(0, rows // 5)), rng.choice(channel_keys))
+        for _ in range(lookups)
+    ]
+
+    start = time.perf_counter()
+    for query in attachment_queries:
+        connection.execute("SELECT * FROM pinned_attachments WHERE attachment_id=? AND channel_key=?", query).fetchall()
+    attachment_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for query in embed_queries:
+        connection.execute("SELECT * FROM pinned_embeds WHERE embed_url=? AND channel_key=?", query).fetchall()
+    embed_seconds = time.perf_counter() - start
+
+    return attachment_seconds / lookups, embed_seconds / lookups
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time dedupe lookups before and after migrating")
+    parser.add_argument("--rows", type=int, default=1000000, help="pinned attachment rows to insert")
+    parser.add_argument("--lookups", type=int, default=200, help="lookups to time for each table")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        database_path = str(pathlib.Path(temp_directory).joinpath("benchmark.db"))
+        connection = sqlite3.connect(database_path)
+        print("Inserting [{}] pinned attachments and [{}] pinned embeds".format(arguments.rows, arguments.rows // 10))
+        channel_keys = populate(connection, arguments.rows)
+        before = time_lookups(connection, channel_keys, arguments.rows, arguments.lookups)
+        connection.close()
+
+        connection = migrations.connect(database_path)
+        start = time.perf_counter()
+        migrations.migrate(connection)
+        migrate_seconds = time.perf_counter() - start
+        after = time_lookups(connection, channel_keys, arguments.rows, arguments.lookups)
+        connection.close()
+
+    print("Migration took [{:.2f}s]".format(migrate_seconds))
+    print("{:<20} {:>16} {:>16}".format("lookup", "before (ms)", "after (ms)"))
+    print("{:<20} {:>16.3f} {:>16.3f}".format("pinned_attachments", before[0] * 1000, after[0] * 1000))
+    print("{:<20} {:>16.3f} {:>16.3f}".format("pinned_embeds", before[1] * 1000, after[1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,209 +1,681 @@
+import argparse
+import asyncio
+import collections
+import functools
 import io
+import math
+import pathlib
+import signal
+import time
+import typing
+
+# When starting up began, near enough: before discord.py, which is most of what importing takes.
+_STARTED = time.perf_counter()
 
 import discord
 import discord.ext.commands
-import pathlib
 import sqlite3
 import uuid
 
-from PIL import Image
-
+from utils import attachments
 from utils import config
+from utils import content
+from utils import db
+from utils import image
+from utils import inflight
+from utils import jobs
 from utils import log
-
-intents = discord.Intents.default()
+from utils import maintenance
+from utils import metrics
+from utils import routing
+
+# Only what PinBot uses: guild channels (for the channel cache), messages (for commands) and reactions.
+intents = discord.Intents.none()
+intents.guilds = True
+intents.guild_messages = True
+intents.dm_messages = True
 intents.message_content = True
-
-BOT = discord.ext.commands.Bot(command_prefix="!", intents=intents)
-DATABASE_CONNECTION = sqlite3.connect("pinbot.db")
+intents.guild_reactions = True
+
+SETTINGS = config.load_settings()
+# Messages are fetched when they're pinned, and members come with the reaction, so neither needs caching.
+# Sharded even when it's a single process: with shard_count and shard_ids unset it runs as many shards as Discord
+# recommends, with them set it runs just those, so the bot can be split across processes (see --shard-ids).
+BOT = discord.ext.commands.AutoShardedBot(
+    command_prefix="!",
+    intents=intents,
+    max_messages=None,
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    chunk_guilds_at_startup=False,
+    shard_count=SETTINGS.shard_count,
+    shard_ids=SETTINGS.shard_ids
+)
+DATABASE = db.Database(SETTINGS.database_path, busy_timeout=SETTINGS.database_busy_timeout)
+ROUTES = routing.RoutingTable()
+_SEND_SEMAPHORE: typing.Optional[asyncio.Semaphore] = None
+# Reaction events received, and how many of those were pins that got processed.
+EVENT_COUNTERS = collections.Counter()
+# The same, per shard: (shard ID, "received" or "processed") -> count
+SHARD_EVENT_COUNTERS = collections.Counter()
+_EVENT_RATE_TASK: typing.Optional[asyncio.Task] = None
+# (message ID, channel key) of the pins currently being made
+PINS_IN_FLIGHT = inflight.InFlightRegistry()
+DOWNLOADER = attachments.Downloader(SETTINGS.download_connections)
+RESIZE_CACHE = content.ResizeCache(pathlib.Path(SETTINGS.resize_cache_directory), SETTINGS.resize_cache_size)
+# (content hash, size limit) of the resizes currently running
+RESIZES_IN_FLIGHT = inflight.InFlightRegistry()
+# Made in setup_hook, once the loop it runs on exists.
+PIN_JOBS: typing.Optional[jobs.PinJobQueue] = None
+# Source channels being backfilled
+BACKFILLS_IN_FLIGHT = inflight.InFlightRegistry()
+# Upload limit of guilds without boosts, for pin channels that aren't cached.
+DEFAULT_UPLOAD_LIMIT = 8388608
+# Discord counts the whole upload against the limit, so leave room for the message and the multipart headers.
+UPLOAD_HEADROOM = 256 * 1024
+# Messages Discord returns per history request, and so how many messages a backfill checks (and checkpoints) at once.
+BACKFILL_PAGE_SIZE = 100
+_METRICS_RUNNER = None
+_EVENT_LOOP_LAG_TASK: typing.Optional[asyncio.Task] = None
+_MAINTENANCE_TASK: typing.Optional[asyncio.Task] = None
+_ROUTE_REFRESH_TASK: typing.Optional[asyncio.Task] = None
+# Seconds each phase of starting up took, in the order they finished.  See _startup_phase().
+STARTUP_PHASES: typing.Dict[str, float] = {}
+
+# Metrics for things that are already counted, read when they're collected.  The rest are in utils.metrics.
+metrics.Counter(
+    "pinbot_reaction_events_total", "Reaction events received, and how many were pins that got queued, per shard",
+    labels=("shard", "kind"), function=lambda: {
+        (str(shard_id), kind): count for (shard_id, kind), count in SHARD_EVENT_COUNTERS.items()
+    }
+)
+metrics.Gauge(
+    "pinbot_pin_jobs_in_flight", "Pin jobs queued, running or waiting to retry",
+    function=lambda: len(PIN_JOBS) if PIN_JOBS is not None else 0
+)
+metrics.Counter(
+    "pinbot_pin_jobs_total", "Pin jobs finished, by outcome: completed, retried or failed (gave up)",
+    labels=("outcome",), function=lambda: {
+        ("completed",): PIN_JOBS.completed, ("retried",): PIN_JOBS.retried, ("failed",): PIN_JOBS.failed
+    } if PIN_JOBS is not None else {}
+)
+metrics.Counter(
+    "pinbot_resize_cache_total", "Resize cache lookups, by result", labels=("result",),
+    function=lambda: {("hit",): RESIZE_CACHE.hits, ("miss",): RESIZE_CACHE.misses}
+)
+metrics.Counter(
+    "pinbot_route_lookups_total", "Routing table lookups of 📌 reactions' channels, by result: hit (a source channel)"
+    " or miss", labels=("result",), function=lambda: {("hit",): ROUTES.hits, ("miss",): ROUTES.misses}
+)
+metrics.Gauge("pinbot_db_size_bytes", "Size of the DB on disk, its WAL included", function=lambda: DATABASE.file_size())
+metrics.Gauge(
+    "pinbot_startup_seconds", "Seconds each phase of starting up took", labels=("phase",),
+    function=lambda: {(phase,): seconds for phase, seconds in STARTUP_PHASES.items()}
+)
 
 # TODO: Support pinning messages from a public channel to user DMs.
 
 
-def delete_record(channel_connection_key: str) -> None:
+class PinError(Exception):
+    """
+    A pin couldn't be posted to some of its connections.  Raised so the pin job gets retried.
+    """
+
+
+async def delete_record(channel_connection_key: str) -> None:
     """
     Given a channel connection key (a uuid4), check if it exists and delete it from the DB
 
     :param channel_connection_key: the uuid4 used to register channels
     :return: None
     """
-    log.debug("Checking if [{}] exists in DB".format(channel_connection_key))
-    with DATABASE_CONNECTION:
-        select_command = "SELECT * FROM channel_connections WHERE channel_key=?"
-        pending_connection = DATABASE_CONNECTION.execute(select_command, (channel_connection_key, )).fetchone()
-        if pending_connection:
+    log.debug("Checking if [{}] exists in DB", channel_connection_key)
+    deleted_connection = await DATABASE.delete_connection(channel_connection_key)
+    if deleted_connection:
+        ROUTES.remove(channel_connection_key)
+        log.debug(
+            "Deleted record [{} | {} | {} | {}] from the DB",
+            deleted_connection[0], deleted_connection[1], deleted_connection[2], deleted_connection[3]
+        )
+    else:
+        log.warning("Key [{}] does not exist in DB", channel_connection_key)
+
+
+async def _resize_attachment(
+    stored_attachment: attachments.StoredAttachment, store: attachments.AttachmentStore, size_limit: int
+) -> attachments.StoredAttachment:
+    """
+    Shrink an attachment under the upload limit, in its own format (see image.ENCODERS).  The resize runs in a process
+    pool, so the event loop (and every other guild's pins) keeps going while it does.
+
+    Resizes are cached by the original's content hash, so an image that's been resized before (a repost, or the same
+    image in another channel) isn't resized again, and concurrent resizes of the same image wait for the first one.
+
+    :param stored_attachment: the downloaded, oversized, hashed attachment
+    :param store: the store for the current pin request, the resized image is kept in it
+    :param size_limit: the maximum size in bytes, see _upload_limit
+    :return: the resized attachment
+    """
+    resize_key = (stored_attachment.content_hash, size_limit)
+
+    resized_data = await RESIZE_CACHE.get(*resize_key)
+    claimed = []
+    if resized_data is None:
+        claimed, joined = RESIZES_IN_FLIGHT.claim([resize_key])
+        if joined:
+            await asyncio.gather(*joined)
+            resized_data = await RESIZE_CACHE.get(*resize_key)
+
+    try:
+        if resized_data is None:
+            resize_started = time.perf_counter()
+            result = await image.resize_in_pool(stored_attachment.read(), size_limit)
+            metrics.RESIZE_SECONDS.observe(time.perf_counter() - resize_started)
+            metrics.RESIZE_PASSES.observe(result.passes)
             log.debug(
-                "Deleting record [{} | {} | {} | {}] from the DB".format(
-                    pending_connection[0], pending_connection[1], pending_connection[2], pending_connection[3]
-                )
+                "Final file size: [{}MB] ({}x{}) after [{}] passes",
+                round(len(result.data) / 1000000, 2), result.width, result.height, result.passes
             )
-            delete_command = "DELETE FROM channel_connections WHERE channel_key=?"
-            DATABASE_CONNECTION.execute(delete_command, (channel_connection_key,))
+            resized_data = result.data
+            await RESIZE_CACHE.put(*resize_key, resized_data)
         else:
-            log.warning("Key [{}] does not exist in DB".format(channel_connection_key))
+            log.debug("Using cached resize of [{}]", stored_attachment.content_hash)
+    finally:
+        RESIZES_IN_FLIGHT.release(claimed)
 
+    return store.add(
+        stored_attachment.filename, resized_data, spoiler=stored_attachment.spoiler,
+        content_hash=stored_attachment.content_hash
+    )
 
-async def _resize_attachment(attachment: discord.Attachment) -> pathlib.Path:
-    await attachment.save(attachment.filename)
-    local_file = pathlib.Path(attachment.filename)
-    final_file = pathlib.Path("reduce_{}".format(local_file.name))
-    final_file.write_bytes(local_file.read_bytes())
 
-    reduction_factor = 0.95
-    file_size_megabytes = round(final_file.stat().st_size / 1000000, 2)
-    while final_file.stat().st_size > 8000000:
-        with Image.open(local_file.name) as image:
-            new_width = int(image.width * reduction_factor)
-            new_height = int(image.height * reduction_factor)
-            log.debug("Resizing image to [{}x{}]".format(new_width, new_height))
+def _upload_limit(pin_channel_id: int) -> int:
+    """
+    :param pin_channel_id: ID of the pin channel
+    :return: the largest attachment in bytes that can be posted there, going by its guild's boost level
+    """
+    channel = BOT.get_channel(pin_channel_id)
+    guild = getattr(channel, "guild", None)
+    return (guild.filesize_limit if guild is not None else DEFAULT_UPLOAD_LIMIT) - UPLOAD_HEADROOM
 
-            image.thumbnail((new_width, new_height), resample=Image.LANCZOS)
-            image.save("reduce_{}".format(local_file.name), quality=100)
-        file_size_megabytes = round(final_file.stat().st_size / 1000000, 2)
-        log.debug("Reduction to [{}] resulted in file size [{}]".format(reduction_factor, file_size_megabytes))
 
-        reduction_factor -= 0.05
-        # There was a resize limit of 80% here before, removed, dunno why.  guess we'll find out lol.
+async def _prepare_attachment(
+    attachment: discord.Attachment, store: attachments.AttachmentStore, size_limit: int
+) -> typing.Optional[attachments.StoredAttachment]:
+    """
+    Download and hash an attachment into the request's store, resizing it if it's over the upload limit.
 
-    final_file = pathlib.Path("reduce_{}".format(local_file.name))
-    log.debug("Final file size: [{}MB] ({}x{})".format(file_size_megabytes, new_width, new_height))
-    local_file.unlink()
+    What to do with it is decided from the size and content type Discord reports before anything is downloaded, and
+    from the image header before the rest of it is: a file that's over the limit and can't be resized (a video, say,
+    or an image too big to decode) isn't downloaded at all, or only until that's clear, and gets posted as a link.
+
+    :param attachment: the attachment to download
+    :param store: the store for the current pin request
+    :param size_limit: the maximum size in bytes, the smallest upload limit of the pin channels it's going to
+    :return: the attachment, ready to be posted, or None if it should be posted as a link instead
+    """
+    oversized = attachment.size > size_limit
+    if oversized and not image.is_resizable(attachment.content_type, attachment.filename):
+        log.info(
+            "Attachment [{}] ({}) is over the upload limit of [{}MB] and can't be resized, linking it",
+            attachment.id, attachment.content_type, round(size_limit / 1000000, 2)
+        )
+        metrics.PINS.inc("linked")
+        return None
+    if oversized and attachment.size > SETTINGS.max_resize_download:
+        log.info(
+            "Attachment [{}] is too big to resize ([{}MB]), linking it",
+            attachment.id, round(attachment.size / 1000000, 2)
+        )
+        metrics.PINS.inc("linked")
+        return None
+
+    download_started = time.perf_counter()
+    try:
+        if oversized:
+            stored_attachment = await store.fetch(
+                attachment, max_bytes=SETTINGS.max_resize_download, accept_header=image.can_shrink
+            )
+        else:
+            stored_attachment = await store.fetch(attachment, max_bytes=size_limit)
+    except attachments.DownloadRejected as exception:
+        log.info("Stopped downloading attachment [{}], linking it: {}", attachment.id, exception)
+        metrics.PINS.inc("linked")
+        return None
+    metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - download_started)
+
+    if oversized:
+        log.warning(
+            "Attachment [{}] is over the upload limit of [{}MB] ([{}MB]); resizing for upload",
+            attachment.id, round(size_limit / 1000000, 2), round(stored_attachment.size / 1000000, 2)
+        )
+
+        # TODO: warning that this was resized
+        try:
+            stored_attachment = await _resize_attachment(stored_attachment, store, size_limit)
+        except image.ResizeError as exception:
+            log.warning("Couldn't resize attachment [{}], linking it: {}", attachment.id, exception)
+            metrics.PINS.inc("linked")
+            return None
+    return stored_attachment
+
+
+async def _send_pin(
+    pin_channel_id: int,
+    content: str,
+    stored_attachments: typing.Sequence[attachments.StoredAttachment] = (),
+    embed: typing.Optional[discord.Embed] = None
+) -> None:
+    """
+    Post a pin to a single pin channel.  Files are made fresh from the stored attachments for every send, since
+    discord.py closes them once they're sent.
+
+    :param pin_channel_id: ID of the channel to post to
+    :param content: the message text
+    :param stored_attachments: attachments to post, if any
+    :param embed: embed to post, if any
+    :return: None
+    """
+    channel = BOT.get_channel(pin_channel_id) or await BOT.fetch_channel(pin_channel_id)
+    started = time.perf_counter()
+    if stored_attachments:
+        await channel.send(content, files=[stored_attachment.to_file() for stored_attachment in stored_attachments])
+    else:
+        await channel.send(content, embed=embed)
+    metrics.SEND_SECONDS.observe(time.perf_counter() - started)
 
-    return final_file
+
+def _shard_of(guild_id: typing.Optional[int]) -> int:
+    # Discord's shard formula.  DMs are always on shard 0.
+    if guild_id is None:
+        return 0
+    return (guild_id >> 22) % (BOT.shard_count or 1)
+
+
+async def _log_event_rates(interval: float) -> None:
+    """
+    Every interval seconds, log the rate of reaction events and pins on each shard this process runs.
+
+    :param interval: seconds between reports
+    :return: None
+    """
+    last_counts = collections.Counter(SHARD_EVENT_COUNTERS)
+    while True:
+        await asyncio.sleep(interval)
+        counts = collections.Counter(SHARD_EVENT_COUNTERS)
+        for shard_id in sorted(BOT.shards):
+            received = counts[shard_id, "received"] - last_counts[shard_id, "received"]
+            processed = counts[shard_id, "processed"] - last_counts[shard_id, "processed"]
+            log.info(
+                "Shard [{}]: [{}] reaction events/s, [{}] pins/s", shard_id,
+                round(received / interval, 2), round(processed / interval, 2),
+                shard_id=shard_id, reaction_events=received, pins=processed, interval_s=interval
+            )
+        last_counts = counts
+
+
+async def _current_routes(source_channel: int, reload: bool = False) -> typing.Tuple[routing.Route, ...]:
+    """
+    A source channel's routes, no more than route_refresh_interval seconds out of date.  Another process sharing the
+    DB may have changed them, so if ROUTES read them longer ago than that they're read again (and ROUTES updated).  A
+    single process (route_refresh_interval 0) knows all the changes already and never needs to.
+
+    :param source_channel: ID of the source channel
+    :param reload: read them again however recently ROUTES did, unless it's a single process
+    :return: (channel_key, pin_channel) for every completed connection from it
+    """
+    refresh_interval = SETTINGS.route_refresh_interval
+    if not refresh_interval or (not reload and ROUTES.age(source_channel) < refresh_interval):
+        return ROUTES.peek(source_channel)
+    writes = ROUTES.writes
+    return ROUTES.load_source(source_channel, await DATABASE.load_source_connections(source_channel), writes)
+
+
+async def _refresh_routes(interval: float) -> None:
+    """
+    Every interval seconds, reload ROUTES from the DB, to pick up connections other processes sharing it registered or
+    deleted.
+
+    :param interval: seconds between reloads
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            writes = ROUTES.writes
+            ROUTES.load(await DATABASE.load_connections(), writes)
+        except sqlite3.Error as exception:
+            log.error("Couldn't reload routes, will try again in [{}s]: {}", interval, exception)
+
+
+def _get_send_semaphore() -> asyncio.Semaphore:
+    # Made on first use so it belongs to the loop the bot is running on.
+    global _SEND_SEMAPHORE
+    if _SEND_SEMAPHORE is None:
+        _SEND_SEMAPHORE = asyncio.Semaphore(SETTINGS.max_concurrent_sends)
+    return _SEND_SEMAPHORE
+
+
+async def _fan_out(
+    sends: typing.Dict[str, typing.Callable[[], typing.Awaitable[None]]]
+) -> typing.Tuple[typing.Set[str], typing.Dict[str, BaseException]]:
+    """
+    Run the sends for every connection concurrently, at most max_concurrent_sends at a time across the whole bot.
+    Each send goes to a different channel, and discord.py holds a lock per rate limit bucket (which for messages is
+    per channel), so any 429 handling only ever holds up the channel it belongs to.
+
+    A failing send is logged and doesn't stop the others.
+
+    :param sends: connection key -> coroutine function doing the send for that connection
+    :return: the connection keys that were sent successfully, and what went wrong with the ones that weren't
+    """
+    semaphore = _get_send_semaphore()
+
+    async def _bounded(send: typing.Callable[[], typing.Awaitable[None]]) -> None:
+        async with semaphore:
+            await send()
+
+    results = await asyncio.gather(*(_bounded(send) for send in sends.values()), return_exceptions=True)
+
+    pinned_connections = set()
+    failures = {}
+    for connection_key, result in zip(sends.keys(), results):
+        if isinstance(result, BaseException):
+            log.error("Failed to pin to connection [{}]: {!r}", connection_key, result)
+            failures[connection_key] = result
+        else:
+            pinned_connections.add(connection_key)
+    return pinned_connections, failures
 
 
 @BOT.event
-async def on_reaction_add(reaction: discord.reaction.Reaction, user: discord.member.Member) -> None:
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent) -> None:
+    """
+    Called for every reaction added anywhere PinBot can see, whether or not the message is cached.  Checks if the
+    reaction emoji is 📌 and the channel it's in has pin connections, and only then queues a job to pin it.  The pin
+    itself happens on a pin worker (see _run_pin_job), so this returns without waiting on Discord or the DB.
+
+    :param payload: The raw reaction event
+    :return: None
+    """
+    shard_id = _shard_of(payload.guild_id)
+    EVENT_COUNTERS["received"] += 1
+    SHARD_EVENT_COUNTERS[shard_id, "received"] += 1
+
+    # We don't care about reaction that aren't :pushpin:, or reactions sent in channels that aren't registered source
+    # channels.  That's nearly every reaction, so they're turned away before anything gets fetched, formatted or logged.
+    if payload.emoji.name != "📌":
+        return
+    channel_connections = ROUTES.get(payload.channel_id)
+    if not channel_connections:
+        return
+
+    EVENT_COUNTERS["processed"] += 1
+    SHARD_EVENT_COUNTERS[shard_id, "processed"] += 1
+    PIN_JOBS.submit(payload.guild_id, payload.channel_id, payload.message_id, payload.user_id, user=payload.member)
+
+
+async def _run_pin_job(job: jobs.PinJob) -> None:
+    """
+    Pin worker handler.  Fetches the message and pins it to the source channel's current connections.  Raises if it
+    should be retried, i.e. if anything went wrong other than the message, a channel or the user being gone (or hidden).
+
+    :param job: the pin job
+    :return: None
+    """
+    # Read again if ROUTES might be out of date, so a connection another process deleted isn't pinned to for long.
+    channel_connections = await _current_routes(job.source_channel)
+    if not channel_connections:
+        log.debug("[{}] has no connections anymore, dropping pin of [{}]", job.source_channel, job.message_id)
+        return
+
+    try:
+        source_channel = BOT.get_channel(job.source_channel) or await BOT.fetch_channel(job.source_channel)
+        post_to_pin = await source_channel.fetch_message(job.message_id)
+        # The member came with the reaction, unless the job was replayed after a restart.
+        user = job.user or BOT.get_user(job.user_id) or await BOT.fetch_user(job.user_id)
+    except (discord.NotFound, discord.Forbidden) as exception:
+        log.warning("Can't pin [{}] from [{}]: {}", job.message_id, job.source_channel, exception)
+        return
+
+    await pin_message(post_to_pin, user, channel_connections, reacted_at=job.created_at)
+
+
+async def _tell_user(user: discord.abc.User, message: str) -> None:
     """
-    Pinning function, called whenever PinBot can see a reaction added.  Checks if the reaction emoji is 📌 and the
-    channel it's in has pin connection.  If so, repost the reacted message's attachments/embeds to the connected
-    pin channels.
+    DM a user why their pin didn't happen.  Best effort: the pin job isn't retried over it, e.g. when they have DMs
+    from server members turned off.
 
-    :param reaction: The reaction action, used to get the message to post.
+    :param user: who pinned the message
+    :param message: what to tell them
+    :return: None
+    """
+    try:
+        await user.send(message)
+    except discord.HTTPException as exception:
+        log.debug("Couldn't DM [{}]: {}", user.id, exception)
+
+
+async def pin_message(
+    post_to_pin: discord.Message,
+    user: discord.abc.User,
+    channel_connections: typing.Sequence[routing.Route],
+    reacted_at: typing.Optional[float] = None
+) -> None:
+    """
+    Pinning function.  Repost the message's attachments/embeds to the connected pin channels.
+
+    :param post_to_pin: The message to post.
     :param user: The user that pinned the post.
+    :param channel_connections: The connections for the message's channel, from the routing table.
+    :param reacted_at: When the 📌 reaction came in (time.time()), for the pin latency metric.  Defaults to now.
     :return: None
+    :raises PinError: if it couldn't be posted to some of the connections, other than because their pin channel is
+                      gone or PinBot isn't allowed to post there
     """
-    post_to_pin = reaction.message
+    started = time.monotonic()
+    if reacted_at is None:
+        reacted_at = time.time()
     source_channel = post_to_pin.channel
-    log.debug(
-        "User [{}] ({}) react to [{}] in [{}] ({}) in server [{}] ({})".format(
+
+    if log.is_debug_enabled():
+        log.debug(
+            "User [{}] ({}) pinned [{}] in [{}] ({}) in server [{}] ({})",
             user.display_name, user.id,
             post_to_pin.id,
             source_channel.name, source_channel.id,
             source_channel.guild.name, source_channel.guild.id
         )
-    )
+        log.debug(
+            "Got [{}] connections for source channel [{}] ([{}]/[{}] reaction events processed)",
+            len(channel_connections), source_channel.id, EVENT_COUNTERS["processed"], EVENT_COUNTERS["received"]
+        )
 
-    # We don't care about reaction that aren't :pushpin:
-    if str(reaction) == "📌":
-        # We don't care about reactions sent in channels that aren't registered source channels
-        log.debug("Searching DB for records where source channel is [{}]".format(source_channel.id))
-        with DATABASE_CONNECTION:
-            select_command = "SELECT * FROM channel_connections WHERE source_channel=?"
-            channel_connections = DATABASE_CONNECTION.execute(select_command, (source_channel.id,)).fetchall()
+    if len(post_to_pin.attachments) == 0 and len(post_to_pin.embeds) == 0:
+        message = "Cannot pin message without media to pin."
+        log.warning(message)
+        metrics.PINS.inc("skipped")
+        await _tell_user(user, message)
+        return
 
-        if len(channel_connections) == 0:
-            log.warning("Channel [{}] has no pin connections".format(post_to_pin.channel.name))
-            return
-        else:
-            log.debug(
-                "Got [{}] connections for source channel [{}]".format(len(channel_connections), source_channel.id)
-            )
+    # Author's choice: either embed something (links, usually) or attach it.  Not both.
+    if len(post_to_pin.attachments) > 0 and len(post_to_pin.embeds) > 0:
+        message = "Will not pin something with attachments and embeds, separate them."
+        log.warning(message)
+        metrics.PINS.inc("skipped")
+        await _tell_user(user, message)
+        return
 
-        if len(post_to_pin.attachments) == 0 and len(post_to_pin.embeds) == 0:
-            message = "Cannot pin message without media to pin."
-            log.warning(message)
-            await user.send(message)
-            return
+    # Several people hitting 📌 at once would otherwise all see "not pinned yet" and all post it.  Each connection is
+    # pinned by whichever reaction claims it first, the rest wait for that to finish.
+    claimed, joined = PINS_IN_FLIGHT.claim(
+        (post_to_pin.id, connection_key) for connection_key, _ in channel_connections
+    )
+    claimed_connections = [route for route in channel_connections if (post_to_pin.id, route[0]) in claimed]
+    failures = {}
+    try:
+        if claimed_connections:
+            pinned_connections, failures = await _pin_to_connections(post_to_pin, user, claimed_connections)
+            for connection_key, pin_channel in claimed_connections:
+                if connection_key in pinned_connections:
+                    metrics.PINS.inc("posted")
+                    metrics.PIN_LATENCY_SECONDS.observe(time.time() - reacted_at)
+                    log.debug(
+                        "Pinned [{}] to [{}]", post_to_pin.id, pin_channel,
+                        guild_id=source_channel.guild.id, channel_id=source_channel.id, message_id=post_to_pin.id,
+                        pin_channel_id=pin_channel, latency_ms=round((time.monotonic() - started) * 1000, 1)
+                    )
+    finally:
+        PINS_IN_FLIGHT.release(claimed)
+
+    if joined:
+        log.debug("[{}] is already being pinned to [{}] connections, joining", post_to_pin.id, len(joined))
+        await asyncio.gather(*joined)
+
+    if failures:
+        metrics.PINS.inc("failed", amount=len(failures))
+        # A pin channel that's gone, or that PinBot can't post in anymore, would fail the same way on every retry.
+        retryable = {}
+        for connection_key, exception in failures.items():
+            if isinstance(exception, (discord.NotFound, discord.Forbidden)):
+                log.warning("Can't pin [{}] to connection [{}], not retrying: {}", post_to_pin.id, connection_key,
+                            exception)
+            else:
+                retryable[connection_key] = exception
+        if retryable:
+            raise PinError(
+                "Failed to pin [{}] to [{}] of [{}] connections".format(
+                    post_to_pin.id, len(retryable), len(claimed_connections)
+                )
+            ) from next(iter(retryable.values()))
 
-        # Author's choice: either embed something (links, usually) or attach it.  Not both.
-        if len(post_to_pin.attachments) > 0 and len(post_to_pin.embeds) > 0:
-            message = "Will not pin something with attachments and embeds, separate them."
-            log.warning(message)
-            await user.send(message)
-            return
 
-        for connection in channel_connections:
-            connection_key = connection[0]
-            pin_channel = connection[2]
-            channel = await BOT.fetch_channel(pin_channel)
-
-            pinned_message = False
-
-            if len(post_to_pin.attachments) > 0:
-                attachments_to_pin = []
-
-                # Finding what attachments that haven't been pinned yet
-                for attachment in post_to_pin.attachments:
-                    pinned_lookup_command = "SELECT * FROM pinned_attachments WHERE attachment_id=? AND channel_key=?"
-                    attachment_pins = DATABASE_CONNECTION.execute(
-                        pinned_lookup_command, (attachment.id, connection_key)
-                    ).fetchall()
-
-                    if attachment_pins:
-                        log.debug("Attachment [{}] already pinned".format(attachment.id))
-                        continue
-                    else:
-                        attachments_to_pin.append(attachment)
-
-                # Preparing attachments to be pinned
-                files = []
-                for attachment in attachments_to_pin:
-                    if attachment.size > 8000000:
-                        attachment_size_string = "{}MB".format(round(attachment.size / 1000000, 2))
-                        log.warning(
-                            "Attachment [{}] is over max size of 8MB ({}); resizing for upload".format(
-                                attachment.id, attachment_size_string
-                            )
-                        )
-
-                        # TODO: warning that this was resized
-                        resized_file = await _resize_attachment(attachment)
-                        files.append(discord.File(resized_file.name))
-                    else:
-                        files.append(await attachment.to_file())
-
-                # Pinning attachments that need to be pinned
-                if files:
-                    await channel.send(
-                        "Pinned by `{}`\nOriginal Message: {}".format(user.display_name, post_to_pin.jump_url),
-                        files=files
+async def _pin_to_connections(
+    post_to_pin: discord.Message, user: discord.abc.User, channel_connections: typing.Sequence[routing.Route]
+) -> typing.Tuple[typing.Set[str], typing.Dict[str, BaseException]]:
+    """
+    Post the message's attachments/embeds to the given connections, skipping anything that's already been pinned
+    there, and log what was pinned.
+
+    :param post_to_pin: The message to post.
+    :param user: The user that pinned the post.
+    :param channel_connections: The connections to pin to, claimed by the caller.
+    :return: The channel keys of the connections it was pinned to, and why it failed for those it wasn't.
+    """
+    pin_text = "Pinned by `{}`\nOriginal Message: {}".format(user.display_name, post_to_pin.jump_url)
+
+    if len(post_to_pin.attachments) > 0:
+        # Finding what attachments that haven't been pinned yet, for every connection at once
+        already_pinned = await DATABASE.get_pinned_attachments(
+            [attachment.id for attachment in post_to_pin.attachments],
+            [connection_key for connection_key, _ in channel_connections]
+        )
+        attachments_to_pin = {}
+        for connection_key, _ in channel_connections:
+            attachments_to_pin[connection_key] = []
+            for attachment in post_to_pin.attachments:
+                if (attachment.id, connection_key) in already_pinned:
+                    log.debug("Attachment [{}] already pinned to [{}]", attachment.id, connection_key)
+                    metrics.PINS.inc("duplicate")
+                else:
+                    attachments_to_pin[connection_key].append(attachment)
+
+        # Download (and resize) each attachment once, no matter how many channels it's going to, small enough for
+        # the smallest upload limit among them.
+        needed_attachments = {}
+        size_limits = {}
+        for connection_key, pin_channel in channel_connections:
+            for attachment in attachments_to_pin[connection_key]:
+                needed_attachments[attachment.id] = attachment
+                size_limits[attachment.id] = min(
+                    size_limits.get(attachment.id, math.inf), _upload_limit(pin_channel)
+                )
+        with attachments.AttachmentStore(SETTINGS.attachment_memory_limit, DOWNLOADER) as store:
+            prepared_attachments = await asyncio.gather(
+                *(
+                    _prepare_attachment(attachment, store, size_limits[attachment_id])
+                    for attachment_id, attachment in needed_attachments.items()
+                )
+            )
+            # None for the ones that are posted as links
+            stored_attachments = dict(zip(needed_attachments.keys(), prepared_attachments))
+
+            # Attachments that are byte for byte something already in the pin channel, when suppressing reposts.
+            # They're logged as pinned all the same, so the next 📌 on this message doesn't download them again.
+            # Best effort: two reposts pinned at the same moment can both get through.
+            suppressed_pins = []
+            if SETTINGS.suppress_duplicate_content:
+                already_posted = await DATABASE.get_pinned_content(
+                    {
+                        stored_attachment.content_hash for stored_attachment in prepared_attachments
+                        if stored_attachment is not None
+                    },
+                    {pin_channel for _, pin_channel in channel_connections}
+                )
+                for connection_key, pin_channel in channel_connections:
+                    pending = []
+                    for attachment in attachments_to_pin[connection_key]:
+                        stored_attachment = stored_attachments[attachment.id]
+                        if stored_attachment is not None and (
+                            stored_attachment.content_hash, pin_channel
+                        ) in already_posted:
+                            log.debug("Attachment [{}] is a repost in [{}], not pinning", attachment.id, pin_channel)
+                            metrics.PINS.inc("suppressed")
+                            suppressed_pins.append((attachment.id, connection_key))
+                        else:
+                            pending.append(attachment)
+                    attachments_to_pin[connection_key] = pending
+
+            sends = {}
+            for connection_key, pin_channel in channel_connections:
+                if attachments_to_pin[connection_key]:
+                    links = [
+                        attachment.url for attachment in attachments_to_pin[connection_key]
+                        if stored_attachments[attachment.id] is None
+                    ]
+                    sends[connection_key] = functools.partial(
+                        _send_pin, pin_channel, "\n".join([pin_text, *links]),
+                        stored_attachments=[
+                            stored_attachments[attachment.id] for attachment in attachments_to_pin[connection_key]
+                            if stored_attachments[attachment.id] is not None
+                        ]
                     )
+            pinned_connections, failures = await _fan_out(sends)
+
+        # Logging that we pinned attachments
+        pin_channels = dict(channel_connections)
+        await DATABASE.record_pins(
+            attachment_pins=[
+                (attachment.id, connection_key)
+                for connection_key in pinned_connections for attachment in attachments_to_pin[connection_key]
+            ] + suppressed_pins,
+            content_pins=[
+                (stored_attachments[attachment.id].content_hash, pin_channels[connection_key], connection_key)
+                for connection_key in pinned_connections for attachment in attachments_to_pin[connection_key]
+                if stored_attachments[attachment.id] is not None
+            ]
+        )
+
+    else:
+        # Embeds are logged by the message URL, so only the first embed of a message ever gets pinned.
+        already_pinned = await DATABASE.get_pinned_embed_keys(
+            post_to_pin.jump_url, [connection_key for connection_key, _ in channel_connections]
+        )
+        sends = {}
+        for connection_key, pin_channel in channel_connections:
+            if connection_key in already_pinned:
+                log.warning("Embed [{}] was already pinned to [{}]", post_to_pin.jump_url, connection_key)
+                metrics.PINS.inc("duplicate")
+            else:
+                sends[connection_key] = functools.partial(
+                    _send_pin, pin_channel, pin_text, embed=post_to_pin.embeds[0]
+                )
+        pinned_connections, failures = await _fan_out(sends)
 
-                    # Closing file handles and deleting temp files
-                    for file in files:
-                        filename = file.filename
-                        file = None
-                        pathlib.Path(filename).unlink(missing_ok=True)
-                    pinned_message = True
-
-                # Logging that we pinned attachments
-                for attachment in attachments_to_pin:
-                    with DATABASE_CONNECTION:
-                        db_entry_command = """INSERT INTO pinned_attachments(attachment_id,channel_key) VALUES(?,?)"""
-                        DATABASE_CONNECTION.execute(db_entry_command, (int(attachment.id), connection_key))
-
-            elif len(post_to_pin.embeds) > 0:
-                for embed in post_to_pin.embeds:
-                    embed_lookup_command = "SELECT * FROM pinned_embeds WHERE embed_url=? AND channel_key=?"
-                    embed_pins = DATABASE_CONNECTION.execute(
-                        embed_lookup_command, (post_to_pin.jump_url, connection_key)
-                    ).fetchall()
-
-                    if embed_pins:
-                        log.warning("Embed [{}] was already pinned".format(post_to_pin.jump_url))
-                    else:
-                        await channel.send(
-                            "Pinned by `{}`\nOriginal Message: {}".format(user.display_name, post_to_pin.jump_url),
-                            embed=embed
-                        )
-                        pinned_message = True
-                        with DATABASE_CONNECTION:
-                            db_entry_command = """INSERT INTO pinned_embeds(embed_url,channel_key) VALUES(?,?)"""
-                            DATABASE_CONNECTION.execute(db_entry_command, (post_to_pin.jump_url, connection_key))
-
-            if pinned_message:
-                log.debug("Pinned [{}] to [{}]".format(post_to_pin.id, pin_channel))
+        await DATABASE.record_pins(
+            embed_pins=[(post_to_pin.jump_url, connection_key) for connection_key in pinned_connections]
+        )
+
+    return pinned_connections, failures
 
 
 @BOT.command()
@@ -219,47 +691,35 @@ async def register_source_channel(ctx: discord.ext.commands.context.Context) ->
     registering_user: discord.User = ctx.message.author
 
     if type(source_channel) == discord.DMChannel:
-        log.warning("User [{}] tried to register DMs as a source channel".format(registering_user.id))
+        log.warning("User [{}] tried to register DMs as a source channel", registering_user.id)
         await registering_user.send("You cannot make your DMs with PinBot a source for other channels.")
         return
 
     log.debug(
-        "User [{}] ([{}]) began registering channel [{}] ([{}])".format(
-            registering_user.display_name, registering_user.id, source_channel, source_channel.id
-        )
+        "User [{}] ([{}]) began registering channel [{}] ([{}])",
+        registering_user.display_name, registering_user.id, source_channel, source_channel.id
     )
 
     # If they already have a pending connection to this channel, give that key to them instead of making a new one.
-    with DATABASE_CONNECTION:
-        select_command = """
-            SELECT * FROM channel_connections 
-            WHERE source_channel=? and pin_channel IS NULL and registering_user=?
-        """
-        pending_connections = DATABASE_CONNECTION.execute(select_command, (source_channel.id, registering_user.id))
-        pending_connections = pending_connections.fetchall()
-        if len(pending_connections) > 0:
-            log.debug(
-                "User [{}] already has pending connection, sending them key [{}] again".format(
-                    registering_user.id, pending_connections[0][0]
-                )
-            )
-            await registering_user.send(
-                "Register pin channel with `!register_pin_channel {}`".format(pending_connections[0][0])
-            )
-            return
+    pending_connection = await DATABASE.get_pending_connection(source_channel.id, registering_user.id)
+    if pending_connection:
+        log.debug(
+            "User [{}] already has pending connection, sending them key [{}] again",
+            registering_user.id, pending_connection[0]
+        )
+        await registering_user.send(
+            "Register pin channel with `!register_pin_channel {}`".format(pending_connection[0])
+        )
+        return
 
     # Create UUID for this channel connection
     channel_connection_key = str(uuid.uuid4())
-    log.debug("Logging connection for [{}] with key [{}]".format(source_channel.id, channel_connection_key))
+    log.debug("Logging connection for [{}] with key [{}]", source_channel.id, channel_connection_key)
 
     # Create DB entry
-    with DATABASE_CONNECTION:
-        db_entry_command = """
-            INSERT INTO channel_connections(channel_key,source_channel,pin_channel,registering_user) 
-            VALUES(?,?,NULL,?)
-        """
-        DATABASE_CONNECTION.execute(db_entry_command, (channel_connection_key, source_channel.id, registering_user.id))
-    log.debug("Added record to DB: [{} | {} | {}]".format(channel_connection_key, source_channel.id, "NULL"))
+    await DATABASE.add_connection(channel_connection_key, source_channel.id, registering_user.id)
+    ROUTES.add(channel_connection_key, source_channel.id)
+    log.debug("Added record to DB: [{} | {} | {}]", channel_connection_key, source_channel.id, "NULL")
 
     # Done - send the user a DM with the registration command
     await registering_user.send("Register pin channel with `!register_pin_channel {}`".format(channel_connection_key))
@@ -284,78 +744,73 @@ async def register_pin_channel(ctx: discord.ext.commands.context.Context, channe
     pin_channel: discord.TextChannel = ctx.message.channel
 
     if type(pin_channel) == discord.DMChannel:
-        log.warning("User [{}] tried to register DMs as a pin channel, not supported.".format(registering_user.id))
+        log.warning("User [{}] tried to register DMs as a pin channel, not supported.", registering_user.id)
         await registering_user.send("Sending pins as DMs not supported at this time, deleting pending key.")
-        delete_record(channel_connection_key)
+        await delete_record(channel_connection_key)
         return
 
     bot_member = await pin_channel.guild.fetch_member(BOT.user.id)
     if not pin_channel.permissions_for(bot_member).send_messages:
-        log.warning("Cannot send messages to [{}], will not pin.")
+        log.warning("Cannot send messages to [{}], will not pin.", pin_channel.id)
         await registering_user.send("Cannot send messages in `{}`, deleting pending key.".format(pin_channel.name))
-        delete_record(channel_connection_key)
+        await delete_record(channel_connection_key)
         return
 
     log.debug(
-        "Attempting to register channel [{}] ([{}]) by [{}] ([{}])".format(
-            pin_channel.name, pin_channel.id, registering_user.display_name, registering_user.id
-        )
+        "Attempting to register channel [{}] ([{}]) by [{}] ([{}])",
+        pin_channel.name, pin_channel.id, registering_user.display_name, registering_user.id
     )
 
-    with DATABASE_CONNECTION:
-        select_command = "SELECT * FROM channel_connections WHERE channel_key=?"
-        # Since channel_key is UNIQUE on the table, we know this will always return None, or the pending record.
-        pending_connection = DATABASE_CONNECTION.execute(select_command, (channel_connection_key, )).fetchone()
-        if not pending_connection:
-            log.warning(
-                "User [{}] ([{}]) tried connecting with nonexistent key [{}]".format(
-                    ctx.message.author.display_name, ctx.message.author.id, channel_connection_key
-                )
-            )
-            await ctx.send("No pending channel registrations with key `{}`".format(channel_connection_key))
-            return
-
-        # Make sure the user the ran the command is the user that ran the first command.
-        original_registering_user: discord.User = await BOT.fetch_user(pending_connection[3])
-        if original_registering_user.id != registering_user.id:
-            log.warning(
-                "User [{}] ([{}]) tried registering key made by User [{}] ([{}])".format(
-                    registering_user.display_name, registering_user.id, original_registering_user.display_name,
-                    original_registering_user.id
-                )
-            )
-            await ctx.send("Cannot use another user's key, please run `!register_source_channel` yourself.")
-            return
+    # Since channel_key is UNIQUE on the table, we know this will always return None, or the pending record.
+    pending_connection = await DATABASE.get_connection(channel_connection_key)
+    if not pending_connection:
+        log.warning(
+            "User [{}] ([{}]) tried connecting with nonexistent key [{}]",
+            ctx.message.author.display_name, ctx.message.author.id, channel_connection_key
+        )
+        await ctx.send("No pending channel registrations with key `{}`".format(channel_connection_key))
+        return
 
-        # Pending record exists, the user is the same, let's see if a completed source -> pin record exists.
-        source_channel: discord.TextChannel = BOT.get_channel(pending_connection[1])
-        select_command = "SELECT * FROM channel_connections WHERE source_channel=? and pin_channel=?"
-        source_connections = DATABASE_CONNECTION.execute(select_command, (source_channel.id, pin_channel.id)).fetchall()
-
-        # If the record exists, let the user know and delete pending record.
-        # It's probably not great from a UX perspective, but it keeps the DB clean.
-        # And since I am a dunce, keeping the DB clean is paramount.
-        if source_connections:
-            log.warning(
-                "User [{}] ([{}]) tried registering [{}] which has already been registered with key [{}]".format(
-                    registering_user.display_name, registering_user.id, pin_channel.id, source_connections[0][0]
-                )
-            )
-            await ctx.send(
-                "`{}` -> `{}` already registered, will not register twice.  Deleting key `{}`".format(
-                    source_channel.name, pin_channel.name, channel_connection_key
-                )
-            )
-            delete_record(channel_connection_key)
+    # Make sure the user the ran the command is the user that ran the first command.
+    original_registering_user: discord.User = await BOT.fetch_user(pending_connection[3])
+    if original_registering_user.id != registering_user.id:
+        log.warning(
+            "User [{}] ([{}]) tried registering key made by User [{}] ([{}])",
+            registering_user.display_name, registering_user.id, original_registering_user.display_name,
+            original_registering_user.id
+        )
+        await ctx.send("Cannot use another user's key, please run `!register_source_channel` yourself.")
+        return
 
-        # Theoretically, that should always return 0 or 1 records.  But just in case, let's check that too
-        if len(source_connections) > 1:
-            log.error(
-                "[{}] -> [{}] connection registered [{}] times, investigation required!".format(
-                    source_channel.id, pin_channel.id, len(source_connections)
-                )
+    # Pending record exists, the user is the same, let's see if a completed source -> pin record exists.
+    # The source channel's guild may be on a shard another process runs, so it may not be cached here.
+    try:
+        source_channel: discord.TextChannel = (
+            BOT.get_channel(pending_connection[1]) or await BOT.fetch_channel(pending_connection[1])
+        )
+    except (discord.NotFound, discord.Forbidden):
+        log.warning("Source channel [{}] of key [{}] is gone", pending_connection[1], channel_connection_key)
+        await ctx.send("The source channel of `{}` is gone, deleting key.".format(channel_connection_key))
+        await delete_record(channel_connection_key)
+        return
+    # The unique index on (source_channel, pin_channel) means there's at most one.
+    source_connection = await DATABASE.get_connection_between(source_channel.id, pin_channel.id)
+
+    # If the record exists, let the user know and delete pending record.
+    # It's probably not great from a UX perspective, but it keeps the DB clean.
+    # And since I am a dunce, keeping the DB clean is paramount.
+    if source_connection:
+        log.warning(
+            "User [{}] ([{}]) tried registering [{}] which has already been registered with key [{}]",
+            registering_user.display_name, registering_user.id, pin_channel.id, source_connection[0]
+        )
+        await ctx.send(
+            "`{}` -> `{}` already registered, will not register twice.  Deleting key `{}`".format(
+                source_channel.name, pin_channel.name, channel_connection_key
             )
-            # TODO: figure out how to handle this case.
+        )
+        await delete_record(channel_connection_key)
+        return
 
     if source_channel.is_nsfw() and not pin_channel.is_nsfw():
         log.error("Will not pin possibly NSFW messages to non-NSFW channel, deleting pending record")
@@ -364,12 +819,13 @@ async def register_pin_channel(ctx: discord.ext.commands.context.Context, channe
                 source_channel.name, pin_channel.name, channel_connection_key
             )
         )
-        delete_record(channel_connection_key)
+        await delete_record(channel_connection_key)
+        return
 
     # Developer choice - you can't pin messages to the same chat, because _why_ would you?
     if source_channel.id == pin_channel.id:
         await ctx.send("Will not pin messages to the same chat; deleting pending key.")
-        delete_record(channel_connection_key)
+        await delete_record(channel_connection_key)
         return
 
         # So by this point, we've verified:
@@ -380,62 +836,474 @@ async def register_pin_channel(ctx: discord.ext.commands.context.Context, channe
         #  * The both channels as NSFW, SFW, or the source channel is SFW and the pin channel is NSFW
         # That means we're good to go to register it.
 
-    log.debug("Setting up connection from [{}] to [{}]".format(source_channel.id, pin_channel.id))
-    with DATABASE_CONNECTION:
-        update_command = "UPDATE channel_connections SET pin_channel=? WHERE channel_key=?"
-        DATABASE_CONNECTION.execute(update_command, (pin_channel.id, channel_connection_key))
-        log.debug(
-            "Updated record in DB: [{} | {} | {}]".format(channel_connection_key, source_channel.id, pin_channel.id)
+    log.debug("Setting up connection from [{}] to [{}]", source_channel.id, pin_channel.id)
+    try:
+        await DATABASE.set_pin_channel(channel_connection_key, pin_channel.id)
+    except sqlite3.IntegrityError:
+        # Someone else registered the same connection between our check and now.
+        log.warning("[{}] -> [{}] was registered concurrently", source_channel.id, pin_channel.id)
+        await ctx.send(
+            "`{}` -> `{}` already registered, will not register twice.  Deleting key `{}`".format(
+                source_channel.name, pin_channel.name, channel_connection_key
+            )
         )
+        await delete_record(channel_connection_key)
+        return
+    ROUTES.set_pin_channel(channel_connection_key, pin_channel.id)
+    log.debug("Updated record in DB: [{} | {} | {}]", channel_connection_key, source_channel.id, pin_channel.id)
 
     # Done
-    await ctx.send("Registered pinning from `{}` to `{}`".format(source_channel.name, pin_channel.name))
+    await ctx.send(
+        "Registered pinning from `{}` to `{}`.  Run `!backfill` in `{}` to pin what was pinned before now.".format(
+            source_channel.name, pin_channel.name, source_channel.name
+        )
+    )
+
+
+def _is_pinnable(message: discord.Message) -> bool:
+    """
+    Whether a message in history has a 📌 on it and something pin_message would pin.  Anything else is skipped by
+    backfills, rather than DMing whoever ran it about every message without media.
+    """
+    if bool(message.attachments) == bool(message.embeds):
+        return False
+    return any(reaction.emoji == "📌" for reaction in message.reactions)
+
+
+async def _find_unpinned(
+    messages: typing.Sequence[discord.Message], channel_connections: typing.Sequence[routing.Route]
+) -> typing.List[discord.Message]:
+    """
+    Find which pinnable messages in a page of history haven't been pinned to every connection yet, with one query per
+    pin table for the whole page.
+
+    :param messages: a page of the source channel's history
+    :param channel_connections: the source channel's connections
+    :return: the messages that still need pinning somewhere
+    """
+    candidates = [message for message in messages if _is_pinnable(message)]
+    channel_keys = [connection_key for connection_key, _ in channel_connections]
+    pinned_attachments = await DATABASE.get_pinned_attachments(
+        [attachment.id for message in candidates for attachment in message.attachments], channel_keys
+    )
+    pinned_embeds = await DATABASE.get_pinned_embeds(
+        [message.jump_url for message in candidates if message.embeds], channel_keys
+    )
+
+    unpinned = []
+    for message in candidates:
+        if message.attachments:
+            pinned = all(
+                (attachment.id, connection_key) in pinned_attachments
+                for attachment in message.attachments for connection_key in channel_keys
+            )
+        else:
+            pinned = all((message.jump_url, connection_key) in pinned_embeds for connection_key in channel_keys)
+        if not pinned:
+            unpinned.append(message)
+    return unpinned
+
+
+async def _backfill(
+    source_channel: discord.TextChannel, user: discord.abc.User, after_message_id: typing.Optional[int]
+) -> typing.Tuple[int, int]:
+    """
+    Page through a source channel's history, oldest first, queueing a pin job for every message with a 📌 that
+    hasn't been pinned everywhere yet.  Jobs are queued at most backfill_pins_per_second, so a backfill doesn't starve
+    live pins (or run into Discord's rate limits).  Progress is checkpointed after every page, once that page's jobs
+    are committed, so an interrupted backfill resumes from the last page without losing or rescanning anything.
+
+    A pin channel connected part way through missed the pages before, so once that happens the checkpoint is dropped
+    (registering it already did that once) and not saved again, and the next backfill starts from the beginning.
+
+    :param source_channel: the channel to backfill
+    :param user: who the pins are credited to
+    :param after_message_id: only look at messages after this one, None for the whole history
+    :return: how many messages were scanned and how many pins were queued
+    """
+    loop = asyncio.get_running_loop()
+    interval = 1 / SETTINGS.backfill_pins_per_second
+    next_queue_at = loop.time()
+    scanned = 0
+    queued = 0
+    last_message_id = after_message_id
+    # Keys of the connections there were when the backfill started, and whether any have been added since.
+    started_keys: typing.Optional[typing.Set[str]] = None
+    connected_since = False
+
+    async def _check_connections() -> typing.Tuple[routing.Route, ...]:
+        nonlocal started_keys, connected_since
+        # Connections may have changed since the last page.
+        channel_connections = await _current_routes(source_channel.id)
+        keys = {channel_key for channel_key, _ in channel_connections}
+        if started_keys is None:
+            started_keys = keys
+        elif keys - started_keys and not connected_since:
+            connected_since = True
+            log.info("[{}] got a new pin channel during its backfill, the next one starts over", source_channel.id)
+            await DATABASE.delete_backfill_checkpoint(source_channel.id)
+        return channel_connections
+
+    async def _process(page: typing.List[discord.Message]) -> None:
+        nonlocal next_queue_at, scanned, queued, last_message_id
+        channel_connections = await _check_connections()
+        unpinned = await _find_unpinned(page, channel_connections) if channel_connections else []
+        page_queued = 0
+        for message in unpinned:
+            delay = next_queue_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_queue_at = max(next_queue_at, loop.time()) + interval
+            if await PIN_JOBS.add(source_channel.guild.id, source_channel.id, message.id, user.id, user=user):
+                page_queued += 1
+
+        if not connected_since:
+            await DATABASE.save_backfill_checkpoint(
+                source_channel.id, page[-1].id, len(page), page_queued, time.time()
+            )
+        last_message_id = page[-1].id
+        scanned += len(page)
+        queued += page_queued
+        log.debug(
+            "Backfill of [{}] at [{}]: [{}] scanned, [{}] queued", source_channel.id, page[-1].id, scanned, queued
+        )
+
+    after = discord.Object(after_message_id) if after_message_id else None
+    page = []
+    async for message in source_channel.history(limit=None, after=after, oldest_first=True):
+        page.append(message)
+        if len(page) == BACKFILL_PAGE_SIZE:
+            await _process(page)
+            page = []
+    if page:
+        await _process(page)
+
+    await _check_connections()
+    if last_message_id and not connected_since:
+        await DATABASE.save_backfill_checkpoint(source_channel.id, last_message_id, 0, 0, time.time(), completed=True)
+    return scanned, queued
+
+
+@BOT.command()
+@discord.ext.commands.guild_only()
+@discord.ext.commands.has_permissions(manage_messages=True)
+async def backfill(ctx: discord.ext.commands.context.Context) -> None:
+    """
+    The !backfill command function.  Run in a source channel, pins everything in its history that has a 📌 on it
+    and hasn't been pinned to its pin channels yet, e.g. from before the connection was registered or while PinBot
+    was down.  Picks up after the last message a previous backfill got to.
+
+    :param ctx: discord context when someone calls !backfill
+    :return: None
+    """
+    source_channel: discord.TextChannel = ctx.message.channel
+    # The connection may have just been registered from a pin channel another process looks after.
+    if not await _current_routes(source_channel.id, reload=True):
+        await ctx.send("`{}` doesn't pin to any channels, nothing to backfill.".format(source_channel.name))
+        return
+
+    claimed, joined = BACKFILLS_IN_FLIGHT.claim([source_channel.id])
+    if joined:
+        await ctx.send("`{}` is already being backfilled.".format(source_channel.name))
+        return
+
+    try:
+        checkpoint = await DATABASE.get_backfill_checkpoint(source_channel.id)
+        after_message_id = checkpoint[1] if checkpoint else None
+        log.info(
+            "User [{}] ([{}]) started a backfill of [{}] after [{}]",
+            ctx.author.display_name, ctx.author.id, source_channel.id, after_message_id
+        )
+        await ctx.send(
+            "Backfilling `{}` {}.".format(
+                source_channel.name, "from where the last backfill stopped" if checkpoint else "from the start"
+            )
+        )
+
+        try:
+            scanned, queued = await _backfill(source_channel, ctx.author, after_message_id)
+        except discord.Forbidden:
+            log.warning("Can't read the history of [{}], backfill stopped", source_channel.id)
+            await ctx.send("I can't read the history of `{}`.".format(source_channel.name))
+            return
+        except Exception:
+            await ctx.send(
+                "Backfill of `{}` stopped part way, run `!backfill` again to pick up where it left off.".format(
+                    source_channel.name
+                )
+            )
+            raise
+
+        log.info("Backfill of [{}] done: [{}] scanned, [{}] queued", source_channel.id, scanned, queued)
+        await ctx.send("Backfill of `{}` done: checked {} messages, pinning {}.".format(
+            source_channel.name, scanned, queued
+        ))
+    finally:
+        BACKFILLS_IN_FLIGHT.release(claimed)
+
+
+def _format_seconds(seconds: typing.Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 1:
+        return "{}ms".format(round(seconds * 1000, 1))
+    return "{}s".format(round(seconds, 2))
+
+
+def _format_quantiles(histogram: metrics.Histogram, *label_values: str) -> str:
+    return "p50 {}, p99 {} ({} total)".format(
+        _format_seconds(histogram.quantile(0.5, *label_values)),
+        _format_seconds(histogram.quantile(0.99, *label_values)),
+        histogram.count(*label_values)
+    )
+
+
+@BOT.command()
+async def pinstats(ctx: discord.ext.commands.context.Context) -> None:
+    """
+    The !pinstats command function.  Replies with a summary of the metrics: how pins are going and how long they
+    take, since this process started.  Quantiles are estimated from the histogram buckets.
+
+    :param ctx: discord context when someone calls !pinstats
+    :return: None
+    """
+    pin_counts = ", ".join(
+        "{} {}".format(int(metrics.PINS.get(outcome)), outcome)
+        for outcome in ("posted", "duplicate", "suppressed", "linked", "failed", "skipped")
+    )
+    lines = [
+        "Pins: {}".format(pin_counts),
+        "Reaction to pin: {}".format(_format_quantiles(metrics.PIN_LATENCY_SECONDS)),
+        "Sends: {}".format(_format_quantiles(metrics.SEND_SECONDS)),
+        "Downloads: {}".format(_format_quantiles(metrics.DOWNLOAD_SECONDS)),
+        "Resizes: {}, {} cached".format(_format_quantiles(metrics.RESIZE_SECONDS), RESIZE_CACHE.hits),
+    ]
+    if metrics.RESIZE_PASSES.count():
+        lines.append("Passes per resize: {}".format(
+            round(metrics.RESIZE_PASSES.total() / metrics.RESIZE_PASSES.count(), 1)
+        ))
+    queries = metrics.DB_QUERY_SECONDS.label_values()
+    if queries:
+        slowest = max(queries, key=lambda label_values: metrics.DB_QUERY_SECONDS.quantile(0.99, *label_values))
+        lines.append("DB queries: {}, slowest {}: {}".format(
+            sum(metrics.DB_QUERY_SECONDS.count(*label_values) for label_values in queries),
+            slowest[0], _format_quantiles(metrics.DB_QUERY_SECONDS, *slowest)
+        ))
+    if PIN_JOBS is not None:
+        lines.append("Pin jobs: {} in flight, {} done, {} retries, {} given up".format(
+            len(PIN_JOBS), PIN_JOBS.completed, PIN_JOBS.retried, PIN_JOBS.failed
+        ))
+    lines.append("Event loop lag: {}".format(_format_seconds(metrics.EVENT_LOOP_LAG_SECONDS.get())))
+    await ctx.send("```\n{}\n```".format("\n".join(lines)))
+
+
+def _format_megabytes(size: int) -> str:
+    return "{}MB".format(round(size / 1000000, 2))
+
+
+@BOT.command()
+async def dbstats(ctx: discord.ext.commands.context.Context) -> None:
+    """
+    The !dbstats command function.  Replies with how big the DB is, what's in it, and what the last maintenance run
+    (see utils.maintenance) cleared out.
+
+    :param ctx: discord context when someone calls !dbstats
+    :return: None
+    """
+    stats = await DATABASE.get_stats()
+    lines = [
+        "DB: {} ({} of it WAL), {} free".format(
+            _format_megabytes(stats.file_bytes + stats.wal_bytes), _format_megabytes(stats.wal_bytes),
+            _format_megabytes(stats.free_pages * stats.page_size)
+        ),
+        "Pins: {} attachments ({} more archived), {} embeds, {} content hashes".format(
+            stats.pinned_attachments, stats.archived_attachments, stats.pinned_embeds, stats.pinned_content
+        ),
+    ]
+    report = maintenance.LAST_REPORT
+    if report is None:
+        lines.append("Maintenance: hasn't run since this process started")
+    else:
+        lines.append("Last maintenance: {} ago, took {}".format(
+            _format_seconds(time.time() - report.finished_at), _format_seconds(report.seconds)
+        ))
+        lines.append("Pruned {} orphaned rows, archived {} pins, reclaimed {}".format(
+            sum(report.pruned.values()), report.archived, _format_megabytes(report.reclaimed_bytes)
+        ))
+    lines.append("Since this process started: pruned {}, archived {}, reclaimed {}".format(
+        int(sum(value for _, _, value in metrics.DB_PRUNED_ROWS.samples())), int(metrics.DB_ARCHIVED_PINS.get()),
+        _format_megabytes(metrics.DB_RECLAIMED_BYTES.get())
+    ))
+    await ctx.send("```\n{}\n```".format("\n".join(lines)))
+
+
+def _startup_phase(phase: str) -> None:
+    """
+    Record that a phase of starting up just finished, and how long it took since the one before it did (or since
+    starting, for the first).  Only the first time counts, so reconnecting later doesn't change the report.
+
+    :param phase: what was being done
+    :return: None
+    """
+    if phase not in STARTUP_PHASES:
+        STARTUP_PHASES[phase] = time.perf_counter() - _STARTED - sum(STARTUP_PHASES.values())
+
+
+async def setup_hook() -> None:
+    """
+    Runs once the bot has logged in, before it connects to the gateway.  Loads the routing table (and keeps reloading
+    it), starts the pin workers, replaying any pins (on this process's shards) that didn't finish last time, starts
+    logging event rates, starts serving metrics and schedules DB maintenance.
+
+    :return: None
+    """
+    global PIN_JOBS, _EVENT_RATE_TASK, _METRICS_RUNNER, _EVENT_LOOP_LAG_TASK, _MAINTENANCE_TASK, _ROUTE_REFRESH_TASK
+    _startup_phase("login")
+    if BOT.shard_ids is None:
+        log.info("Running all shards ([{}] total)", BOT.shard_count or "automatic")
+    else:
+        log.info("Running shards [{}] of [{}]", ", ".join(str(shard_id) for shard_id in BOT.shard_ids), BOT.shard_count)
+
+    ROUTES.load(await DATABASE.load_connections())
+    log.info("Loaded routes for [{}] source channels", len(ROUTES))
+    if SETTINGS.route_refresh_interval and _ROUTE_REFRESH_TASK is None:
+        _ROUTE_REFRESH_TASK = asyncio.create_task(_refresh_routes(SETTINGS.route_refresh_interval))
+
+    PIN_JOBS = jobs.PinJobQueue(
+        DATABASE,
+        _run_pin_job,
+        workers=SETTINGS.pin_workers,
+        max_attempts=SETTINGS.pin_job_max_attempts,
+        backoff=SETTINGS.pin_job_backoff,
+        max_backoff=SETTINGS.pin_job_max_backoff,
+        shard_count=BOT.shard_count,
+        shard_ids=BOT.shard_ids
+    )
+    replayed = await PIN_JOBS.start()
+    log.info("Started [{}] pin workers, replaying [{}] unfinished pins", PIN_JOBS.workers, replayed)
+
+    if SETTINGS.event_rate_log_interval and _EVENT_RATE_TASK is None:
+        _EVENT_RATE_TASK = asyncio.create_task(_log_event_rates(SETTINGS.event_rate_log_interval))
+
+    if _EVENT_LOOP_LAG_TASK is None:
+        _EVENT_LOOP_LAG_TASK = asyncio.create_task(
+            metrics.monitor_event_loop_lag(SETTINGS.event_loop_lag_interval)
+        )
+    if SETTINGS.metrics_port is not None and _METRICS_RUNNER is None:
+        # Not worth not pinning over.
+        try:
+            _METRICS_RUNNER = await metrics.start_server(SETTINGS.metrics_host, SETTINGS.metrics_port)
+        except OSError as exception:
+            log.error("Can't serve metrics on port [{}]: {}", SETTINGS.metrics_port, exception)
+
+    # Processes sharing the DB would only repeat each other's work, so the one with shard 0 looks after it.
+    maintains_database = BOT.shard_ids is None or 0 in BOT.shard_ids
+    if SETTINGS.database_maintenance_interval and maintains_database and _MAINTENANCE_TASK is None:
+        _MAINTENANCE_TASK = asyncio.create_task(maintenance.run_forever(
+            DATABASE, SETTINGS.database_maintenance_interval, SETTINGS.archive_pins_after_days
+        ))
+    _startup_phase("setup")
+
+
+@BOT.event
+async def on_ready() -> None:
+    """
+    Runs once every shard this process runs is connected and has its guilds, and again after some reconnects.  The
+    first time, reports how long starting up took.
+
+    :return: None
+    """
+    if "gateway" in STARTUP_PHASES:
+        return
+    _startup_phase("gateway")
+    log.info(
+        "Started in [{}s]: {}", round(sum(STARTUP_PHASES.values()), 2),
+        ", ".join("{} {}s".format(phase, round(seconds, 2)) for phase, seconds in STARTUP_PHASES.items())
+    )
+
+
+@BOT.event
+async def on_shard_connect(shard_id: int) -> None:
+    log.info("Shard [{}] of [{}] connected", shard_id, BOT.shard_count, shard_id=shard_id)
+
+
+BOT.setup_hook = setup_hook
+_close_bot = BOT.close
+
+
+async def close() -> None:
+    """
+    Runs when the bot shuts down.  Closes the download session, then the bot.
+
+    :return: None
+    """
+    await DOWNLOADER.close()
+    await _close_bot()
+
+
+BOT.close = close
+
+
+def _parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="PinBot")
+    parser.add_argument(
+        "--shard-ids", type=int, nargs="+", help="run only these shards, e.g. to split the bot across processes"
+    )
+    parser.add_argument("--shard-count", type=int, help="total number of shards, across every process")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics on this port instead of the configured one")
+    parser.add_argument(
+        "--vacuum", action="store_true",
+        help="rebuild the DB so DB maintenance can shrink it, then exit.  Stop every process using the DB first"
+    )
+    return parser.parse_args()
+
+
+def _vacuum() -> None:
+    """
+    --vacuum: switch a DB from before incremental auto vacuum over to it.  The rebuild holds the write lock throughout,
+    which is why it's a separate step, for when nothing else is using the DB.
+
+    :return: None
+    """
+    size = DATABASE.file_size()
+    log.info("Rebuilding the DB, which can take a while for a big one")
+    if DATABASE.enable_incremental_vacuum():
+        log.info("DB rebuilt with incremental auto vacuum, [{}] -> [{}]", _format_megabytes(size),
+                 _format_megabytes(DATABASE.file_size()))
+    else:
+        log.info("DB already has incremental auto vacuum, nothing to do")
 
 
 if __name__ == '__main__':
+    _startup_phase("imports")
+    arguments = _parse_arguments()
+    # The command line wins over settings.json, so processes sharing a config can each run different shards.
+    if arguments.shard_count is not None:
+        BOT.shard_count = arguments.shard_count
+    if arguments.shard_ids is not None:
+        BOT.shard_ids = arguments.shard_ids
+    if BOT.shard_ids is not None and BOT.shard_count is None:
+        raise SystemExit("--shard-ids needs a shard count, from --shard-count or settings.json")
+    if arguments.metrics_port is not None:
+        SETTINGS.metrics_port = arguments.metrics_port
+
+    if SETTINGS.queued_logging:
+        log.start_queue_listener()
+    image.configure_process_pool(SETTINGS.image_workers)
     log.info("Starting PinBot.  Initializing database")
-    with DATABASE_CONNECTION:
-        # Connections between Source and Pin channels
-        table_creation_command = """
-            CREATE TABLE IF NOT EXISTS channel_connections (
-                channel_key text UNIQUE,
-                source_channel INTEGER,
-                pin_channel INTEGER,
-                registering_user INTEGER 
-            )
-        """
-        DATABASE_CONNECTION.execute(table_creation_command)
-
-        # Log of attachments pinned from Source to Pin channels
-        table_creation_command = """
-            create table IF NOT EXISTS pinned_attachments
-            (
-                attachment_id int  not null,
-                channel_key   TEXT not null
-                    constraint pinned_attachments_channel_connections_channel_key_fk
-                        references channel_connections (channel_key)
-                        on delete cascade
-            );
-
-        """
-        DATABASE_CONNECTION.execute(table_creation_command)
-
-        # Log of embeds pinned from Source to Pin channels
-        table_creation_command = """
-            create table IF NOT EXISTS pinned_embeds
-            (
-                embed_url   TEXT not null,
-                channel_key TEXT not null
-                    constraint pinned_embeds_channel_connections_channel_key_fk
-                        references channel_connections (channel_key)
-                        on delete cascade
-            );
-        """
-        DATABASE_CONNECTION.execute(table_creation_command)
-
-    # TODO: figure out if sqlite can table-ly stop a source channel from being equal to a pin channel.
-    # TODO: figure out if sqlite can table-ly stop multiple of the same source/pin channel records.
-
-    log.info("Database initialized, running bot")
-
-    BOT.run(config.load_discord_token())
+    schema_version = DATABASE.open()
+    _startup_phase("database")
+
+    # docker stop sends SIGTERM.  Handled like Ctrl+C, so the bot and DB get closed (and the WAL checkpointed).
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if arguments.vacuum:
+            _vacuum()
+        else:
+            log.info("Database at schema version [{}], running bot", schema_version)
+            RESIZE_CACHE.load()
+            _startup_phase("resize cache")
+            BOT.run(config.load_discord_token())
+    finally:
+        DATABASE.close()
+        log.stop_queue_listener()
@@ -0,0 +1,130 @@
+# What the tests share: an event loop per test, main.py set up against a DB of the test's own, and a local stand-in for
+# the Discord API (tests.discord_stub) for the tests that go through the real discord.py HTTP client.  Handlers are
+# driven with the in-process fakes in tests.fakes otherwise.
+#
+# Run from the repo root:
+#   python -m pytest
+import asyncio
+import collections
+import types
+import typing
+import uuid
+
+import discord.http
+import discord.utils
+import pytest
+
+import main
+from tests import discord_stub
+from tests import fakes
+from utils import attachments
+from utils import content
+from utils import db
+from utils import metrics
+from utils import routing
+
+# What setup_hook starts, for it to start again (on the test's loop) and to be stopped after
+_BACKGROUND = ("_EVENT_RATE_TASK", "_EVENT_LOOP_LAG_TASK", "_MAINTENANCE_TASK", "_ROUTE_REFRESH_TASK")
+
+
+@pytest.fixture
+def loop() -> typing.Iterator[asyncio.AbstractEventLoop]:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def run(loop: asyncio.AbstractEventLoop) -> typing.Callable[[typing.Awaitable], typing.Any]:
+    """
+    Runs a coroutine on the test's loop and returns what it did, e.g. run(pinbot.setup_hook()).
+    """
+    return loop.run_until_complete
+
+
+@pytest.fixture
+def pinbot(tmp_path, monkeypatch, run) -> typing.Iterator[types.ModuleType]:
+    """
+    main, with its own DB and (turned off) resize cache in tmp_path, attachments downloaded from the fakes, every
+    counter and metric at zero, and none of what setup_hook starts left running after the test.  Metrics aren't served
+    unless the test sets metrics_port, nor routes refreshed, nor the DB maintained.
+    """
+    for name, value in {
+        "metrics_port": None, "route_refresh_interval": 0, "database_maintenance_interval": 0,
+        "event_rate_log_interval": 0, "pin_job_backoff": 0.05,
+    }.items():
+        monkeypatch.setattr(main.SETTINGS, name, value)
+
+    database = db.Database(str(tmp_path.joinpath("pinbot.db")))
+    monkeypatch.setattr(main, "DATABASE", database)
+    monkeypatch.setattr(main, "RESIZE_CACHE", content.ResizeCache(tmp_path.joinpath("resize_cache"), 0))
+    monkeypatch.setattr(main, "DOWNLOADER", fakes.FakeDownloader())
+    monkeypatch.setattr(main, "ROUTES", routing.RoutingTable())
+    monkeypatch.setattr(main, "EVENT_COUNTERS", collections.Counter())
+    monkeypatch.setattr(main, "SHARD_EVENT_COUNTERS", collections.Counter())
+    for name in ("PIN_JOBS", "_SEND_SEMAPHORE", "_METRICS_RUNNER", *_BACKGROUND):
+        monkeypatch.setattr(main, name, None)
+    for metric in metrics.REGISTRY:
+        monkeypatch.setattr(metric, "_values", {})
+        if isinstance(metric, metrics.Histogram):
+            monkeypatch.setattr(metric, "_histograms", {})
+    # fakes.install() replaces these.
+    monkeypatch.setattr(main.BOT, "get_channel", main.BOT.get_channel)
+    monkeypatch.setattr(main.BOT, "fetch_channel", main.BOT.fetch_channel)
+
+    database.open()
+    try:
+        yield main
+    finally:
+        if main.PIN_JOBS is not None:
+            run(main.PIN_JOBS.stop())
+        tasks = [getattr(main, name) for name in _BACKGROUND if getattr(main, name) is not None]
+        for task in tasks:
+            task.cancel()
+        run(asyncio.gather(*tasks, return_exceptions=True))
+        if main._METRICS_RUNNER is not None:
+            run(main._METRICS_RUNNER.cleanup())
+        run(main.DOWNLOADER.close())
+        database.close()
+
+
+@pytest.fixture
+def connect(pinbot, run) -> typing.Callable[[int, typing.Sequence[int], int], typing.List[str]]:
+    """
+    Connects a source channel to pin channels in the test's DB, like registering them does, e.g.
+    connect(source_channel.id, [pin_channel.id], user.id).  Returns the channel keys.
+    """
+    def connect(source_channel: int, pin_channels: typing.Sequence[int], user_id: int) -> typing.List[str]:
+        channel_keys = []
+        for pin_channel in pin_channels:
+            channel_key = str(uuid.uuid4())
+            run(pinbot.DATABASE.add_connection(channel_key, source_channel, user_id))
+            run(pinbot.DATABASE.set_pin_channel(channel_key, pin_channel))
+            pinbot.ROUTES.add(channel_key, source_channel, pin_channel)
+            channel_keys.append(channel_key)
+        return channel_keys
+
+    return connect
+
+
+@pytest.fixture
+def stub(pinbot, monkeypatch, run) -> typing.Iterator[discord_stub.DiscordStub]:
+    """
+    A local stand-in for the Discord API, with the bot logged in to it and downloading attachments from it through
+    the real download session.  Starts out with no channels.
+    """
+    monkeypatch.setattr(pinbot, "DOWNLOADER", attachments.Downloader())
+    monkeypatch.setattr(discord.http.Route, "BASE", discord.http.Route.BASE)
+    # The HTTP client keeps its connector between logins, and closing the client closes it.
+    monkeypatch.setattr(pinbot.BOT.http, "connector", discord.utils.MISSING)
+    stub = discord_stub.DiscordStub()
+    run(stub.start())
+    try:
+        run(stub.use(pinbot.BOT))
+        yield stub
+    finally:
+        run(pinbot.BOT.http.close())
+        run(stub.stop())
@@ -0,0 +1,220 @@
+# A local stand-in for the parts of the Discord HTTP API (and CDN) PinBot uses, so the real discord.py HTTP client can
+# be driven against it.  Point discord.py at it with use(), e.g.:
+#
+#   stub = DiscordStub(latency=0.02)
+#   await stub.start()
+#   await stub.use(pinbot.BOT)
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import re
+import time
+import types
+import typing
+
+import discord
+import discord.http
+from aiohttp import web
+
+_IDS = itertools.count(100000000000000000)
+# The content field of a posted message, whether it was posted as JSON or as the payload_json part of a multipart post
+_CONTENT = re.compile(rb'"content":\s*"((?:[^"\\]|\\.)*)"')
+
+
+def next_id() -> int:
+    return next(_IDS)
+
+
+def json_response(data: dict, status: int = 200, headers: typing.Optional[dict] = None) -> web.Response:
+    # discord.py only decodes JSON if the content type is exactly application/json, no charset.
+    return web.Response(
+        body=json.dumps(data).encode(), status=status, headers={"Content-Type": "application/json", **(headers or {})}
+    )
+
+
+class DiscordStub:
+    """
+    Serves channels, messages and attachments it's been told about, and takes message posts.
+
+    :param latency: seconds every API request takes
+    :param error_rate: fraction of message posts answered with a 500
+    :param rate_limit_rate: fraction of message posts answered with a 429
+    :param retry_after: what the 429s tell the client to wait, in seconds
+    """
+
+    def __init__(
+        self, latency: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0, retry_after: float = 0.05
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.guild_id = next_id()
+        self.channels: typing.Dict[int, dict] = {}
+        self.messages: typing.Dict[int, dict] = {}
+        self.files: typing.Dict[int, bytes] = {}
+        # channel ID -> request body size of every message posted there
+        self.posts: typing.Dict[int, typing.List[int]] = {}
+        # channel ID -> text of every message posted there
+        self.post_contents: typing.Dict[int, typing.List[str]] = {}
+        # channel ID -> time.perf_counter() when each of those posts was accepted
+        self.post_times: typing.Dict[int, typing.List[float]] = {}
+        # attachment ID -> bytes written to clients, which stops early if the client hangs up
+        self.bytes_served: typing.Dict[int, int] = {}
+        self.requests = 0
+        self.errors_sent = 0
+        self.rate_limits_sent = 0
+        self.base_url = ""
+        self._runner: typing.Optional[web.AppRunner] = None
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/api/v10/users/@me", self._get_me)
+        app.router.add_get("/api/v10/users/{user_id}", self._get_user)
+        app.router.add_get("/api/v10/channels/{channel_id}", self._get_channel)
+        app.router.add_get("/api/v10/channels/{channel_id}/messages/{message_id}", self._get_message)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self._post_message)
+        app.router.add_get("/attachments/{attachment_id}/{filename}", self._get_attachment)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = "http://127.0.0.1:{}".format(port)
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def use(self, bot: discord.Client) -> None:
+        """
+        Send the bot's HTTP requests here and log it in.  Sets the bot's user like Client.login() does, without
+        running its setup_hook.
+        """
+        discord.http.Route.BASE = "{}/api/v10".format(self.base_url)
+        data = await bot.http.static_login("stub-token")
+        bot._connection.user = discord.ClientUser(state=bot._connection, data=data)
+
+    def add_channel(self, name: str = "channel") -> int:
+        channel_id = next_id()
+        self.channels[channel_id] = {
+            "id": str(channel_id), "type": 0, "guild_id": str(self.guild_id), "name": name, "position": 0,
+            "permission_overwrites": [], "nsfw": False, "parent_id": None,
+        }
+        self.posts[channel_id] = []
+        self.post_contents[channel_id] = []
+        self.post_times[channel_id] = []
+        return channel_id
+
+    def add_message(self, channel_id: int, files: typing.Sequence[typing.Tuple[str, bytes]] = ()) -> int:
+        """
+        :param channel_id: the channel to add it to
+        :param files: (filename, data) or (filename, data, content type) of each attachment
+        :return: the message ID
+        """
+        message_id = next_id()
+        attachments = []
+        for filename, data, *content_type in files:
+            attachment_id = next_id()
+            self.files[attachment_id] = data
+            url = "{}/attachments/{}/{}".format(self.base_url, attachment_id, filename)
+            attachment = {
+                "id": str(attachment_id), "filename": filename, "size": len(data), "url": url, "proxy_url": url,
+            }
+            if content_type:
+                attachment["content_type"] = content_type[0]
+            attachments.append(attachment)
+        self.messages[message_id] = self._message(channel_id, message_id, attachments)
+        return message_id
+
+    def reaction_payload(self, channel_id: int, message_id: int, user, emoji: str = "📌") -> types.SimpleNamespace:
+        """
+        Build what on_raw_reaction_add gets for the user's reaction to one of the messages here.
+        """
+        return types.SimpleNamespace(
+            emoji=types.SimpleNamespace(name=emoji, id=None), guild_id=self.guild_id, channel_id=channel_id,
+            message_id=message_id, user_id=user.id, member=user
+        )
+
+    def _message(self, channel_id: int, message_id: int, attachments: typing.List[dict]) -> dict:
+        return {
+            "id": str(message_id), "channel_id": str(channel_id), "guild_id": str(self.guild_id), "type": 0,
+            "content": "", "author": {"id": "1", "username": "poster", "discriminator": "0001", "avatar": None},
+            "attachments": attachments, "embeds": [], "mentions": [], "mention_roles": [], "pinned": False,
+            "mention_everyone": False, "tts": False, "timestamp": datetime.datetime.utcnow().isoformat(),
+            "edited_timestamp": None, "flags": 0,
+        }
+
+    async def _respond(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _get_me(self, request: web.Request) -> web.Response:
+        await self._respond()
+        return json_response({"id": "2", "username": "PinBot", "discriminator": "0001", "avatar": None})
+
+    async def _get_user(self, request: web.Request) -> web.Response:
+        await self._respond()
+        return json_response(
+            {"id": request.match_info["user_id"], "username": "user", "discriminator": "0001", "avatar": None}
+        )
+
+    async def _get_channel(self, request: web.Request) -> web.Response:
+        await self._respond()
+        channel = self.channels.get(int(request.match_info["channel_id"]))
+        if channel is None:
+            return json_response({"message": "Unknown Channel", "code": 10003}, status=404)
+        return json_response(channel)
+
+    async def _get_message(self, request: web.Request) -> web.Response:
+        await self._respond()
+        message = self.messages.get(int(request.match_info["message_id"]))
+        if message is None:
+            return json_response({"message": "Unknown Message", "code": 10008}, status=404)
+        return json_response(message)
+
+    async def _get_attachment(self, request: web.Request) -> web.StreamResponse:
+        await self._respond()
+        attachment_id = int(request.match_info["attachment_id"])
+        data = self.files[attachment_id]
+        response = web.StreamResponse()
+        response.content_length = len(data)
+        await response.prepare(request)
+        self.bytes_served.setdefault(attachment_id, 0)
+        try:
+            for start in range(0, len(data), 64 * 1024):
+                await response.write(data[start:start + 64 * 1024])
+                self.bytes_served[attachment_id] += min(64 * 1024, len(data) - start)
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def _post_message(self, request: web.Request) -> web.Response:
+        await self._respond()
+        body = await request.read()
+        roll = random.random()
+        if roll < self.error_rate:
+            self.errors_sent += 1
+            return json_response({"message": "Internal Server Error", "code": 0}, status=500)
+        if roll < self.error_rate + self.rate_limit_rate:
+            self.rate_limits_sent += 1
+            # discord.py treats a 429 without Via as Cloudflare banning it.
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": self.retry_after, "global": False},
+                status=429, headers={"Via": "1.1 google"}
+            )
+
+        channel_id = int(request.match_info["channel_id"])
+        self.posts.setdefault(channel_id, []).append(len(body))
+        match = _CONTENT.search(body)
+        self.post_contents.setdefault(channel_id, []).append(
+            json.loads(b'"' + match.group(1) + b'"') if match else ""
+        )
+        self.post_times.setdefault(channel_id, []).append(time.perf_counter())
+        return json_response(self._message(channel_id, next_id(), []))
@@ -0,0 +1,220 @@
+# In-process stand-ins for the discord.py objects PinBot's handlers touch, so the handlers can be driven without a
+# gateway connection.  Only the attributes and methods main.py actually uses are implemented.
+import asyncio
+import contextlib
+import itertools
+import types
+import typing
+
+import discord
+
+_IDS = itertools.count(1000)
+
+
+def next_id() -> int:
+    return next(_IDS)
+
+
+def forbidden(message: str) -> discord.Forbidden:
+    """
+    What discord.py raises when Discord answers a request with a 403.
+    """
+    return discord.Forbidden(types.SimpleNamespace(status=403, reason="Forbidden"), message)
+
+
+class FakeGuild:
+    def __init__(self, name: str = "guild", filesize_limit: int = 8388608):
+        self.id = next_id()
+        self.name = name
+        self.filesize_limit = filesize_limit
+
+    async def fetch_member(self, user_id: int) -> types.SimpleNamespace:
+        return types.SimpleNamespace(id=user_id)
+
+
+class FakeUser:
+    def __init__(self, name: str = "user"):
+        self.id = next_id()
+        self.display_name = name
+        self.direct_messages: typing.List[str] = []
+        # Whether they let the bot DM them, like a member with DMs from server members turned off doesn't.
+        self.accepts_direct_messages = True
+
+    async def send(self, content: str) -> None:
+        if not self.accepts_direct_messages:
+            raise forbidden("Cannot send messages to this user")
+        self.direct_messages.append(content)
+
+
+# URL -> attachment, for FakeDownloader
+_ATTACHMENTS: typing.Dict[str, "FakeAttachment"] = {}
+
+
+class FakeAttachment:
+    def __init__(
+        self, data: bytes, filename: str = "image.png", latency: float = 0.0,
+        content_type: typing.Optional[str] = None
+    ):
+        self.id = next_id()
+        self.filename = filename
+        self.size = len(data)
+        self.content_type = content_type
+        self.url = "https://cdn.example/{}/{}".format(self.id, filename)
+        self.data = data
+        self.latency = latency
+        self.downloads = 0
+        # Bytes FakeDownloader handed out, however many downloads were stopped part way
+        self.bytes_sent = 0
+        _ATTACHMENTS[self.url] = self
+
+    def is_spoiler(self) -> bool:
+        return False
+
+    async def read(self) -> bytes:
+        self.downloads += 1
+        await asyncio.sleep(self.latency)
+        return self.data
+
+
+class FakeDownloader:
+    """
+    Stands in for attachments.Downloader, serving the fake attachments by URL.
+    """
+
+    def __init__(self, chunk_size: int = 64 * 1024):
+        self.chunk_size = chunk_size
+
+    @contextlib.asynccontextmanager
+    async def open(self, url: str) -> typing.AsyncIterator[typing.AsyncIterator[bytes]]:
+        attachment = _ATTACHMENTS[url]
+        data = await attachment.read()
+
+        async def chunks() -> typing.AsyncIterator[bytes]:
+            for start in range(0, len(data), self.chunk_size):
+                chunk = data[start:start + self.chunk_size]
+                attachment.bytes_sent += len(chunk)
+                yield chunk
+
+        yield chunks()
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeMessage:
+    def __init__(
+        self, channel: "FakeChannel", attachments: typing.Sequence[FakeAttachment] = (), embeds=(),
+        reactions: typing.Sequence[str] = ()
+    ):
+        self.id = next_id()
+        self.channel = channel
+        self.attachments = list(attachments)
+        self.embeds = list(embeds)
+        self.reactions = [types.SimpleNamespace(emoji=emoji, count=1) for emoji in reactions]
+        self.jump_url = "https://discord.com/channels/{}/{}/{}".format(channel.guild.id, channel.id, self.id)
+
+
+class FakeChannel:
+    def __init__(
+        self, guild: FakeGuild, name: str = "channel", latency: float = 0.0, nsfw: bool = False,
+        channel_id: typing.Optional[int] = None
+    ):
+        """
+        :param channel_id: the channel's ID, if it should be the same as a real (or discord_stub) channel's
+        """
+        self.id = channel_id if channel_id is not None else next_id()
+        self.guild = guild
+        self.name = name
+        self.latency = latency
+        self.nsfw = nsfw
+        self.can_send = True
+        # What send() raises instead of sending, e.g. forbidden() for a channel PinBot lost permission to post in
+        self.send_error: typing.Optional[Exception] = None
+        self.messages: typing.Dict[int, FakeMessage] = {}
+        # (content, [file bytes], embed) for every message sent here
+        self.sent: typing.List[typing.Tuple[str, typing.List[bytes], typing.Any]] = []
+        self.history_requests = 0
+        # history() raises after this many more requests, to simulate being cut off part way.
+        self.fail_history_after: typing.Optional[int] = None
+
+    def is_nsfw(self) -> bool:
+        return self.nsfw
+
+    def permissions_for(self, member) -> types.SimpleNamespace:
+        return types.SimpleNamespace(send_messages=self.can_send)
+
+    def add_message(
+        self, attachments: typing.Sequence[FakeAttachment] = (), embeds=(), reactions: typing.Sequence[str] = ()
+    ) -> FakeMessage:
+        message = FakeMessage(self, attachments, embeds, reactions)
+        self.messages[message.id] = message
+        return message
+
+    async def history(self, limit=None, after=None, oldest_first=None) -> typing.AsyncIterator[FakeMessage]:
+        """
+        Messages after the given one, oldest first, fetched 100 at a time like discord.py does.
+        """
+        after_id = after.id if after is not None else 0
+        remaining = sorted(message_id for message_id in self.messages if message_id > after_id)
+        for start in range(0, len(remaining), 100):
+            if self.fail_history_after is not None:
+                if self.fail_history_after == 0:
+                    raise ConnectionResetError("history cut off")
+                self.fail_history_after -= 1
+            self.history_requests += 1
+            await asyncio.sleep(self.latency)
+            for message_id in remaining[start:start + 100]:
+                yield self.messages[message_id]
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        return self.messages[message_id]
+
+    async def send(self, content: str, files=None, embed=None) -> None:
+        await asyncio.sleep(self.latency)
+        if self.send_error is not None:
+            raise self.send_error
+        self.sent.append((content, [file.fp.read() for file in files or ()], embed))
+        for file in files or ():
+            file.close()
+
+
+class FakeContext:
+    """
+    What a command gets as ctx when the author runs it in the channel.  Replies are kept in replies.
+    """
+
+    def __init__(self, channel: FakeChannel, author: FakeUser):
+        self.message = types.SimpleNamespace(channel=channel, author=author)
+        self.author = author
+        self.replies: typing.List[str] = []
+
+    async def send(self, content: str) -> None:
+        self.replies.append(content)
+
+
+def reaction_payload(message: FakeMessage, user: FakeUser, emoji: str = "📌") -> types.SimpleNamespace:
+    """
+    Build what on_raw_reaction_add gets for a reaction to the message.
+    """
+    return types.SimpleNamespace(
+        emoji=types.SimpleNamespace(name=emoji, id=None),
+        channel_id=message.channel.id,
+        message_id=message.id,
+        guild_id=message.channel.guild.id,
+        user_id=user.id,
+        member=user,
+    )
+
+
+def install(bot, channels: typing.Iterable[FakeChannel]) -> None:
+    """
+    Point the bot's channel lookups at the fake channels.
+    """
+    by_id = {channel.id: channel for channel in channels}
+
+    async def fetch_channel(channel_id: int) -> FakeChannel:
+        return by_id[channel_id]
+
+    bot.get_channel = by_id.get
+    bot.fetch_channel = fetch_channel
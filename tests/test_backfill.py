@@ -0,0 +1,55 @@
+from tests import fakes
+
+MESSAGES = 2000
+PINNED_EVERY = 10
+
+
+def test_backfill_resumes_and_pins_once(pinbot, run, connect, monkeypatch):
+    # A long history, some of it already pinned, backfilled with the first run cut off part way.  The second run
+    # resumes from the checkpoint (rescanning nothing), and every message with a 📌 ends up pinned exactly once per pin
+    # channel, including one connected after the backfill finished.
+    monkeypatch.setattr(pinbot.SETTINGS, "backfill_pins_per_second", 1000)
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source")
+    pin_channels = [fakes.FakeChannel(guild, "pins-{}".format(index)) for index in range(2)]
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels])
+    user = fakes.FakeUser()
+    connect(source_channel.id, [pin_channel.id for pin_channel in pin_channels], user.id)
+    run(pinbot.setup_hook())
+
+    to_pin = []
+    for index in range(MESSAGES):
+        attachment = fakes.FakeAttachment(b"x" * 100, "image-{}.png".format(index))
+        if index % PINNED_EVERY == 0:
+            to_pin.append(source_channel.add_message([attachment], reactions=["👍", "📌"]))
+        else:
+            source_channel.add_message([attachment], reactions=["👍"] if index % 3 else [])
+
+    # Pinned live before the backfill, so it should be skipped.
+    run(pinbot.on_raw_reaction_add(fakes.reaction_payload(to_pin[0], user)))
+    run(pinbot.PIN_JOBS.drain())
+
+    context = fakes.FakeContext(source_channel, user)
+    source_channel.fail_history_after = MESSAGES // 100 // 2
+    try:
+        run(pinbot.backfill.callback(context))
+    except ConnectionResetError:
+        pass
+    source_channel.fail_history_after = None
+    run(pinbot.backfill.callback(context))
+    run(pinbot.PIN_JOBS.drain())
+
+    checkpoint = run(pinbot.DATABASE.get_backfill_checkpoint(source_channel.id))
+    assert checkpoint[2] == MESSAGES
+    assert checkpoint[5] is not None
+    assert source_channel.history_requests == -(-MESSAGES // 100)
+    assert [len(pin_channel.sent) for pin_channel in pin_channels] == [len(to_pin)] * len(pin_channels)
+
+    late_channel = fakes.FakeChannel(guild, "pins-late")
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels, late_channel])
+    connect(source_channel.id, [late_channel.id], user.id)
+    run(pinbot.backfill.callback(context))
+    run(pinbot.PIN_JOBS.drain())
+
+    assert len(late_channel.sent) == len(to_pin)
+    assert [len(pin_channel.sent) for pin_channel in pin_channels] == [len(to_pin)] * len(pin_channels)
@@ -0,0 +1,32 @@
+import pytest
+
+from utils import config
+
+
+def load_settings():
+    # Not the cached one, so each test reads its own environment.
+    return config.load_settings.__wrapped__()
+
+
+def test_environment_overrides(monkeypatch):
+    monkeypatch.setenv("PINBOT_PIN_WORKERS", "16")
+    monkeypatch.setenv("PINBOT_DATABASE_PATH", "1")
+    settings = load_settings()
+    assert settings.pin_workers == 16
+    assert settings.database_path == "1"
+
+
+def test_shard_ids_need_shard_count(monkeypatch):
+    monkeypatch.setenv("PINBOT_SHARD_IDS", "[0]")
+    with pytest.raises(ValueError, match="shard_count"):
+        load_settings()
+
+    monkeypatch.setenv("PINBOT_SHARD_COUNT", "2")
+    assert load_settings().shard_ids == [0]
+
+
+@pytest.mark.parametrize("rate", ["0", "-1"])
+def test_backfill_rate_positive(monkeypatch, rate):
+    monkeypatch.setenv("PINBOT_BACKFILL_PINS_PER_SECOND", rate)
+    with pytest.raises(ValueError, match="backfill_pins_per_second"):
+        load_settings()
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import time
+import uuid
+
+from utils import db
+from utils import migrations
+
+PROCESSES = 4
+WRITES = 500
+
+
+def guild_on_shard(shard_id: int, shard_count: int, index: int) -> int:
+    # Guild IDs are snowflakes, the shard comes from the timestamp bits.
+    return ((index * shard_count + shard_id) << 22) | index
+
+
+async def write(database: db.Database, shard_id: int, shard_count: int, channel_key: str, writes: int) -> None:
+    await asyncio.gather(*(
+        database.add_pin_job(guild_on_shard(shard_id, shard_count, index), shard_id, index, 1, time.time())
+        for index in range(writes)
+    ))
+    await asyncio.gather(*(
+        database.record_pins(attachment_pins=[(shard_id * writes + index + 1, channel_key)])
+        for index in range(writes)
+    ))
+
+
+def worker(
+    database_path: str, shard_id: int, shard_count: int, channel_key: str, writes: int, barrier, results
+) -> None:
+    database = db.Database(database_path)
+    try:
+        # Everyone opens (and so tries to migrate) the fresh DB at once.
+        barrier.wait()
+        database.open()
+        # Then waits for the connection the pins belong to.
+        barrier.wait()
+        barrier.wait()
+        asyncio.run(write(database, shard_id, shard_count, channel_key, writes))
+        replayed = asyncio.run(database.get_pin_jobs(shard_count, [shard_id]))
+        results.put((shard_id, None, len(replayed)))
+    except Exception as exception:
+        results.put((shard_id, repr(exception), 0))
+    finally:
+        database.close()
+
+
+def test_processes_share_database(tmp_path):
+    # Several processes open one fresh DB at the same moment, the way a bot split across processes by shard would, then
+    # write pins and pin jobs as fast as they can.  Nobody hits a locking error, every write lands, and each process
+    # only replays the jobs of its own shards.
+    database_path = str(tmp_path.joinpath("pinbot.db"))
+    channel_key = str(uuid.uuid4())
+    barrier = multiprocessing.Barrier(PROCESSES + 1)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(database_path, shard_id, PROCESSES, channel_key, WRITES, barrier, results)
+        )
+        for shard_id in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+
+    barrier.wait()
+    barrier.wait()
+    connection = migrations.connect(database_path)
+    with connection:
+        connection.execute(
+            "INSERT INTO channel_connections(channel_key,source_channel,pin_channel,registering_user) VALUES(?,1,2,1)",
+            (channel_key,)
+        )
+    connection.close()
+    barrier.wait()
+
+    outcomes = sorted(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join()
+
+    connection = migrations.connect(database_path)
+    try:
+        jobs = connection.execute("SELECT COUNT(*) FROM pin_jobs").fetchone()[0]
+        pins = connection.execute("SELECT COUNT(*) FROM pinned_attachments").fetchone()[0]
+        version = migrations.get_schema_version(connection)
+    finally:
+        connection.close()
+
+    assert outcomes == [(shard_id, None, WRITES) for shard_id in range(PROCESSES)]
+    assert version == migrations.LATEST_VERSION
+    assert jobs == pins == PROCESSES * WRITES
+
+
+def test_many_attachments_looked_up(tmp_path, run):
+    # More attachments than SQLite takes parameters in one statement (999 before 3.32) are still all looked up.
+    database = db.Database(str(tmp_path.joinpath("pinbot.db")))
+    database.open()
+    try:
+        channel_keys = [str(uuid.uuid4()) for _ in range(3)]
+        for index, channel_key in enumerate(channel_keys):
+            run(database.add_connection(channel_key, 1, 1))
+            run(database.set_pin_channel(channel_key, 10 + index))
+        pinned = [(attachment_id, channel_keys[attachment_id % 3]) for attachment_id in range(1, 2000, 97)]
+        run(database.record_pins(attachment_pins=pinned))
+        found = run(database.get_pinned_attachments(list(range(1, 2001)), channel_keys))
+    finally:
+        database.close()
+
+    assert found == set(pinned)
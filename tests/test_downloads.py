@@ -0,0 +1,92 @@
+import io
+import os
+import struct
+import threading
+import typing
+import zlib
+
+import pytest
+from PIL import Image
+
+from tests import fakes
+from utils import image
+
+MB = 1000000
+
+
+def png_header(width: int, height: int, size: int) -> bytes:
+    # A PNG that claims to be width x height, its image data noise.
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    start = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    return start + chunk(b"IDAT", os.urandom(size - len(start) - 12))
+
+
+def noisy_jpeg() -> bytes:
+    noise = Image.frombytes("RGB", (1000, 750), os.urandom(1000 * 750 * 3)).resize((4000, 3000))
+    buffer = io.BytesIO()
+    noise.save(buffer, format="JPEG", quality=100)
+    return buffer.getvalue()
+
+
+# name -> (filename, what makes the data, content type, whether it should be uploaded rather than linked)
+CASES: typing.Dict[str, typing.Tuple[str, typing.Callable[[], bytes], typing.Optional[str], bool]] = {
+    "small image": ("small.png", lambda: png_header(10, 10, 1000), "image/png", True),
+    "oversized photo": ("photo.jpg", noisy_jpeg, "image/jpeg", True),
+    "video": ("clip.mp4", lambda: os.urandom(20 * MB), "video/mp4", False),
+    "too big to download": ("poster.png", lambda: os.urandom(80 * MB), "image/png", False),
+    "too many pixels": ("panorama.png", lambda: png_header(40000, 30000, 60 * MB), "image/png", False),
+    "not really an image": ("fake.png", lambda: os.urandom(60 * MB), None, False),
+}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_attachment_uploaded_or_linked(pinbot, run, connect, stub, monkeypatch, name):
+    # Attachments that can't all be uploaded as they are, pinned through the real download session.  Each one is
+    # uploaded or linked as it should be, and the ones that get linked are downloaded only as far as it takes to tell.
+    filename, make_data, content_type, uploaded = CASES[name]
+    data = make_data()
+    monkeypatch.setattr(pinbot.SETTINGS, "max_resize_download", 64 * MB)
+    user = fakes.FakeUser()
+    source_channel = stub.add_channel("source")
+    pin_channel = stub.add_channel("pins")
+    connect(source_channel, [pin_channel], user.id)
+    run(pinbot.setup_hook())
+
+    message_id = stub.add_message(source_channel, [(filename, data, content_type)])
+    attachment_id = int(stub.messages[message_id]["attachments"][0]["id"])
+    run(pinbot.on_raw_reaction_add(stub.reaction_payload(source_channel, message_id, user)))
+    run(pinbot.PIN_JOBS.drain())
+
+    content = stub.post_contents[pin_channel][-1]
+    linked = "/attachments/{}/".format(attachment_id) in content
+    assert linked != uploaded
+    assert (stub.posts[pin_channel][-1] > len(content) + 1000) == uploaded
+    if not uploaded:
+        # The socket buffers take a few MB the client never reads, so count anything under a fifth of the file.
+        assert stub.bytes_served.get(attachment_id, 0) < len(data) / 5
+
+
+def test_header_checked_off_event_loop(pinbot, run, connect, stub, monkeypatch):
+    # Telling from its header whether an oversized image can be resized (and importing PIL to do it the first time)
+    # doesn't hold up the event loop.
+    threads = []
+    can_shrink = image.can_shrink
+
+    def recording_can_shrink(header: bytes) -> bool:
+        threads.append(threading.get_ident())
+        return can_shrink(header)
+
+    monkeypatch.setattr(image, "can_shrink", recording_can_shrink)
+    user = fakes.FakeUser()
+    source_channel = stub.add_channel("source")
+    pin_channel = stub.add_channel("pins")
+    connect(source_channel, [pin_channel], user.id)
+    run(pinbot.setup_hook())
+
+    message_id = stub.add_message(source_channel, [("panorama.png", png_header(40000, 30000, 60 * MB), "image/png")])
+    run(pinbot.on_raw_reaction_add(stub.reaction_payload(source_channel, message_id, user)))
+    run(pinbot.PIN_JOBS.drain())
+
+    assert len(threads) == 1 and threads[0] != threading.get_ident()
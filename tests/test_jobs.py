@@ -0,0 +1,33 @@
+import asyncio
+
+from tests import fakes
+
+MESSAGES = 200
+
+
+def test_unfinished_jobs_replayed(pinbot, run, connect, stub):
+    # Jobs left over when the workers are stopped part way are replayed by the next start, and every message ends up
+    # posted exactly once per pin channel.
+    stub.latency = 0.02
+    user = fakes.FakeUser()
+    source_channel = stub.add_channel("source")
+    pin_channels = [stub.add_channel("pins-{}".format(index)) for index in range(2)]
+    connect(source_channel, pin_channels, user.id)
+    message_ids = [
+        stub.add_message(source_channel, [("image-{}.png".format(index), b"x" * 50000)]) for index in range(MESSAGES)
+    ]
+    run(pinbot.setup_hook())
+    for message_id in message_ids:
+        run(pinbot.on_raw_reaction_add(stub.reaction_payload(source_channel, message_id, user)))
+
+    # "Crash" once the jobs are written but before most of them have run.
+    run(asyncio.gather(*pinbot.PIN_JOBS._adding))
+    run(pinbot.PIN_JOBS.stop())
+    assert run(pinbot.DATABASE.get_pin_jobs())
+
+    run(pinbot.setup_hook())
+    run(pinbot.PIN_JOBS.drain())
+    run(pinbot.PIN_JOBS.stop())
+
+    assert not run(pinbot.DATABASE.get_pin_jobs())
+    assert [len(stub.posts[pin_channel]) for pin_channel in pin_channels] == [MESSAGES] * len(pin_channels)
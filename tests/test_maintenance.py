@@ -0,0 +1,141 @@
+import random
+import sqlite3
+import time
+import typing
+import uuid
+
+from utils import db
+from utils import maintenance
+from utils import migrations
+
+DAY = 24 * 60 * 60
+CONNECTIONS = 20
+PINS = 20000
+# Connections deleted with foreign keys off
+ORPHANED = 5
+ARCHIVE_AFTER_DAYS = 90
+
+
+def build(database_path: str) -> typing.Dict[str, typing.Any]:
+    """
+    Build a DB the way an older PinBot would have left it: no incremental auto vacuum, pins left behind by connections
+    deleted while foreign keys were off, checkpoints and jobs of channels that aren't a source anymore, years of pins.
+
+    :return: what the DB was built with, for checking what maintenance does to it
+    """
+    generator = random.Random(0)
+    # Not migrations.connect(), which would turn on incremental auto vacuum for the new DB.
+    connection = sqlite3.connect(database_path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    migrations.migrate(connection)
+
+    now = time.time()
+    keys = [str(uuid.uuid4()) for _ in range(CONNECTIONS)]
+    connection.executemany(
+        "INSERT INTO channel_connections(channel_key,source_channel,pin_channel,registering_user) VALUES(?,?,?,1)",
+        [(key, 100 + index, 1000 + index) for index, key in enumerate(keys)]
+    )
+    attachment_pins = []
+    for key in keys:
+        # Pins spread over the last two years
+        timestamps = sorted(now - generator.random() * 730 * DAY for _ in range(PINS // CONNECTIONS))
+        attachment_pins += [
+            (maintenance.snowflake_at(timestamp) + generator.randrange(1 << 22), key) for timestamp in timestamps
+        ]
+    connection.executemany("INSERT OR IGNORE INTO pinned_attachments(attachment_id,channel_key) VALUES(?,?)",
+                           attachment_pins)
+    connection.executemany(
+        "INSERT INTO pinned_embeds(embed_url,channel_key) VALUES(?,?)",
+        [("https://example.com/{}".format(attachment_id), key) for attachment_id, key in attachment_pins[::10]]
+    )
+    connection.executemany(
+        "INSERT INTO pinned_content(content_hash,pin_channel,channel_key) VALUES(?,?,?)",
+        [("{:064x}".format(attachment_id), 1000 + keys.index(key), key) for attachment_id, key in attachment_pins]
+    )
+    # The last source keeps its connection, so its checkpoint and old job should stay.  Source 99 was never connected,
+    # its checkpoint and old job should go, its new job should stay.
+    connected = 100 + CONNECTIONS - 1
+    connection.executemany(
+        "INSERT INTO backfill_checkpoints(source_channel,last_message_id,updated_at) VALUES(?,1,?)",
+        [(connected, now), (99, now)]
+    )
+    connection.executemany(
+        "INSERT INTO pin_jobs(source_channel,message_id,user_id,created_at,next_attempt_at) VALUES(?,?,1,?,?)",
+        [(connected, 1, now - 30 * DAY, now), (99, 2, now - 30 * DAY, now), (99, 3, now, now)]
+    )
+    connection.commit()
+
+    # Delete connections the way older versions could, with foreign keys off, leaving their pins behind.
+    orphaned_keys = keys[:ORPHANED]
+    connection.execute("PRAGMA foreign_keys = OFF")
+    connection.executemany("DELETE FROM channel_connections WHERE channel_key=?", [(key,) for key in orphaned_keys])
+    connection.commit()
+    connection.close()
+
+    kept = [pin for pin in attachment_pins if pin[1] not in orphaned_keys]
+    return {
+        "keys": keys[ORPHANED:],
+        "kept": kept,
+        "orphaned_pins": len(attachment_pins) - len(kept),
+        "orphaned_embeds": sum(1 for _, key in attachment_pins[::10] if key in orphaned_keys),
+    }
+
+
+async def lookup(
+    database: db.Database, pins: typing.Sequence[typing.Tuple[int, str]], keys: typing.Sequence[str]
+) -> typing.Set[typing.Tuple[int, str]]:
+    """
+    Look every pin up the way a pin of each message does, plus an attachment that was never pinned each time.
+    """
+    found = set()
+    for attachment_id, key in pins:
+        found |= await database.get_pinned_attachments([attachment_id, attachment_id + 1], keys[:2] + [key])
+    return found
+
+
+def test_maintenance_of_old_database(tmp_path, run, monkeypatch):
+    # Maintenance on an old, overgrown DB, then rebuilding it the way --vacuum does and maintaining it twice more, the
+    # last time after deleting a connection.  The orphans go and nothing else, old pins are archived in bounded chunks
+    # but still count as pinned, maintenance never rebuilds the DB itself, and the file shrinks.
+    # Small chunks, to get several per connection.
+    monkeypatch.setattr(db, "ARCHIVE_CHUNK_SIZE", 256)
+    database_path = str(tmp_path.joinpath("pinbot.db"))
+    built = build(database_path)
+    database = db.Database(database_path)
+    database.open()
+    try:
+        sample = random.Random(1).sample(built["kept"], 2000)
+        before = run(database.get_stats())
+        found_before = run(lookup(database, sample, built["keys"]))
+
+        first = run(maintenance.run(database, ARCHIVE_AFTER_DAYS))
+        chunks, biggest_chunk = run(database._read(lambda connection: connection.execute(
+            "SELECT COUNT(*), MAX(attachment_count) FROM pinned_attachments_archive"
+        ).fetchone()))
+        rebuilt = database.enable_incremental_vacuum()
+        rebuilt_again = database.enable_incremental_vacuum()
+        second = run(maintenance.run(database, ARCHIVE_AFTER_DAYS))
+        found_after = run(lookup(database, sample, built["keys"]))
+        run(database.delete_connection(built["keys"][0]))
+        third = run(maintenance.run(database, ARCHIVE_AFTER_DAYS))
+    finally:
+        database.close()
+
+    assert first.pruned["pinned_attachments"] == built["orphaned_pins"]
+    assert first.pruned["pinned_embeds"] == built["orphaned_embeds"]
+    assert first.pruned["pinned_content"] == built["orphaned_pins"]
+    assert first.pruned["backfill_checkpoints"] == 1
+    assert first.pruned["pin_jobs"] == 1
+
+    cutoff = maintenance.snowflake_at(time.time() - ARCHIVE_AFTER_DAYS * DAY)
+    expected_archived = sum(1 for attachment_id, _ in built["kept"] if attachment_id < cutoff)
+    assert first.archived == expected_archived == first.stats.archived_attachments
+    assert biggest_chunk <= db.ARCHIVE_CHUNK_SIZE and chunks > len(built["keys"])
+    assert first.stats.pinned_attachments + first.stats.archived_attachments == len(built["kept"])
+    assert found_after == found_before == set(sample)
+
+    assert first.stats.auto_vacuum == 0
+    assert rebuilt and not rebuilt_again and second.stats.auto_vacuum == 2
+    assert second.stats.file_bytes + second.stats.wal_bytes < before.file_bytes + before.wal_bytes
+    assert not sum(second.pruned.values()) and not second.archived
+    assert third.reclaimed_bytes > 0
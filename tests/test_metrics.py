@@ -0,0 +1,71 @@
+import asyncio
+import socket
+import types
+
+import aiohttp
+
+from tests import fakes
+
+MESSAGES = 20
+
+
+def free_port() -> int:
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+def test_pins_show_up_in_metrics(pinbot, run, connect, monkeypatch):
+    # A few pins (one with nothing to pin, one pinned twice, one reaction outside a source channel) show up in /metrics
+    # and !pinstats.
+    port = free_port()
+    monkeypatch.setattr(pinbot.SETTINGS, "metrics_port", port)
+    monkeypatch.setattr(pinbot.SETTINGS, "event_loop_lag_interval", 0.05)
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source", latency=0.01)
+    pin_channels = [fakes.FakeChannel(guild, "pins-{}".format(index), latency=0.02) for index in range(2)]
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels])
+    user = fakes.FakeUser()
+    connect(source_channel.id, [pin_channel.id for pin_channel in pin_channels], user.id)
+    run(pinbot.setup_hook())
+
+    messages = [
+        source_channel.add_message([fakes.FakeAttachment(b"x" * 1000, "image-{}.png".format(index), latency=0.01)])
+        for index in range(MESSAGES)
+    ]
+    for message in [*messages, source_channel.add_message([]), messages[0]]:
+        run(pinbot.on_raw_reaction_add(fakes.reaction_payload(message, user)))
+        run(pinbot.PIN_JOBS.drain())
+    run(pinbot.on_raw_reaction_add(fakes.reaction_payload(pin_channels[0].add_message([]), user)))
+    run(asyncio.sleep(0.2))
+
+    async def scrape() -> str:
+        async with aiohttp.ClientSession() as session:
+            async with session.get("http://127.0.0.1:{}/metrics".format(port)) as response:
+                return await response.text()
+
+    scraped = run(scrape())
+    replies = []
+
+    async def send(content: str) -> None:
+        replies.append(content)
+
+    run(pinbot.pinstats.callback(types.SimpleNamespace(send=send)))
+
+    posts = MESSAGES * len(pin_channels)
+    for line in [
+        'pinbot_pins_total{{outcome="posted"}} {}'.format(posts),
+        'pinbot_pins_total{{outcome="duplicate"}} {}'.format(len(pin_channels)),
+        'pinbot_pins_total{outcome="skipped"} 1',
+        'pinbot_pin_latency_seconds_count {}'.format(posts),
+        'pinbot_send_seconds_count {}'.format(posts),
+        'pinbot_attachment_download_seconds_count {}'.format(MESSAGES),
+        'pinbot_db_query_seconds_count{query="record_pins"}',
+        'pinbot_pin_jobs_total{{outcome="completed"}} {}'.format(MESSAGES + 2),
+        'pinbot_pin_jobs_in_flight 0',
+        'pinbot_route_lookups_total{{result="hit"}} {}'.format(MESSAGES + 2),
+        'pinbot_route_lookups_total{result="miss"} 1',
+        'pinbot_event_loop_lag_seconds ',
+    ]:
+        assert line in scraped
+    assert "Pins: {} posted, {} duplicate".format(posts, len(pin_channels)) in replies[0]
@@ -0,0 +1,127 @@
+import asyncio
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from tests import fakes
+from utils import content
+from utils import image
+from utils import metrics
+
+
+def oversized_png() -> bytes:
+    # Noise doesn't compress, so this comes out around 9MB.
+    noise = Image.frombytes("RGB", (1800, 1700), os.urandom(1800 * 1700 * 3))
+    buffer = io.BytesIO()
+    noise.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_concurrent_pins_post_once(pinbot, run, connect):
+    # A burst of simultaneous pins of one message gets it downloaded once and posted once to every pin channel.  Called
+    # on pin_message directly: reactions would already be collapsed into one job by the pin job queue.
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source", latency=0.01)
+    pin_channels = [fakes.FakeChannel(guild, "pins-{}".format(index), latency=0.05) for index in range(3)]
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels])
+    users = [fakes.FakeUser("user-{}".format(index)) for index in range(50)]
+    connect(source_channel.id, [pin_channel.id for pin_channel in pin_channels], users[0].id)
+    run(pinbot.setup_hook())
+
+    attachments = [fakes.FakeAttachment(b"x" * 1000, "image-{}.png".format(index), latency=0.05) for index in range(3)]
+    message = source_channel.add_message(attachments)
+    routes = pinbot.ROUTES.get(source_channel.id)
+    run(asyncio.gather(*(pinbot.pin_message(message, user, routes) for user in users)))
+
+    assert [len(pin_channel.sent) for pin_channel in pin_channels] == [1, 1, 1]
+    assert [attachment.downloads for attachment in attachments] == [1, 1, 1]
+
+
+def test_closed_direct_messages_not_retried(pinbot, run, connect):
+    # A message with nothing to pin gets its pinner a DM saying so, and a pinner who doesn't take DMs doesn't get the
+    # pin job retried over it.
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source")
+    pin_channel = fakes.FakeChannel(guild, "pins")
+    fakes.install(pinbot.BOT, [source_channel, pin_channel])
+    user = fakes.FakeUser()
+    closed_user = fakes.FakeUser("closed")
+    closed_user.accepts_direct_messages = False
+    connect(source_channel.id, [pin_channel.id], user.id)
+    run(pinbot.setup_hook())
+
+    for pinner in (user, closed_user):
+        run(pinbot.on_raw_reaction_add(fakes.reaction_payload(source_channel.add_message([]), pinner)))
+        run(pinbot.PIN_JOBS.drain())
+
+    assert user.direct_messages == ["Cannot pin message without media to pin."]
+    assert (pinbot.PIN_JOBS.completed, pinbot.PIN_JOBS.retried, pinbot.PIN_JOBS.failed) == (2, 0, 0)
+    assert not pin_channel.sent
+
+
+def test_forbidden_pin_channel_not_retried(pinbot, run, connect):
+    # A pin channel PinBot can't post in anymore fails its pins for good, without holding up the other pin channels or
+    # getting the pin job retried.
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source")
+    pin_channels = [fakes.FakeChannel(guild, "pins-{}".format(index)) for index in range(2)]
+    pin_channels[0].send_error = fakes.forbidden("Missing Permissions")
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels])
+    user = fakes.FakeUser()
+    connect(source_channel.id, [pin_channel.id for pin_channel in pin_channels], user.id)
+    run(pinbot.setup_hook())
+
+    message = source_channel.add_message([fakes.FakeAttachment(b"x" * 1000)])
+    run(pinbot.on_raw_reaction_add(fakes.reaction_payload(message, user)))
+    run(pinbot.PIN_JOBS.drain())
+
+    assert [len(pin_channel.sent) for pin_channel in pin_channels] == [0, 1]
+    assert (pinbot.PIN_JOBS.completed, pinbot.PIN_JOBS.retried, pinbot.PIN_JOBS.failed) == (1, 0, 0)
+    assert metrics.PINS.get("failed") == 1
+
+
+@pytest.mark.parametrize("suppress", [False, True])
+def test_reposts_resized_once(pinbot, run, connect, monkeypatch, tmp_path, suppress):
+    # The same oversized image pinned from several messages (reposts, and the same image in another source channel) is
+    # resized once, and with suppress_duplicate_content on, only posted to the pin channel once.
+    monkeypatch.setattr(pinbot.SETTINGS, "suppress_duplicate_content", suppress)
+    monkeypatch.setattr(pinbot, "RESIZE_CACHE", content.ResizeCache(tmp_path.joinpath("cache"), 1000000000))
+    pinbot.RESIZE_CACHE.load()
+    resizes = []
+    resize_in_pool = image.resize_in_pool
+
+    async def counting_resize(data: bytes, size_limit: int) -> image.ResizeResult:
+        resizes.append(size_limit)
+        return await resize_in_pool(data, size_limit)
+
+    monkeypatch.setattr(image, "resize_in_pool", counting_resize)
+
+    guild = fakes.FakeGuild()
+    source_channels = [fakes.FakeChannel(guild, "source-{}".format(index)) for index in range(2)]
+    pin_channel = fakes.FakeChannel(guild, "pins")
+    fakes.install(pinbot.BOT, [*source_channels, pin_channel])
+    user = fakes.FakeUser()
+    for source_channel in source_channels:
+        connect(source_channel.id, [pin_channel.id], user.id)
+    run(pinbot.setup_hook())
+
+    data = oversized_png()
+    messages = [
+        source_channels[index % len(source_channels)].add_message([fakes.FakeAttachment(data, "meme.png")])
+        for index in range(4)
+    ]
+    # Suppression is best effort for reposts pinned at the same instant, so only pin those without it.  They also
+    # check concurrent resizes of the same image are coalesced.
+    concurrent = 1 if suppress else 2
+    run(asyncio.gather(
+        *(pinbot.on_raw_reaction_add(fakes.reaction_payload(message, user)) for message in messages[:concurrent])
+    ))
+    run(pinbot.PIN_JOBS.drain())
+    for message in messages[concurrent:]:
+        run(pinbot.on_raw_reaction_add(fakes.reaction_payload(message, user)))
+        run(pinbot.PIN_JOBS.drain())
+
+    assert len(resizes) == 1
+    assert len(pin_channel.sent) == (1 if suppress else len(messages))
@@ -0,0 +1,72 @@
+import asyncio
+
+from tests import fakes
+from utils import routing
+
+
+def test_write_through_outlives_older_rows():
+    routes = routing.RoutingTable()
+    routes.load([("a", 1, 10), ("b", 2, None)])
+    assert routes.get(1) == (("a", 10),) and routes.get(2) == () and 2 not in routes
+
+    # Read before "b" was completed and "c" added in this process, so those are kept.
+    writes = routes.writes
+    routes.set_pin_channel("b", 20)
+    routes.add("c", 3, 30)
+    routes.load([("a", 1, 11), ("b", 2, None)], writes)
+    assert routes.peek(1) == (("a", 11),)
+    assert routes.peek(2) == (("b", 20),)
+    assert routes.peek(3) == (("c", 30),)
+    assert routes.load_source(3, [], writes) == (("c", 30),)
+
+    # Read after, so they replace them.
+    writes = routes.writes
+    assert routes.load_source(3, [("d", 3, 31)], writes) == (("d", 31),)
+    routes.remove("c")
+    assert routes.peek(3) == (("d", 31),)
+    assert (routes.hits, routes.misses) == (1, 1)
+
+
+def test_age():
+    routes = routing.RoutingTable()
+    assert routes.age(1) == float("inf")
+    routes.load_source(1, [("a", 1, 10)])
+    assert routes.age(1) < 1 and routes.age(2) == float("inf")
+    routes.load([])
+    assert routes.age(2) < 1
+
+
+def test_pins_reread_routes_only_when_out_of_date(pinbot, run, connect, monkeypatch):
+    # A pin doesn't ask the DB where to go while ROUTES is newer than route_refresh_interval, and does once it isn't,
+    # e.g. to stop pinning to a connection another process deleted.
+    guild = fakes.FakeGuild()
+    source_channel = fakes.FakeChannel(guild, "source")
+    pin_channels = [fakes.FakeChannel(guild, "pins-{}".format(index)) for index in range(2)]
+    fakes.install(pinbot.BOT, [source_channel, *pin_channels])
+    user = fakes.FakeUser()
+    channel_keys = connect(source_channel.id, [pin_channel.id for pin_channel in pin_channels], user.id)
+    monkeypatch.setattr(pinbot.SETTINGS, "route_refresh_interval", 60)
+    run(pinbot.setup_hook())
+    reads = []
+    load_source_connections = pinbot.DATABASE.load_source_connections
+
+    async def counting_load(source_channel_id: int):
+        reads.append(source_channel_id)
+        return await load_source_connections(source_channel_id)
+
+    monkeypatch.setattr(pinbot.DATABASE, "load_source_connections", counting_load)
+    # Deleted by "another process", so only in the DB.
+    run(pinbot.DATABASE.delete_connection(channel_keys[0]))
+
+    def pin() -> None:
+        message = source_channel.add_message([fakes.FakeAttachment(b"x" * 100)])
+        run(pinbot.on_raw_reaction_add(fakes.reaction_payload(message, user)))
+        run(pinbot.PIN_JOBS.drain())
+
+    pin()
+    assert reads == [] and [len(pin_channel.sent) for pin_channel in pin_channels] == [1, 1]
+    monkeypatch.setattr(pinbot.SETTINGS, "route_refresh_interval", 0.01)
+    run(asyncio.sleep(0.02))
+    pin()
+    pin()
+    assert reads == [source_channel.id] and [len(pin_channel.sent) for pin_channel in pin_channels] == [1, 3]
@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import io
+import pathlib
+import tempfile
+import typing
+
+import aiohttp
+import discord
+
+from utils import content
+
+
+# Bytes handed to a fetch's header check, enough for the dimensions of any image format PIL reads.
+HEADER_SIZE = 256 * 1024
+
+
+class DownloadRejected(Exception):
+    """
+    A download was stopped part way, because it went over its byte cap or its header check turned it down.
+    """
+
+
+class Downloader:
+    """
+    Streams files over one pooled HTTP session, so downloads from Discord's CDN reuse connections (and their TLS
+    handshakes) across pins, and nothing has to hold a whole file to look at the start of it.
+
+    The session is made on first use, so it belongs to the loop the bot runs on.  Close it on shutdown.
+    """
+
+    def __init__(self, connections: int = 16, chunk_size: int = 64 * 1024, read_timeout: float = 30.0):
+        """
+        :param connections: most connections open at once, across all hosts
+        :param chunk_size: bytes per chunk streamed
+        :param read_timeout: seconds a download may go without receiving anything before it fails
+        """
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.read_timeout = read_timeout
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=self.read_timeout)
+            )
+        return self._session
+
+    @contextlib.asynccontextmanager
+    async def open(self, url: str) -> typing.AsyncIterator[typing.AsyncIterator[bytes]]:
+        """
+        Start downloading a file.  Leaving the context early drops the rest of it.
+
+        :param url: the file's URL
+        :return: the file's chunks
+        :raises aiohttp.ClientResponseError: if the response isn't a success
+        """
+        async with self._get_session().get(url) as response:
+            response.raise_for_status()
+            yield response.content.iter_chunked(self.chunk_size)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class StoredAttachment:
+    """
+    An attachment's bytes, either held in memory or spilled to a file in the request's temp directory.
+    A new discord.File can be made from it as many times as needed, since sending a file closes it.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        data: typing.Optional[bytes] = None,
+        path: typing.Optional[pathlib.Path] = None,
+        spoiler: bool = False,
+        content_hash: typing.Optional[str] = None
+    ):
+        self.filename = filename
+        self.spoiler = spoiler
+        # Hash of the attachment as it was posted.  A resized attachment keeps the hash of the original it was made
+        # from, so reposts of the same image match however it ended up being uploaded.
+        self.content_hash = content_hash
+        self._data = data
+        self._path = path
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return self._path.stat().st_size
+
+    def read(self) -> bytes:
+        if self._data is not None:
+            return self._data
+        return self._path.read_bytes()
+
+    def open(self) -> typing.BinaryIO:
+        if self._data is not None:
+            # BytesIO shares the underlying bytes object until it's written to, so this doesn't copy.
+            return io.BytesIO(self._data)
+        return self._path.open("rb")
+
+    def to_file(self) -> discord.File:
+        return discord.File(self.open(), filename=self.filename, spoiler=self.spoiler)
+
+
+class AttachmentStore:
+    """
+    Holds the attachments for a single pin request.  Attachments are kept in memory until memory_limit bytes are in
+    use, anything past that is written to a temp directory that belongs to this request alone, so concurrent pins of
+    files with the same name can't clobber each other.  The temp directory (if one was needed) is removed on close.
+
+    Use as a context manager:
+        with AttachmentStore(memory_limit, downloader) as store:
+            stored = await store.fetch(attachment)
+    """
+
+    def __init__(self, memory_limit: int, downloader: Downloader):
+        self.memory_limit = memory_limit
+        self.downloader = downloader
+        self.memory_used = 0
+        self._temp_directory: typing.Optional[tempfile.TemporaryDirectory] = None
+        self._spilled_files = 0
+
+    def __enter__(self) -> "AttachmentStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._temp_directory is not None:
+            self._temp_directory.cleanup()
+            self._temp_directory = None
+        self.memory_used = 0
+
+    def _fits_in_memory(self, size: int) -> bool:
+        return self.memory_used + size <= self.memory_limit
+
+    def _spill_path(self, filename: str) -> pathlib.Path:
+        if self._temp_directory is None:
+            self._temp_directory = tempfile.TemporaryDirectory(prefix="pinbot_")
+        # Prefix with a counter, two attachments in one message can share a name too.
+        self._spilled_files += 1
+        return pathlib.Path(self._temp_directory.name).joinpath("{}_{}".format(self._spilled_files, filename))
+
+    def add(
+        self, filename: str, data: bytes, spoiler: bool = False, content_hash: typing.Optional[str] = None
+    ) -> StoredAttachment:
+        """
+        Store bytes that are already in memory, e.g. the output of a resize.
+
+        :param filename: the name the file should be posted with
+        :param data: the file contents
+        :param spoiler: whether the file should be posted as a spoiler
+        :param content_hash: the hash of the original attachment, if known
+        :return: the stored attachment
+        """
+        if self._fits_in_memory(len(data)):
+            self.memory_used += len(data)
+            return StoredAttachment(filename, data=data, spoiler=spoiler, content_hash=content_hash)
+
+        path = self._spill_path(filename)
+        path.write_bytes(data)
+        return StoredAttachment(filename, path=path, spoiler=spoiler, content_hash=content_hash)
+
+    async def fetch(
+        self,
+        attachment: discord.Attachment,
+        max_bytes: typing.Optional[int] = None,
+        accept_header: typing.Optional[typing.Callable[[bytes], bool]] = None
+    ) -> StoredAttachment:
+        """
+        Stream an attachment into the store, hashing it on the way.  Whether it goes to memory or disk is decided up
+        front from the size Discord reports, so nothing is written twice.
+
+        :param attachment: the attachment to download
+        :param max_bytes: stop once more than this many bytes have come in
+        :param accept_header: called with the first HEADER_SIZE bytes (or the whole file, if it's smaller), stop if it
+                              returns False.  It's called in the default executor, off the event loop, so it can take
+                              its time, e.g. to import PIL and parse the header with it.
+        :return: the stored attachment, with its content hash
+        :raises DownloadRejected: if it was stopped by max_bytes or accept_header
+        """
+        in_memory = self._fits_in_memory(attachment.size)
+        if in_memory:
+            # Reserve the memory before awaiting, other fetches for this request may be running alongside this one.
+            self.memory_used += attachment.size
+            chunks = []
+            path = None
+            file = None
+        else:
+            path = self._spill_path(attachment.filename)
+            file = path.open("wb")
+
+        async def _check_header(header: bytes) -> None:
+            if not await asyncio.get_running_loop().run_in_executor(None, accept_header, header):
+                raise DownloadRejected("Header of [{}] was turned down".format(attachment.id))
+
+        hasher = content.new_hasher()
+        received = 0
+        header = b"" if accept_header is not None else None
+        try:
+            async with self.downloader.open(attachment.url) as stream:
+                async for chunk in stream:
+                    received += len(chunk)
+                    if max_bytes is not None and received > max_bytes:
+                        raise DownloadRejected("[{}] is over [{}] bytes".format(attachment.id, max_bytes))
+                    if header is not None:
+                        header += chunk
+                        if len(header) >= HEADER_SIZE:
+                            await _check_header(header)
+                            header = None
+                    hasher.update(chunk)
+                    if file is not None:
+                        file.write(chunk)
+                    else:
+                        chunks.append(chunk)
+            if header is not None:
+                await _check_header(header)
+        except BaseException:
+            if in_memory:
+                self.memory_used -= attachment.size
+            else:
+                file.close()
+                path.unlink()
+            raise
+
+        content_hash = hasher.hexdigest()
+        if in_memory:
+            data = b"".join(chunks)
+            self.memory_used += len(data) - attachment.size
+            return StoredAttachment(
+                attachment.filename, data=data, spoiler=attachment.is_spoiler(), content_hash=content_hash
+            )
+        file.close()
+        return StoredAttachment(
+            attachment.filename, path=path, spoiler=attachment.is_spoiler(), content_hash=content_hash
+        )
@@ -1,5 +1,77 @@
+import dataclasses
+import functools
 import json
+import os
 import pathlib
+import typing
+
+
+# Environment variables named this plus a setting's name in capitals override it, e.g. PINBOT_PIN_WORKERS=16.
+ENVIRONMENT_PREFIX = "PINBOT_"
+
+
+@dataclasses.dataclass
+class Settings:
+    """
+    Everything PinBot can be configured with.  The defaults here are overridden by config/settings.json (and
+    bot_token by config/secrets.json), which are overridden by environment variables (see ENVIRONMENT_PREFIX).
+    Environment variables are read as JSON, like the values in settings.json, except strings don't need quotes.
+    """
+
+    # From secrets.json.  Only needed to actually connect.
+    bot_token: typing.Optional[str] = dataclasses.field(default=None, repr=False)
+    # The sqlite DB, relative to the working directory.  Every process of a sharded bot should point at the same one.
+    database_path: str = "pinbot.db"
+    # Seconds to wait on a lock another connection (or process) holds before a query fails.
+    database_busy_timeout: float = 5.0
+    # Seconds between DB maintenance runs (pruning orphaned rows, archiving old pins, giving free space back to the
+    # filesystem), 0 to turn it off.  Only the process running shard 0 does it.
+    database_maintenance_interval: float = 21600.0
+    # Compact the "already pinned" history of attachments older than this many days into a much smaller archive.
+    # Lookups stay exact.  None keeps it all as it is.
+    archive_pins_after_days: typing.Optional[float] = None
+    # Total shards and the ones this process runs.  Both unset runs every shard, as many as Discord recommends.
+    # shard_ids needs shard_count.  Can be overridden with --shard-count and --shard-ids.
+    shard_count: typing.Optional[int] = None
+    shard_ids: typing.Optional[typing.List[int]] = None
+    # Seconds between reloads of the routing table from the DB, so connections registered or deleted by other processes
+    # sharing it start (or stop) being pinned from here.  A pin rereads its source channel's connections if they were
+    # last read longer ago than this.  0 turns both off, for a bot that runs as a single process.
+    route_refresh_interval: float = 10.0
+    # Processes resizes run on, None for one per CPU.  Lower it when running several bot processes on one machine.
+    image_workers: typing.Optional[int] = None
+    # Seconds between per-shard event rate reports, 0 to turn them off.
+    event_rate_log_interval: float = 300.0
+    # Bytes of attachments a single pin request may hold in memory before spilling to a temp directory.
+    attachment_memory_limit: int = 64000000
+    # Connections attachments are downloaded over, kept open between pins.
+    download_connections: int = 16
+    # Largest image (in bytes) downloaded to be resized.  Anything bigger that's over the upload limit, and anything
+    # over it that isn't an image, is posted as a link.
+    max_resize_download: int = 64000000
+    # Sends to pin channels that may be in flight at once, across all pins.
+    max_concurrent_sends: int = 8
+    # Write logs from a background thread, so the event loop never waits on stdout.
+    queued_logging: bool = True
+    # Where resized images are kept, and how many bytes of them to keep (0 turns the cache off).
+    resize_cache_directory: str = "resize_cache"
+    resize_cache_size: int = 1000000000
+    # Don't post an attachment to a pin channel that already has the exact same file, whatever message it came from.
+    suppress_duplicate_content: bool = False
+    # Pins are made by this many workers, and retried this many times, backing off exponentially from pin_job_backoff
+    # seconds up to pin_job_max_backoff seconds between tries.
+    pin_workers: int = 8
+    pin_job_max_attempts: int = 8
+    pin_job_backoff: float = 2.0
+    pin_job_max_backoff: float = 600.0
+    # How fast !backfill queues pins from a channel's history, more than 0.
+    backfill_pins_per_second: float = 2.0
+    # Where to serve Prometheus metrics (/metrics), None to not serve them.  Each process of a sharded bot needs its
+    # own port, see --metrics-port.
+    metrics_host: str = "127.0.0.1"
+    metrics_port: typing.Optional[int] = 9108
+    # Seconds between event loop lag checks.
+    event_loop_lag_interval: float = 1.0
 
 
 def get_config_directory() -> pathlib.Path:
@@ -11,9 +83,94 @@ def get_config_directory() -> pathlib.Path:
     return pathlib.Path(__file__).absolute().parent.parent.joinpath("config")
 
 
+def _read_json(filename: str) -> dict:
+    config_file = get_config_directory().joinpath(filename)
+    return json.loads(config_file.read_text()) if config_file.exists() else {}
+
+
+def _check_type(name: str, value: typing.Any, expected: typing.Any) -> typing.Any:
+    """
+    :return: the value, if it's what the setting's annotation says it should be (ints are taken for floats)
+    :raises ValueError: if it isn't
+    """
+    if typing.get_origin(expected) is typing.Union:
+        if value is None and type(None) in typing.get_args(expected):
+            return None
+        expected = next(option for option in typing.get_args(expected) if option is not type(None))
+    if typing.get_origin(expected) is list:
+        if isinstance(value, list):
+            return [_check_type(name, item, typing.get_args(expected)[0]) for item in value]
+    elif expected is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    elif isinstance(value, expected) and not (expected is int and isinstance(value, bool)):
+        return value
+    raise ValueError("Setting [{}] should be {}, not {!r}".format(name, getattr(expected, "__name__", expected), value))
+
+
+def _from_environment(name: str, expected: typing.Any) -> typing.Any:
+    raw = os.environ[ENVIRONMENT_PREFIX + name.upper()]
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    # Unquoted strings, and ones that happen to look like something else, e.g. a path of "1".
+    if not isinstance(value, str) and value is not None and str in (expected, *typing.get_args(expected)):
+        value = raw
+    return value
+
+
+def _check_settings(settings: Settings) -> Settings:
+    """
+    :return: the settings, if their values make sense, on their own and together
+    :raises ValueError: if they don't
+    """
+    # !backfill waits 1 / backfill_pins_per_second between pins.
+    if settings.backfill_pins_per_second <= 0:
+        raise ValueError("Setting [backfill_pins_per_second] should be more than 0, not {!r}".format(
+            settings.backfill_pins_per_second
+        ))
+    # discord.py refuses it too, but only once the bot is made, with an exception that doesn't say which setting.
+    if settings.shard_ids is not None and settings.shard_count is None:
+        raise ValueError("Setting [shard_ids] needs shard_count to be set too")
+    return settings
+
+
+@functools.lru_cache(maxsize=None)
 def load_secret_configs() -> dict:
-    return json.loads(get_config_directory().joinpath("secrets.json").read_text())
+    """
+    Read secrets.json, once.
+
+    :return: what's in it, nothing if it doesn't exist
+    """
+    return _read_json("secrets.json")
+
+
+@functools.lru_cache(maxsize=None)
+def load_settings() -> Settings:
+    """
+    Load the bot settings, once: the Settings defaults, then settings.json and secrets.json, then the environment.
+
+    :return: the settings, the same object every call
+    :raises ValueError: if a setting doesn't exist or has the wrong type, or settings don't make sense
+    """
+    values = {**_read_json("settings.json"), **{
+        key: value for key, value in load_secret_configs().items() if key == "bot_token"
+    }}
+    types = typing.get_type_hints(Settings)
+    for name in types:
+        if ENVIRONMENT_PREFIX + name.upper() in os.environ:
+            values[name] = _from_environment(name, types[name])
+
+    unknown = set(values) - set(types)
+    if unknown:
+        raise ValueError("Unknown settings: {}".format(", ".join(sorted(unknown))))
+    return _check_settings(Settings(**{name: _check_type(name, value, types[name]) for name, value in values.items()}))
 
 
 def load_discord_token() -> str:
-    return load_secret_configs()["bot_token"]
+    token = load_settings().bot_token
+    if not token:
+        raise ValueError(
+            "No bot token, put it in config/secrets.json or set {}BOT_TOKEN".format(ENVIRONMENT_PREFIX)
+        )
+    return token
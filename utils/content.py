@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import hashlib
+import os
+import pathlib
+import typing
+
+from utils import log
+
+
+HASH_DIGEST_SIZE = 20
+
+
+def new_hasher() -> "hashlib._Hash":
+    """
+    :return: the hasher content is identified by (BLAKE2b), for hashing bytes as they come in (e.g. downloads)
+    """
+    return hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+
+
+class ResizeCache:
+    """
+    Resized images on disk, keyed by the hash of the original's bytes and the limit it was resized to, so the same
+    image is only ever resized once per limit, however many times (and wherever) it's pinned.
+
+    The directory is kept under size_limit bytes by evicting the least recently used entries.  Recency is the files'
+    modification time, which get() bumps, so it survives restarts.  A size_limit of 0 disables the cache.
+
+    Entries are several MB, so get() and put() read and write them on the default executor rather than the event loop.
+    The bookkeeping stays on the event loop, so only call them from there.
+    """
+
+    def __init__(self, directory: pathlib.Path, size_limit: int):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # file name -> size, least recently used first
+        self._entries: typing.OrderedDict[str, int] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_name(original_hash: str, resize_limit: int) -> str:
+        return "{}_{}".format(original_hash, resize_limit)
+
+    def load(self) -> None:
+        """
+        Pick up whatever's already in the directory, making it if it doesn't exist.  Blocking, call it before the bot
+        starts.
+
+        :return: None
+        """
+        if not self.size_limit:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp":
+                # Left over from a write that never finished.
+                path.unlink()
+                continue
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+
+        self._entries.clear()
+        self.size = 0
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.size += size
+        self._delete(self._evict())
+        log.info(
+            "Loaded [{}] resized images ({}MB) from [{}]", len(self._entries), round(self.size / 1000000, 2),
+            self.directory
+        )
+
+    @staticmethod
+    def _read(path: pathlib.Path) -> bytes:
+        data = path.read_bytes()
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def _write(directory: pathlib.Path, name: str, data: bytes) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        # Written under another name and renamed into place, so a crash never leaves a truncated entry behind.
+        temporary_path = directory.joinpath("{}.tmp".format(name))
+        temporary_path.write_bytes(data)
+        os.replace(temporary_path, directory.joinpath(name))
+
+    @staticmethod
+    def _delete(paths: typing.Iterable[pathlib.Path]) -> None:
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def get(self, original_hash: str, resize_limit: int) -> typing.Optional[bytes]:
+        """
+        :param original_hash: hash of the original image (see new_hasher)
+        :param resize_limit: the size limit it was resized for
+        :return: the resized image, None if it isn't cached
+        """
+        name = self._entry_name(original_hash, resize_limit)
+        if name not in self._entries:
+            self.misses += 1
+            return None
+
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(None, self._read, self.directory.joinpath(name))
+        except FileNotFoundError:
+            # Someone cleaned out the directory from under us, or it was evicted while it was being read.
+            self.size -= self._entries.pop(name, 0)
+            self.misses += 1
+            return None
+        if name in self._entries:
+            self._entries.move_to_end(name)
+        self.hits += 1
+        return data
+
+    async def put(self, original_hash: str, resize_limit: int, data: bytes) -> None:
+        """
+        Cache a resized image, evicting the least recently used ones if the cache is over its size limit.
+
+        :param original_hash: hash of the original image (see new_hasher)
+        :param resize_limit: the size limit it was resized for
+        :param data: the resized image
+        :return: None
+        """
+        if not self.size_limit or len(data) > self.size_limit:
+            return
+
+        name = self._entry_name(original_hash, resize_limit)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, self.directory, name, data)
+
+        self.size += len(data) - self._entries.pop(name, 0)
+        self._entries[name] = len(data)
+        evicted = self._evict()
+        if evicted:
+            await loop.run_in_executor(None, self._delete, evicted)
+
+    def _evict(self) -> typing.List[pathlib.Path]:
+        """
+        Drop the least recently used entries until the cache is under its size limit.
+
+        :return: the files of the entries dropped, for the caller to delete
+        """
+        evicted = []
+        while self.size > self.size_limit and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(self.directory.joinpath(name))
+            log.debug("Evicted [{}] from the resize cache", name)
+        return evicted
@@ -0,0 +1,780 @@
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+from utils import log
+from utils import metrics
+from utils import migrations
+
+
+# channel_key, source_channel, pin_channel, registering_user
+ConnectionRow = typing.Tuple[str, int, typing.Optional[int], int]
+# job_id, guild_id, source_channel, message_id, user_id, attempts, created_at, next_attempt_at
+PinJobRow = typing.Tuple[int, typing.Optional[int], int, int, int, int, float, float]
+# source_channel, last_message_id, scanned, queued, updated_at, completed_at
+BackfillCheckpointRow = typing.Tuple[int, int, int, int, float, typing.Optional[float]]
+# Most attachment IDs in one pinned_attachments_archive chunk, 32KB of them.  Archiving rewrites at most one chunk.
+ARCHIVE_CHUNK_SIZE = 4096
+# Most parameters put in one statement.  SQLite before 3.32 (e.g. python:3.8's) allows 999, so IN lists longer than
+# this, e.g. of the attachments in a page of history, are looked up in batches.
+MAX_QUERY_PARAMETERS = 900
+
+
+class DatabaseStats(typing.NamedTuple):
+    file_bytes: int
+    wal_bytes: int
+    page_size: int
+    page_count: int
+    free_pages: int
+    # 0 none, 1 full, 2 incremental
+    auto_vacuum: int
+    pinned_attachments: int
+    archived_attachments: int
+    pinned_embeds: int
+    pinned_content: int
+
+_STOP = object()
+# code object of a query function -> name of the Database method it belongs to
+_QUERY_NAMES: typing.Dict[typing.Any, str] = {}
+
+
+def _placeholders(values: typing.Collection) -> str:
+    return ",".join("?" * len(values))
+
+
+def _batches(values: typing.Iterable, size: int) -> typing.List[list]:
+    values = list(values)
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def _select_in(
+    connection: sqlite3.Connection, command: str, values: typing.Collection, keys: typing.Collection
+) -> typing.Set[tuple]:
+    """
+    Run a SELECT with two IN lists, e.g. of attachment IDs and of channel keys, in as many batches as it takes to keep
+    under SQLite's limit on parameters (see MAX_QUERY_PARAMETERS).  That's one for anything but a lot of them.
+
+    :param command: the SELECT, with a {} for each list's placeholders
+    :return: every row it found
+    """
+    rows = set()
+    for key_batch in _batches(keys, MAX_QUERY_PARAMETERS // 2):
+        for value_batch in _batches(values, MAX_QUERY_PARAMETERS - len(key_batch)):
+            rows.update(connection.execute(
+                command.format(_placeholders(value_batch), _placeholders(key_batch)), (*value_batch, *key_batch)
+            ).fetchall())
+    return rows
+
+
+def _pack_ids(ids: typing.Iterable[int]) -> bytes:
+    # How pinned_attachments_archive keeps attachment IDs: sorted, as little-endian signed 64 bit integers.
+    packed = array.array("q", sorted(ids))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_ids(data: bytes) -> typing.Sequence[int]:
+    unpacked = array.array("q")
+    unpacked.frombytes(data)
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked
+
+
+def _contains(ids: typing.Sequence[int], value: int) -> bool:
+    index = bisect.bisect_left(ids, value)
+    return index < len(ids) and ids[index] == value
+
+
+def _query_name(function: typing.Callable) -> str:
+    # Query functions are lambdas (or local functions) in the Database method making the query, so the method's name
+    # is in their qualified name, e.g. "Database.get_pin_jobs.<locals>.<lambda>".
+    code = getattr(function, "__code__", None)
+    name = _QUERY_NAMES.get(code)
+    if name is None:
+        name = _QUERY_NAMES[code] = function.__qualname__.split(".<locals>")[0].rsplit(".", 1)[-1]
+    return name
+
+
+def _resolve(future: asyncio.Future, result: typing.Any = None, exception: typing.Optional[BaseException] = None):
+    # Runs on the event loop.  The awaiting coroutine may have been cancelled while the query ran.
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class Database:
+    """
+    Async access to the PinBot DB that keeps SQLite off the event loop.
+
+    * Reads run on a small thread pool, each thread with its own connection (WAL lets them read while a write is
+      going on).
+    * Writes go to a single writer thread through a queue.  The writer takes everything that's queued up (up to
+      commit_batch_size) and runs it in one transaction, each write in its own savepoint, so a burst of pins costs one
+      commit (and one fsync) instead of one each, and one failing write doesn't take the rest of the batch with it.
+
+    Every query PinBot makes is a method here, main.py doesn't write SQL.  How long each takes (as the caller sees it,
+    so waiting for the writer counts) goes to the pinbot_db_query_seconds metric, labelled with the method's name.
+
+    Several processes can share the DB (e.g. one per group of shards).  Write transactions take the write lock up
+    front, and every connection waits up to busy_timeout seconds for a lock another process holds.
+    """
+
+    def __init__(
+        self, database_path: str, read_connections: int = 4, commit_batch_size: int = 64, busy_timeout: float = 5.0
+    ):
+        self.database_path = database_path
+        self.read_connections = read_connections
+        self.commit_batch_size = commit_batch_size
+        self.busy_timeout = busy_timeout
+
+        self._write_queue: queue.Queue = queue.Queue()
+        self._writer: typing.Optional[threading.Thread] = None
+        self._read_pool: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._thread_local = threading.local()
+        self._open_connections: typing.List[sqlite3.Connection] = []
+        self._open_connections_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = migrations.connect(
+            self.database_path, check_same_thread=False, busy_timeout=self.busy_timeout
+        )
+        with self._open_connections_lock:
+            self._open_connections.append(connection)
+        return connection
+
+    def open(self) -> int:
+        """
+        Migrate the DB and start the writer thread and the read pool.  Blocking, call it before the bot starts.
+
+        :return: the schema version the DB is at
+        """
+        writer_connection = self._connect()
+        schema_version = migrations.migrate(writer_connection)
+        # Transactions are managed by the writer itself.
+        writer_connection.isolation_level = None
+
+        self._writer = threading.Thread(
+            target=self._write_loop, args=(writer_connection,), name="pinbot-db-writer", daemon=True
+        )
+        self._writer.start()
+        self._read_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.read_connections, thread_name_prefix="pinbot-db-reader"
+        )
+        return schema_version
+
+    def close(self) -> None:
+        """
+        Finish any queued writes, then stop the writer thread and the read pool, checkpoint the WAL into the DB file
+        (so the file alone has everything, as long as no other process is still writing) and close every connection.
+
+        :return: None
+        """
+        if self._writer is not None:
+            self._write_queue.put(_STOP)
+            self._writer.join()
+            self._writer = None
+        if self._read_pool is not None:
+            self._read_pool.shutdown(wait=True)
+            self._read_pool = None
+        with self._open_connections_lock:
+            if self._open_connections:
+                try:
+                    self._open_connections[0].execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+                except sqlite3.Error as exception:
+                    log.warning("Couldn't checkpoint the DB on closing: {}", exception)
+            for connection in self._open_connections:
+                connection.close()
+            self._open_connections = []
+
+    def _write_loop(self, connection: sqlite3.Connection) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self._write_queue.get()]
+            while len(batch) < self.commit_batch_size:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+            if not batch:
+                continue
+
+            results = []
+            try:
+                # IMMEDIATE, so waiting on another process's write happens here, under the busy timeout.  A deferred
+                # transaction that only finds out at its first write can fail outright instead.
+                connection.execute("BEGIN IMMEDIATE")
+                for function, args, _, _ in batch:
+                    connection.execute("SAVEPOINT pinbot_write")
+                    try:
+                        results.append((function(connection, *args), None))
+                        connection.execute("RELEASE pinbot_write")
+                    except Exception as exception:
+                        connection.execute("ROLLBACK TO pinbot_write")
+                        connection.execute("RELEASE pinbot_write")
+                        results.append((None, exception))
+                connection.execute("COMMIT")
+            except sqlite3.Error as exception:
+                # The commit itself failed, so nothing in the batch made it.
+                log.error("DB commit of [{}] writes failed: {}", len(batch), exception)
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                results = [(None, exception)] * len(batch)
+
+            for (_, _, future, loop), (result, exception) in zip(batch, results):
+                loop.call_soon_threadsafe(_resolve, future, result, exception)
+
+    def _read_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._thread_local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._thread_local.connection = connection
+        return connection
+
+    def _run_read(self, function: typing.Callable, *args) -> typing.Any:
+        return function(self._read_connection(), *args)
+
+    async def _read(self, function: typing.Callable, *args) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._read_pool, functools.partial(self._run_read, function, *args))
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, _query_name(function))
+
+    async def _write(self, function: typing.Callable, *args) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = time.perf_counter()
+        self._write_queue.put((function, args, future, loop))
+        try:
+            return await future
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, _query_name(function))
+
+    # Channel connections
+
+    async def load_connections(self) -> typing.List[typing.Tuple[str, int, typing.Optional[int]]]:
+        """
+        :return: (channel_key, source_channel, pin_channel) for every connection, pending ones included
+        """
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT channel_key, source_channel, pin_channel FROM channel_connections"
+            ).fetchall()
+        )
+
+    async def load_source_connections(
+        self, source_channel: int
+    ) -> typing.List[typing.Tuple[str, int, typing.Optional[int]]]:
+        """
+        :return: (channel_key, source_channel, pin_channel) for every connection from the channel, pending ones included
+        """
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT channel_key, source_channel, pin_channel FROM channel_connections WHERE source_channel=?",
+                (source_channel,)
+            ).fetchall()
+        )
+
+    async def get_connection(self, channel_key: str) -> typing.Optional[ConnectionRow]:
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT * FROM channel_connections WHERE channel_key=?", (channel_key,)
+            ).fetchone()
+        )
+
+    async def get_pending_connection(
+        self, source_channel: int, registering_user: int
+    ) -> typing.Optional[ConnectionRow]:
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT * FROM channel_connections "
+                "WHERE source_channel=? AND pin_channel IS NULL AND registering_user=?",
+                (source_channel, registering_user)
+            ).fetchone()
+        )
+
+    async def get_connection_between(self, source_channel: int, pin_channel: int) -> typing.Optional[ConnectionRow]:
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT * FROM channel_connections WHERE source_channel=? AND pin_channel=?",
+                (source_channel, pin_channel)
+            ).fetchone()
+        )
+
+    async def add_connection(self, channel_key: str, source_channel: int, registering_user: int) -> None:
+        """
+        Add a pending connection (no pin channel yet).
+        """
+        await self._write(
+            lambda connection: connection.execute(
+                "INSERT INTO channel_connections(channel_key,source_channel,pin_channel,registering_user) "
+                "VALUES(?,?,NULL,?)",
+                (channel_key, source_channel, registering_user)
+            )
+        )
+
+    async def set_pin_channel(self, channel_key: str, pin_channel: int) -> None:
+        """
+        Complete a pending connection.  Raises sqlite3.IntegrityError if the source -> pin pair already exists.
+
+        The source channel's backfill checkpoint is deleted along with it: the new pin channel has none of the history
+        earlier backfills got through, so the next backfill has to start from the beginning.
+        """
+        def _set(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "UPDATE channel_connections SET pin_channel=? WHERE channel_key=?", (pin_channel, channel_key)
+            )
+            connection.execute(
+                "DELETE FROM backfill_checkpoints "
+                "WHERE source_channel=(SELECT source_channel FROM channel_connections WHERE channel_key=?)",
+                (channel_key,)
+            )
+
+        await self._write(_set)
+
+    async def delete_connection(self, channel_key: str) -> typing.Optional[ConnectionRow]:
+        """
+        Delete a connection (and, through the cascades, its pins).
+
+        :return: the deleted connection, None if it didn't exist
+        """
+        def _delete(connection: sqlite3.Connection) -> typing.Optional[ConnectionRow]:
+            row = connection.execute("SELECT * FROM channel_connections WHERE channel_key=?", (channel_key,)).fetchone()
+            if row:
+                connection.execute("DELETE FROM channel_connections WHERE channel_key=?", (channel_key,))
+            return row
+
+        return await self._write(_delete)
+
+    # Pins
+
+    async def get_pinned_attachments(
+        self, attachment_ids: typing.Collection[int], channel_keys: typing.Collection[str]
+    ) -> typing.Set[typing.Tuple[int, str]]:
+        """
+        Find which of the given attachments have already been pinned to which of the given connections, in a single
+        query unless there are too many to check at once (see MAX_QUERY_PARAMETERS).
+
+        :param attachment_ids: IDs of the attachments to check
+        :param channel_keys: keys of the connections to check
+        :return: (attachment_id, channel_key) for every pin that already exists
+        """
+        if not attachment_ids or not channel_keys:
+            return set()
+
+        select_command = "SELECT attachment_id, channel_key FROM pinned_attachments WHERE attachment_id IN ({}) " \
+                         "AND channel_key IN ({})"
+        archive_command = "SELECT channel_key, attachment_ids FROM pinned_attachments_archive " \
+                          "WHERE channel_key IN ({}) AND last_attachment_id >= ? AND first_attachment_id <= ?"
+        id_range = (min(attachment_ids), max(attachment_ids))
+
+        def _select(connection: sqlite3.Connection) -> typing.Set[typing.Tuple[int, str]]:
+            pinned = _select_in(connection, select_command, attachment_ids, channel_keys)
+            # Pins of messages newer than anything that's been archived, i.e. nearly all of them, find nothing here.
+            for key_batch in _batches(channel_keys, MAX_QUERY_PARAMETERS - len(id_range)):
+                for channel_key, data in connection.execute(
+                    archive_command.format(_placeholders(key_batch)), (*key_batch, *id_range)
+                ):
+                    archived = _unpack_ids(data)
+                    pinned.update(
+                        (attachment_id, channel_key) for attachment_id in attachment_ids
+                        if _contains(archived, attachment_id)
+                    )
+            return pinned
+
+        return await self._read(_select)
+
+    async def get_pinned_embed_keys(self, embed_url: str, channel_keys: typing.Collection[str]) -> typing.Set[str]:
+        """
+        Find which of the given connections an embed has already been pinned to, in a single query.
+
+        :param embed_url: URL the embed was logged with
+        :param channel_keys: keys of the connections to check
+        :return: the channel keys the embed was already pinned to
+        """
+        if not channel_keys:
+            return set()
+
+        select_command = "SELECT channel_key FROM pinned_embeds WHERE embed_url=? AND channel_key IN ({})".format(
+            _placeholders(channel_keys)
+        )
+        parameters = (embed_url, *channel_keys)
+        return await self._read(
+            lambda connection: {row[0] for row in connection.execute(select_command, parameters)}
+        )
+
+    async def get_pinned_embeds(
+        self, embed_urls: typing.Collection[str], channel_keys: typing.Collection[str]
+    ) -> typing.Set[typing.Tuple[str, str]]:
+        """
+        Find which of the given embeds have already been pinned to which of the given connections, in a single query
+        unless there are too many to check at once (see MAX_QUERY_PARAMETERS).
+
+        :param embed_urls: URLs the embeds were logged with
+        :param channel_keys: keys of the connections to check
+        :return: (embed_url, channel_key) for every pin that already exists
+        """
+        if not embed_urls or not channel_keys:
+            return set()
+
+        select_command = "SELECT embed_url, channel_key FROM pinned_embeds WHERE embed_url IN ({}) " \
+                         "AND channel_key IN ({})"
+        return await self._read(
+            lambda connection: _select_in(connection, select_command, embed_urls, channel_keys)
+        )
+
+    async def get_pinned_content(
+        self, content_hashes: typing.Collection[str], pin_channels: typing.Collection[int]
+    ) -> typing.Set[typing.Tuple[str, int]]:
+        """
+        Find which of the given contents have already been posted to which of the given pin channels, through any
+        connection, in a single query unless there are too many to check at once (see MAX_QUERY_PARAMETERS).
+
+        :param content_hashes: hashes of the attachments to check
+        :param pin_channels: IDs of the pin channels to check
+        :return: (content_hash, pin_channel) for every one that was already posted
+        """
+        if not content_hashes or not pin_channels:
+            return set()
+
+        select_command = "SELECT content_hash, pin_channel FROM pinned_content WHERE content_hash IN ({}) " \
+                         "AND pin_channel IN ({})"
+        return await self._read(
+            lambda connection: _select_in(connection, select_command, content_hashes, pin_channels)
+        )
+
+    async def record_pins(
+        self,
+        attachment_pins: typing.Iterable[typing.Tuple[int, str]] = (),
+        embed_pins: typing.Iterable[typing.Tuple[str, str]] = (),
+        content_pins: typing.Iterable[typing.Tuple[str, int, str]] = ()
+    ) -> None:
+        """
+        Log pins, with one statement per table no matter how many there are.  Pins that were already logged are
+        ignored, as are pins to connections deleted in the meantime (e.g. by another process sharing the DB, while
+        this one still had them in its routing table), which there's no longer anything to log against.
+
+        :param attachment_pins: (attachment_id, channel_key) pairs
+        :param embed_pins: (embed_url, channel_key) pairs
+        :param content_pins: (content_hash, pin_channel, channel_key) for each attachment posted
+        :return: None
+        """
+        attachment_pins = list(attachment_pins)
+        embed_pins = list(embed_pins)
+        content_pins = list(content_pins)
+
+        def _record(connection: sqlite3.Connection) -> None:
+            if attachment_pins:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO pinned_attachments(attachment_id,channel_key) "
+                    "SELECT ?, channel_key FROM channel_connections WHERE channel_key=?",
+                    attachment_pins
+                )
+            if embed_pins:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO pinned_embeds(embed_url,channel_key) "
+                    "SELECT ?, channel_key FROM channel_connections WHERE channel_key=?",
+                    embed_pins
+                )
+            if content_pins:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO pinned_content(content_hash,pin_channel,channel_key) "
+                    "SELECT ?, ?, channel_key FROM channel_connections WHERE channel_key=?",
+                    content_pins
+                )
+
+        if not attachment_pins and not embed_pins and not content_pins:
+            return
+        await self._write(_record)
+
+    # Pin jobs
+
+    async def add_pin_job(
+        self, guild_id: typing.Optional[int], source_channel: int, message_id: int, user_id: int, created_at: float
+    ) -> typing.Optional[PinJobRow]:
+        """
+        Queue a pin of a message, due right away.  Returns once it's committed.
+
+        :return: the new job, None if the message already had one queued
+        """
+        def _add(connection: sqlite3.Connection) -> typing.Optional[PinJobRow]:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO pin_jobs"
+                "(guild_id,source_channel,message_id,user_id,created_at,next_attempt_at) VALUES(?,?,?,?,?,?)",
+                (guild_id, source_channel, message_id, user_id, created_at, created_at)
+            )
+            if not cursor.rowcount:
+                return None
+            return cursor.lastrowid, guild_id, source_channel, message_id, user_id, 0, created_at, created_at
+
+        return await self._write(_add)
+
+    async def get_pin_jobs(
+        self, shard_count: typing.Optional[int] = None, shard_ids: typing.Optional[typing.Collection[int]] = None
+    ) -> typing.List[PinJobRow]:
+        """
+        :param shard_count: the total number of shards, if only some shards' jobs are wanted
+        :param shard_ids: the shards to get the jobs of, None for every job
+        :return: the queued jobs, the soonest due first
+        """
+        select_command = "SELECT job_id, guild_id, source_channel, message_id, user_id, attempts, created_at, " \
+                         "next_attempt_at FROM pin_jobs"
+        parameters: tuple = ()
+        if shard_count and shard_ids is not None:
+            # Discord's shard formula.  Jobs without a guild belong to shard 0.
+            select_command += " WHERE ((COALESCE(guild_id, 0) >> 22) % ?) IN ({})".format(_placeholders(shard_ids))
+            parameters = (shard_count, *shard_ids)
+        select_command += " ORDER BY next_attempt_at"
+
+        return await self._read(lambda connection: connection.execute(select_command, parameters).fetchall())
+
+    async def reschedule_pin_job(self, job_id: int, attempts: int, next_attempt_at: float, error: str) -> None:
+        await self._write(
+            lambda connection: connection.execute(
+                "UPDATE pin_jobs SET attempts=?, next_attempt_at=?, last_error=? WHERE job_id=?",
+                (attempts, next_attempt_at, error, job_id)
+            )
+        )
+
+    async def delete_pin_job(self, job_id: int) -> None:
+        await self._write(
+            lambda connection: connection.execute("DELETE FROM pin_jobs WHERE job_id=?", (job_id,))
+        )
+
+    # Backfill checkpoints
+
+    async def get_backfill_checkpoint(self, source_channel: int) -> typing.Optional[BackfillCheckpointRow]:
+        return await self._read(
+            lambda connection: connection.execute(
+                "SELECT source_channel, last_message_id, scanned, queued, updated_at, completed_at "
+                "FROM backfill_checkpoints WHERE source_channel=?",
+                (source_channel,)
+            ).fetchone()
+        )
+
+    async def save_backfill_checkpoint(
+        self, source_channel: int, last_message_id: int, scanned: int, queued: int, updated_at: float,
+        completed: bool = False
+    ) -> None:
+        """
+        Record backfill progress through a source channel.
+
+        :param source_channel: ID of the channel being backfilled
+        :param last_message_id: ID of the newest message that's been dealt with
+        :param scanned: messages scanned since the last checkpoint
+        :param queued: pins queued since the last checkpoint
+        :param updated_at: unix timestamp of the checkpoint
+        :param completed: whether the backfill reached the end of the channel
+        :return: None
+        """
+        completed_at = updated_at if completed else None
+        await self._write(
+            lambda connection: connection.execute(
+                "INSERT INTO backfill_checkpoints"
+                "(source_channel,last_message_id,scanned,queued,updated_at,completed_at) VALUES(?,?,?,?,?,?) "
+                "ON CONFLICT(source_channel) DO UPDATE SET last_message_id=excluded.last_message_id, "
+                "scanned=scanned+excluded.scanned, queued=queued+excluded.queued, updated_at=excluded.updated_at, "
+                "completed_at=excluded.completed_at",
+                (source_channel, last_message_id, scanned, queued, updated_at, completed_at)
+            )
+        )
+
+    async def delete_backfill_checkpoint(self, source_channel: int) -> None:
+        await self._write(
+            lambda connection: connection.execute(
+                "DELETE FROM backfill_checkpoints WHERE source_channel=?", (source_channel,)
+            )
+        )
+
+    # Maintenance (see utils.maintenance)
+
+    async def prune_orphans(self, stale_job_before: float) -> typing.Dict[str, int]:
+        """
+        Delete what nothing refers to anymore, and the cascades didn't get: pins whose connection was deleted while
+        foreign keys weren't enforced (by older versions, or by hand), backfill checkpoints of channels that aren't a
+        source anymore (a new connection should backfill from the start), and pin jobs from those channels that were
+        never run, e.g. because their shard moved to a process that's gone.
+
+        :param stale_job_before: unix timestamp, only jobs queued before it are deleted
+        :return: table -> rows deleted
+        """
+        unconnected_key = "channel_key NOT IN (SELECT channel_key FROM channel_connections)"
+        unconnected_source = "source_channel NOT IN " \
+                             "(SELECT source_channel FROM channel_connections WHERE pin_channel IS NOT NULL)"
+
+        def _prune(connection: sqlite3.Connection) -> typing.Dict[str, int]:
+            pruned = {}
+            for table in ("pinned_attachments", "pinned_attachments_archive", "pinned_embeds", "pinned_content"):
+                pruned[table] = connection.execute("DELETE FROM {} WHERE {}".format(table, unconnected_key)).rowcount
+            pruned["backfill_checkpoints"] = connection.execute(
+                "DELETE FROM backfill_checkpoints WHERE {}".format(unconnected_source)
+            ).rowcount
+            pruned["pin_jobs"] = connection.execute(
+                "DELETE FROM pin_jobs WHERE created_at < ? AND {}".format(unconnected_source), (stale_job_before,)
+            ).rowcount
+            return pruned
+
+        return await self._write(_prune)
+
+    async def archive_pinned_attachments(self, before_attachment_id: int, limit: int) -> int:
+        """
+        Move attachment pins of attachments older than the given ID into pinned_attachments_archive, up to limit at a
+        time so pins don't wait long on the writer.  get_pinned_attachments finds them all the same.
+
+        Oldest first, so each connection's chunks mostly cover ranges of IDs that don't overlap.  A connection's newest
+        chunk is topped up to ARCHIVE_CHUNK_SIZE, the rest go in new chunks, so however much has been archived before,
+        a call only writes about as much as it archives.
+
+        :param before_attachment_id: archive attachments with IDs below this (IDs are snowflakes, so older than it)
+        :param limit: the most to archive
+        :return: how many were archived, less than limit once there are none left
+        """
+        def _insert_chunk(connection: sqlite3.Connection, channel_key: str, attachment_ids: typing.List[int]) -> None:
+            connection.execute(
+                "INSERT INTO pinned_attachments_archive"
+                "(channel_key,attachment_count,first_attachment_id,last_attachment_id,attachment_ids) "
+                "VALUES(?,?,?,?,?)",
+                (channel_key, len(attachment_ids), attachment_ids[0], attachment_ids[-1], _pack_ids(attachment_ids))
+            )
+
+        def _archive(connection: sqlite3.Connection) -> int:
+            rows = connection.execute(
+                "SELECT attachment_id, channel_key FROM pinned_attachments WHERE attachment_id < ? "
+                "ORDER BY attachment_id LIMIT ?",
+                (before_attachment_id, limit)
+            ).fetchall()
+            by_key = collections.defaultdict(list)
+            for attachment_id, channel_key in rows:
+                by_key[channel_key].append(attachment_id)
+            for channel_key, attachment_ids in by_key.items():
+                newest = connection.execute(
+                    "SELECT chunk_id, attachment_count, attachment_ids FROM pinned_attachments_archive "
+                    "WHERE channel_key=? ORDER BY chunk_id DESC LIMIT 1",
+                    (channel_key,)
+                ).fetchone()
+                if newest and newest[1] < ARCHIVE_CHUNK_SIZE:
+                    room = ARCHIVE_CHUNK_SIZE - newest[1]
+                    topped_up = sorted((*_unpack_ids(newest[2]), *attachment_ids[:room]))
+                    connection.execute(
+                        "UPDATE pinned_attachments_archive SET attachment_count=?, first_attachment_id=?, "
+                        "last_attachment_id=?, attachment_ids=? WHERE chunk_id=?",
+                        (len(topped_up), topped_up[0], topped_up[-1], _pack_ids(topped_up), newest[0])
+                    )
+                    attachment_ids = attachment_ids[room:]
+                for start in range(0, len(attachment_ids), ARCHIVE_CHUNK_SIZE):
+                    _insert_chunk(connection, channel_key, attachment_ids[start:start + ARCHIVE_CHUNK_SIZE])
+            connection.executemany("DELETE FROM pinned_attachments WHERE attachment_id=? AND channel_key=?", rows)
+            return len(rows)
+
+        return await self._write(_archive)
+
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Switch a DB made before PinBot turned on incremental auto vacuum over to it, which takes a VACUUM: the whole
+        file is rewritten while holding the write lock, so every other write (in any process) fails once it's waited
+        busy_timeout for it.  Blocking, and only for when nothing else is using the DB, see main.py --vacuum.
+
+        :return: whether it had to VACUUM, it only ever has to once
+        """
+        # On a connection of its own, since connections opened before a VACUUM go on reporting the old auto_vacuum
+        # until their next transaction.  Outside of any transaction, so not through the writer.
+        connection = migrations.connect(self.database_path, busy_timeout=self.busy_timeout)
+        try:
+            if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+            connection.execute("VACUUM")
+            # The rebuilt DB is in the WAL until it's checkpointed.
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return True
+        finally:
+            connection.close()
+
+    async def incremental_vacuum(self, pages: int) -> typing.Tuple[int, int]:
+        """
+        Give up to pages free pages back to the filesystem.
+
+        :param pages: the most pages to free
+        :return: how many pages were freed, and how many free pages are left.  None are freed unless the DB has
+                 incremental auto vacuum on (see enable_incremental_vacuum).
+        """
+        def _vacuum(connection: sqlite3.Connection) -> typing.Tuple[int, int]:
+            free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0, free_pages
+            # Each step of the pragma frees a page, and the sqlite3 module only steps it once.
+            for _ in range(min(pages, free_pages)):
+                connection.execute("PRAGMA incremental_vacuum(1)")
+            left = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            return free_pages - left, left
+
+        return await self._write(_vacuum)
+
+    async def checkpoint(self) -> bool:
+        """
+        Copy everything in the WAL into the DB file and truncate the WAL.  Only then does the DB file shrink by what
+        incremental_vacuum freed, and the WAL by what it grew to since the last truncation.
+
+        :return: whether it got everything, a reader still using the WAL holds back what it's reading
+        """
+        # Outside of any transaction, so not through the writer.
+        return await self._read(
+            lambda connection: not connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        )
+
+    async def optimize(self) -> None:
+        """
+        Have SQLite refresh the query planner's statistics for tables it thinks need it.
+        """
+        await self._write(lambda connection: connection.execute("PRAGMA optimize").fetchall())
+
+    async def get_stats(self) -> DatabaseStats:
+        def _stats(connection: sqlite3.Connection) -> DatabaseStats:
+            def value(query: str) -> int:
+                return connection.execute(query).fetchone()[0] or 0
+
+            return DatabaseStats(
+                file_bytes=self._file_size(),
+                wal_bytes=self._file_size("-wal"),
+                page_size=value("PRAGMA page_size"),
+                page_count=value("PRAGMA page_count"),
+                free_pages=value("PRAGMA freelist_count"),
+                auto_vacuum=value("PRAGMA auto_vacuum"),
+                pinned_attachments=value("SELECT COUNT(*) FROM pinned_attachments"),
+                archived_attachments=value("SELECT SUM(attachment_count) FROM pinned_attachments_archive"),
+                pinned_embeds=value("SELECT COUNT(*) FROM pinned_embeds"),
+                pinned_content=value("SELECT COUNT(*) FROM pinned_content"),
+            )
+
+        return await self._read(_stats)
+
+    def _file_size(self, suffix: str = "") -> int:
+        try:
+            return os.path.getsize(self.database_path + suffix)
+        except OSError:
+            return 0
+
+    def file_size(self) -> int:
+        """
+        :return: bytes the DB takes on disk, its WAL included
+        """
+        return self._file_size() + self._file_size("-wal")
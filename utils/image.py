@@ -0,0 +1,387 @@
+import asyncio
+import concurrent.futures
+import io
+import math
+import mimetypes
+import multiprocessing
+import typing
+
+# Pillow is imported where it's used rather than here: it's only needed once something has to be resized (mostly in
+# the process pool's workers), and importing it is a noticeable part of starting up.
+if typing.TYPE_CHECKING:
+    from PIL import Image
+
+
+# Encoded size scales roughly with pixel count, i.e. with the square of the scale factor.  We aim a little under the
+# limit so the first guess usually fits.
+TARGET_FILL = 0.92
+# Anything that fits and uses at least this much of the limit is good enough, another encode isn't worth it.
+ACCEPT_FILL = 0.8
+# Stop refining after this many encodes (levels and scales together), as long as one of them fit.
+MAX_PASSES = 6
+# Scale factors closer together than this aren't worth another encode either.
+SCALE_TOLERANCE = 0.01
+MINIMUM_SCALE = 0.01
+# Images with more pixels than this aren't resized, decoding them takes too much memory (several bytes per pixel, per
+# copy).  Still a 10000x10000 picture.
+MAX_PIXELS = 100000000
+# Content types of the images worth resizing.  Anything else over the upload limit is posted as a link.
+RESIZABLE_CONTENT_TYPES = frozenset(("image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff"))
+
+# Lazily created, see _get_process_pool().
+_PROCESS_POOL: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+# None is one worker per CPU.
+_PROCESS_POOL_WORKERS: typing.Optional[int] = None
+
+
+class ResizeError(ValueError):
+    """
+    The image couldn't be resized: PIL can't read (or write) it, or it couldn't be shrunk under the limit.
+    """
+
+
+class ImageHeader(typing.NamedTuple):
+    format: str
+    width: int
+    height: int
+
+
+class ResizeResult(typing.NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    passes: int
+
+
+class Encoder:
+    """
+    How to save an image in one format.  levels are the save options to try, from best looking (and biggest) to
+    smallest: shrink_to_limit keeps every pixel if any level fits, and only starts downscaling once even the smallest
+    doesn't.
+
+    This one just re-saves in the image's own format, for formats without an encoder of their own.  Animated images
+    keep every frame, as long as the format can save them.
+    """
+
+    levels: typing.Sequence[typing.Dict[str, typing.Any]] = ({},)
+    # Modes resize and save keep as they are, anything else is converted first.
+    modes: typing.Collection[str] = ("RGB", "RGBA", "L", "LA")
+    # Saved as this format instead of the original's, if set.
+    image_format: typing.Optional[str] = None
+    # Whether to keep every frame, or just the first.
+    animated = True
+
+    def _prepare(self, frame: "Image.Image", level: typing.Dict[str, typing.Any]) -> "Image.Image":
+        # Palette and bilevel images can only be resized with NEAREST, so they go through full color.
+        if frame.mode not in self.modes:
+            has_transparency = "transparency" in frame.info or frame.mode in ("PA", "RGBa")
+            frame = frame.convert("RGBA" if has_transparency else "RGB")
+        return frame
+
+    def _save_options(self, image: "Image.Image", level: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        return dict(level)
+
+    def encode(
+        self, image: "Image.Image", scale: float, level: typing.Dict[str, typing.Any]
+    ) -> typing.Tuple[bytes, int, int]:
+        """
+        :param image: the opened original
+        :param scale: how much to scale it by, 1 keeps its dimensions
+        :param level: one of levels
+        :return: the encoded image and its dimensions
+        """
+        from PIL import Image
+        from PIL import ImageSequence
+
+        width = max(1, int(image.width * scale))
+        height = max(1, int(image.height * scale))
+        frames = []
+        durations = []
+        # Decoded again every pass rather than kept, so only the frames being saved (scaled, usually) are in memory.
+        for frame in ImageSequence.Iterator(image):
+            prepared = self._prepare(frame, level)
+            if scale < 1:
+                prepared = prepared.resize((width, height), resample=Image.LANCZOS)
+            elif prepared is frame:
+                # The iterator seeks the same image to every frame.
+                prepared = frame.copy()
+            frames.append(self._finish(prepared, level))
+            durations.append(frame.info.get("duration", 0))
+            if not self.animated:
+                break
+
+        options = self._save_options(image, level)
+        if len(frames) > 1:
+            options.update(save_all=True, append_images=frames[1:], duration=durations)
+            if "loop" in image.info:
+                options["loop"] = image.info["loop"]
+        buffer = io.BytesIO()
+        frames[0].save(buffer, format=self.image_format or image.format, **options)
+        return buffer.getvalue(), width, height
+
+    def _finish(self, frame: "Image.Image", level: typing.Dict[str, typing.Any]) -> "Image.Image":
+        # Last step before saving, after any resize.
+        return frame
+
+
+class JpegEncoder(Encoder):
+    """
+    Lower quality before fewer pixels, down to 75, which is still hard to tell apart at a glance.  Optimized Huffman
+    tables and progressive scans are lossless and usually save a few percent.  EXIF (so the orientation) and the color
+    profile are kept.
+    """
+
+    levels = tuple({"quality": quality, "optimize": True, "progressive": True} for quality in (95, 90, 85, 80, 75))
+    modes = ("RGB", "L", "CMYK")
+    # Including MPOs (what some cameras save, a JPEG with extra pictures after it), which are saved as just the main
+    # picture.
+    image_format = "JPEG"
+    animated = False
+
+    def _save_options(self, image: "Image.Image", level: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        return dict(level, **_kept_info(image, "exif", "icc_profile"))
+
+
+class PngEncoder(Encoder):
+    """
+    A 256 color palette, which is what makes screenshots and drawings small (photos saved as PNG band a little, but
+    keep their size).  There's no lossless level: re-saving a PNG that's over the limit as it is almost never fits, and
+    max compression (optimize) takes several times the CPU for a few percent.
+    """
+
+    levels = ({"colors": 256},)
+    modes = ("RGB", "RGBA", "L", "LA", "I")
+
+    def _finish(self, frame: "Image.Image", level: typing.Dict[str, typing.Any]) -> "Image.Image":
+        from PIL import Image
+
+        if "colors" in level and frame.mode in ("RGB", "RGBA"):
+            # Fast octree is the only method that handles transparency.
+            return frame.quantize(colors=level["colors"], method=Image.Quantize.FASTOCTREE)
+        return frame
+
+    def _save_options(self, image: "Image.Image", level: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        options = {key: value for key, value in level.items() if key != "colors"}
+        options.update(_kept_info(image, "icc_profile"))
+        return options
+
+
+class GifEncoder(Encoder):
+    """
+    GIFs are already palettized, so there's nothing to trade but pixels.  Every frame is kept, with its timing and the
+    loop count, and optimize drops unused palette entries.
+    """
+
+    levels = ({"optimize": True},)
+
+    def _finish(self, frame: "Image.Image", level: typing.Dict[str, typing.Any]) -> "Image.Image":
+        from PIL import Image
+
+        # Pillow would palettize full color frames itself, with median cut, which is several times slower.  Frames
+        # with transparency are left to it, it knows how to keep that.
+        if frame.mode == "RGB":
+            return frame.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        return frame
+
+
+class WebpEncoder(Encoder):
+    """
+    Lower quality before fewer pixels, for stills and animations alike.  method 4 is libwebp's default tradeoff, 6
+    only gets a few percent more for a lot more CPU.  Animations are encoded with method 0, which is about twice as
+    fast for about 5% more bytes, since every frame costs as much as a still.
+    """
+
+    levels = tuple({"quality": quality, "method": 4} for quality in (90, 80, 70, 60))
+
+    def _save_options(self, image: "Image.Image", level: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        options = dict(level, **_kept_info(image, "exif", "icc_profile"))
+        if getattr(image, "n_frames", 1) > 1:
+            options["method"] = 0
+        return options
+
+
+def _kept_info(image: "Image.Image", *keys: str) -> typing.Dict[str, typing.Any]:
+    return {key: image.info[key] for key in keys if image.info.get(key)}
+
+
+# Format (as Pillow names it) -> encoder.  Anything else gets the plain Encoder.
+ENCODERS: typing.Dict[str, Encoder] = {
+    "JPEG": JpegEncoder(),
+    "MPO": JpegEncoder(),
+    "PNG": PngEncoder(),
+    "GIF": GifEncoder(),
+    "WEBP": WebpEncoder(),
+}
+
+
+def is_resizable(content_type: typing.Optional[str], filename: str) -> bool:
+    """
+    Whether a file is an image shrink_to_limit can try, going by its content type, or its name if there's no content
+    type.  Videos and anything else aren't.
+
+    :param content_type: the MIME type Discord reports for it, if any
+    :param filename: its name
+    :return: True if it's worth downloading to resize
+    """
+    if content_type is None:
+        content_type, _ = mimetypes.guess_type(filename)
+    return content_type is not None and content_type.split(";")[0].strip().lower() in RESIZABLE_CONTENT_TYPES
+
+
+def read_header(header: bytes) -> typing.Optional[ImageHeader]:
+    """
+    Read an image's format and dimensions from the start of it, without decoding any pixels.
+
+    :param header: the first bytes of the file (see attachments.HEADER_SIZE)
+    :return: what was read, None if PIL doesn't recognize it (or the dimensions aren't in those bytes)
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(header)) as image:
+            return ImageHeader(image.format or "PNG", image.width, image.height)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def can_shrink(header: bytes) -> bool:
+    """
+    Whether an image looks like shrink_to_limit can resize it, from its header alone, so a download that's only going
+    to fail in the resize can be stopped early.
+
+    :param header: the first bytes of the file
+    :return: True if PIL can read it and it's no more than MAX_PIXELS
+    """
+    image_header = read_header(header)
+    return image_header is not None and image_header.width * image_header.height <= MAX_PIXELS
+
+
+def _next_scale(scale: float, encoded_size: int, size_limit: int, lower: float, upper: float) -> float:
+    """
+    Predict the scale that lands at TARGET_FILL of the limit from the last encode, falling back to bisection if the
+    prediction lands outside the bracket we already know about.
+
+    :param scale: the scale that was just encoded
+    :param encoded_size: the size in bytes that scale produced
+    :param size_limit: the maximum size in bytes
+    :param lower: largest scale known to fit under the limit (0 if none yet)
+    :param upper: smallest scale known to be over the limit
+    :return: the next scale to try
+    """
+    predicted = scale * math.sqrt(size_limit * TARGET_FILL / encoded_size)
+    if lower < predicted < upper:
+        return predicted
+    return (lower + upper) / 2
+
+
+def shrink_to_limit(data: bytes, size_limit: int) -> ResizeResult:
+    """
+    Re-encode an image until it fits in size_limit bytes, keeping its original format (and every frame, if it's
+    animated), losing as few pixels as possible.
+
+    The format's encoder (see ENCODERS) is tried at full size with its smallest level first.  If that fits, the best
+    level that still fits is found by bisecting the levels, and no pixels are lost.  If it doesn't, that encode
+    predicts the first scale for the smallest level, and every following guess is either predicted from the last encode
+    or bisected between the largest scale that fit and the smallest that didn't.  That usually converges in one or two
+    encodes.
+
+    This is CPU bound and blocking, so it's meant to be run in a process pool (see resize_in_pool).
+
+    :param data: the encoded image
+    :param size_limit: the maximum size in bytes of the result
+    :return: the encoded result, its dimensions, and how many encodes it took
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return _shrink(image, size_limit)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as exception:
+        # Not an image PIL can read (or write back), or one so big it could be a decompression bomb.
+        raise ResizeError("Could not resize image: {}".format(exception)) from exception
+
+
+def _shrink(image: "Image.Image", size_limit: int) -> ResizeResult:
+    if image.format is None:
+        image.format = "PNG"
+    encoder = ENCODERS.get(image.format) or Encoder()
+    levels = encoder.levels
+
+    passes = 1
+    encoded, width, height = encoder.encode(image, 1.0, levels[-1])
+    if len(encoded) <= size_limit:
+        best = (encoded, width, height)
+        # levels[fits] is the best level known to fit, everything before levels[lowest] is known not to.
+        lowest = 0
+        fits = len(levels) - 1
+        while lowest < fits and passes < MAX_PASSES:
+            passes += 1
+            level = (lowest + fits) // 2
+            encoded, width, height = encoder.encode(image, 1.0, levels[level])
+            if len(encoded) <= size_limit:
+                best = (encoded, width, height)
+                fits = level
+            else:
+                lowest = level + 1
+        return ResizeResult(best[0], best[1], best[2], passes)
+
+    lower = 0.0
+    upper = 1.0
+    best: typing.Optional[typing.Tuple[bytes, int, int]] = None
+    scale = _next_scale(1.0, len(encoded), size_limit, lower, upper)
+
+    while True:
+        passes += 1
+        encoded, width, height = encoder.encode(image, scale, levels[-1])
+
+        if len(encoded) <= size_limit:
+            best = (encoded, width, height)
+            lower = scale
+            if len(encoded) >= size_limit * ACCEPT_FILL:
+                break
+        else:
+            upper = scale
+
+        if best is not None and (passes >= MAX_PASSES or upper - lower < SCALE_TOLERANCE):
+            break
+        if upper < MINIMUM_SCALE:
+            raise ResizeError("Could not shrink image under [{}] bytes".format(size_limit))
+
+        scale = _next_scale(scale, len(encoded), size_limit, lower, upper)
+
+    return ResizeResult(best[0], best[1], best[2], passes)
+
+
+def configure_process_pool(max_workers: typing.Optional[int]) -> None:
+    """
+    Set how many worker processes resizes run on.  Only takes effect if the pool hasn't been started yet.
+
+    :param max_workers: the number of worker processes, None for one per CPU
+    :return: None
+    """
+    global _PROCESS_POOL_WORKERS
+    _PROCESS_POOL_WORKERS = max_workers
+
+
+def _get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        # Not forked from here: by the time the first resize comes along the DB, logging and download threads are
+        # running, and a worker forked while one of them held a lock would inherit it held for good.  The fork server
+        # is a fresh interpreter of its own, without any threads to inherit locks from.
+        _PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=_PROCESS_POOL_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _PROCESS_POOL
+
+
+async def resize_in_pool(data: bytes, size_limit: int) -> ResizeResult:
+    """
+    Run shrink_to_limit in the image process pool so resizing doesn't block the event loop.
+
+    :param data: the encoded image
+    :param size_limit: the maximum size in bytes of the result
+    :return: the result of shrink_to_limit
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_process_pool(), shrink_to_limit, data, size_limit)
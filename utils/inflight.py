@@ -0,0 +1,54 @@
+import asyncio
+import typing
+
+
+class InFlightRegistry:
+    """
+    Tracks work that's currently running, so concurrent requests for the same thing join it instead of repeating it.
+
+    claim() is synchronous: between a claim and its release, nothing else on the event loop can claim the same key,
+    which is what makes check-then-act (e.g. "is it pinned yet?" then "pin it") safe under concurrency.
+    """
+
+    def __init__(self):
+        self._in_flight: typing.Dict[typing.Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._in_flight
+
+    def claim(
+        self, keys: typing.Iterable[typing.Hashable]
+    ) -> typing.Tuple[typing.List[typing.Hashable], typing.List[asyncio.Future]]:
+        """
+        Claim every key that isn't already in flight.
+
+        :param keys: the keys to claim
+        :return: the keys claimed by this caller (which must release() them), and futures for the keys someone else
+                 already had, which resolve when they're released
+        """
+        loop = asyncio.get_running_loop()
+        claimed = []
+        joined = []
+        for key in keys:
+            future = self._in_flight.get(key)
+            if future is None:
+                self._in_flight[key] = loop.create_future()
+                claimed.append(key)
+            else:
+                joined.append(future)
+        return claimed, joined
+
+    def release(self, keys: typing.Iterable[typing.Hashable]) -> None:
+        """
+        Mark claimed keys as done, waking up everyone who joined them.
+
+        :param keys: keys previously returned by claim()
+        :return: None
+        """
+        for key in keys:
+            future = self._in_flight.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(None)
@@ -0,0 +1,234 @@
+import asyncio
+import random
+import time
+import typing
+
+from utils import db
+from utils import log
+
+
+class PinJob(typing.NamedTuple):
+    job_id: int
+    guild_id: typing.Optional[int]
+    source_channel: int
+    message_id: int
+    user_id: int
+    attempts: int
+    created_at: float
+    next_attempt_at: float
+    # The user that pinned it, if we still have them from the reaction.  Not saved, replayed jobs have to look them up.
+    user: typing.Any = None
+
+
+class PinJobQueue:
+    """
+    Pins as jobs in the DB, run by a pool of workers.  A job is written (and committed) before it's run and only
+    deleted once the handler is done with it, so a pin that was cut short by a crash or a restart is run again on
+    startup instead of being lost.  Handlers have to be safe to run twice, which the pin dedupe takes care of.
+
+    If the handler raises, the job is retried with exponential backoff (with jitter, so a Discord outage doesn't
+    end in every job retrying at the same moment) until it's been tried max_attempts times.  Handlers return normally
+    for anything retrying won't fix.
+
+    When the bot runs as several processes, give each queue the shards its process runs, so it only replays the jobs
+    of its own guilds.
+    """
+
+    def __init__(
+        self,
+        database: db.Database,
+        handler: typing.Callable[[PinJob], typing.Awaitable[None]],
+        workers: int = 8,
+        max_attempts: int = 8,
+        backoff: float = 2.0,
+        max_backoff: float = 600.0,
+        shard_count: typing.Optional[int] = None,
+        shard_ids: typing.Optional[typing.Sequence[int]] = None
+    ):
+        self.database = database
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+        self._ready: typing.Optional[asyncio.Queue] = None
+        self._worker_tasks: typing.List[asyncio.Task] = []
+        self._adding: typing.Set[asyncio.Task] = set()
+        self._retry_timers: typing.Set[asyncio.TimerHandle] = set()
+        # Jobs that have been scheduled and aren't done yet, and an event set whenever there are none.
+        self._outstanding = 0
+        self._idle: typing.Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return self._outstanding
+
+    async def start(self) -> int:
+        """
+        Start the workers, and schedule every job (on this queue's shards) left in the DB from before.
+
+        :return: the number of jobs that were replayed
+        """
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        replayed = [PinJob(*row) for row in await self.database.get_pin_jobs(self.shard_count, self.shard_ids)]
+        for job in replayed:
+            self._schedule(job)
+        self._worker_tasks = [
+            asyncio.create_task(self._work(), name="pinbot-pin-worker-{}".format(index))
+            for index in range(self.workers)
+        ]
+        return len(replayed)
+
+    async def stop(self) -> None:
+        """
+        Stop the workers.  Whatever they were running stays in the DB and is replayed next start.
+
+        :return: None
+        """
+        for timer in self._retry_timers:
+            timer.cancel()
+        self._retry_timers.clear()
+        for task in (*self._worker_tasks, *self._adding):
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, *self._adding, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def drain(self) -> None:
+        """
+        Wait until every job that's been submitted so far is done, retries included.
+
+        :return: None
+        """
+        while self._adding or not self._idle.is_set():
+            if self._adding:
+                await asyncio.gather(*self._adding, return_exceptions=True)
+            await self._idle.wait()
+
+    def submit(
+        self,
+        guild_id: typing.Optional[int],
+        source_channel: int,
+        message_id: int,
+        user_id: int,
+        user: typing.Any = None
+    ) -> None:
+        """
+        Queue a pin without waiting for it to be written, so the caller (the gateway event handler) returns right
+        away.  Once it's committed, it's handed to the workers.
+
+        :param guild_id: ID of the guild the message is in
+        :param source_channel: ID of the channel the message is in
+        :param message_id: ID of the message to pin
+        :param user_id: ID of the user that pinned it
+        :param user: the user that pinned it, if it's at hand
+        :return: None
+        """
+        task = asyncio.create_task(self.add(guild_id, source_channel, message_id, user_id, user))
+        self._adding.add(task)
+        task.add_done_callback(self._added)
+
+    def _added(self, task: asyncio.Task) -> None:
+        self._adding.discard(task)
+        if not task.cancelled():
+            # Retrieved so asyncio doesn't complain about it, add() already logged it.
+            task.exception()
+
+    async def add(
+        self,
+        guild_id: typing.Optional[int],
+        source_channel: int,
+        message_id: int,
+        user_id: int,
+        user: typing.Any = None
+    ) -> typing.Optional[PinJob]:
+        """
+        Queue a pin, and wait for it to be written.
+
+        :return: the job, None if there already was one for that message
+        """
+        try:
+            row = await self.database.add_pin_job(guild_id, source_channel, message_id, user_id, time.time())
+        except Exception as exception:
+            log.error("Failed to queue pin of [{}] in [{}]: {!r}", message_id, source_channel, exception)
+            raise
+        if row is None:
+            log.debug("[{}] is already queued to be pinned", message_id)
+            return None
+
+        job = PinJob(*row, user=user)
+        self._schedule(job)
+        return job
+
+    def _schedule(self, job: PinJob) -> None:
+        self._outstanding += 1
+        self._idle.clear()
+        self._enqueue_at(job)
+
+    def _enqueue_at(self, job: PinJob) -> None:
+        delay = job.next_attempt_at - time.time()
+        if delay <= 0:
+            self._ready.put_nowait(job)
+            return
+
+        def _due() -> None:
+            self._retry_timers.discard(timer)
+            self._ready.put_nowait(job)
+
+        timer = asyncio.get_running_loop().call_later(delay, _due)
+        self._retry_timers.add(timer)
+
+    def _done(self) -> None:
+        self._outstanding -= 1
+        if not self._outstanding:
+            self._idle.set()
+
+    def _backoff_for(self, attempts: int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._ready.get()
+            try:
+                await self._run(job)
+            except Exception as exception:
+                # Only the DB calls in _run can get here.  The job is still in the DB, so it'll be replayed.
+                log.error("Pin job [{}] couldn't be updated: {!r}", job.job_id, exception)
+                self._done()
+
+    async def _run(self, job: PinJob) -> None:
+        try:
+            await self.handler(job)
+        except Exception as exception:
+            attempts = job.attempts + 1
+            if attempts >= self.max_attempts:
+                log.error(
+                    "Giving up on pin job [{}] (message [{}]) after [{}] attempts: {!r}",
+                    job.job_id, job.message_id, attempts, exception
+                )
+                self.failed += 1
+                await self.database.delete_pin_job(job.job_id)
+                self._done()
+                return
+
+            next_attempt_at = time.time() + self._backoff_for(attempts)
+            log.warning(
+                "Pin job [{}] (message [{}]) failed attempt [{}], retrying in [{}s]: {!r}",
+                job.job_id, job.message_id, attempts, round(next_attempt_at - time.time(), 1), exception
+            )
+            self.retried += 1
+            await self.database.reschedule_pin_job(job.job_id, attempts, next_attempt_at, repr(exception))
+            self._enqueue_at(job._replace(attempts=attempts, next_attempt_at=next_attempt_at))
+            return
+
+        self.completed += 1
+        await self.database.delete_pin_job(job.job_id)
+        self._done()
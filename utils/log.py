@@ -1,5 +1,7 @@
 import json
 import logging.config
+import logging.handlers
+import queue
 import typing
 
 from utils import config
@@ -25,6 +27,24 @@ STACK_LEVEL_PREVIOUS = 3
 STACK_LEVEL_PREVIOUS_PREVIOUS = 4
 
 
+class BraceMessage:
+    """
+    A message and its arguments, formatted with str.format only if something actually emits it.  Logging calls
+    pass one of these instead of a formatted string, so a disabled level never pays for the formatting.
+    """
+
+    __slots__ = ("message", "args")
+
+    def __init__(self, message: typing.Any, args: tuple):
+        self.message = message
+        self.args = args
+
+    def __str__(self) -> str:
+        if self.args:
+            return str(self.message).format(*self.args)
+        return str(self.message)
+
+
 logging_config_file = config.get_config_directory().joinpath("logging.json")
 logging.config.dictConfig(json.loads(logging_config_file.read_text()))
 importer_logger = logging.getLogger("pinbot_logger")
@@ -33,22 +53,89 @@ importer_logger = logging.getLogger("pinbot_logger")
 pillow_logger = logging.getLogger("PIL")
 pillow_logger.setLevel(logging.INFO)
 
+_queue_listener: typing.Optional[logging.handlers.QueueListener] = None
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the record so it can be pickled, which would put the formatting right back on the
+    # caller.  The queue never leaves the process, so hand the record over as is and let the listener format it.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def start_queue_listener() -> None:
+    """
+    Move the configured handlers (and their I/O) onto a background thread.  Logging calls then only put the record
+    on a queue, so a slow stdout (or whatever the handlers write to) doesn't hold up the event loop.
+
+    :return: None
+    """
+    global _queue_listener
+    if _queue_listener is not None:
+        return
+
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(_InProcessQueueHandler(log_queue))
+
+    _queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _queue_listener.start()
+
+
+def stop_queue_listener() -> None:
+    """
+    Flush anything still queued and put the handlers back on the root logger.
+
+    :return: None
+    """
+    global _queue_listener
+    if _queue_listener is None:
+        return
+
+    _queue_listener.stop()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root_logger.removeHandler(handler)
+    for handler in _queue_listener.handlers:
+        root_logger.addHandler(handler)
+    _queue_listener = None
+
+
+def is_debug_enabled() -> bool:
+    """
+    Guard for debug logging that's expensive to even gather the arguments for.
+    """
+    return importer_logger.isEnabledFor(logging.DEBUG)
+
+
+# The log functions take the message and its str.format arguments separately, e.g. log.debug("Got [{}]", value), and
+# only format (and only look up the caller) if the level is enabled.  Keyword arguments are structured fields, they
+# end up as attributes on the record (see JsonFormatter).
 
-def debug(message: typing.Any, stack_level: int = STACK_LEVEL_DEFAULT) -> None:
-    importer_logger.debug(str(message), stacklevel=stack_level)
+def debug(message: typing.Any, *args, stack_level: int = STACK_LEVEL_DEFAULT, **fields) -> None:
+    if importer_logger.isEnabledFor(logging.DEBUG):
+        importer_logger.debug(BraceMessage(message, args), stacklevel=stack_level, extra=fields)
 
 
-def info(message: typing.Any, stack_level: int = STACK_LEVEL_DEFAULT) -> None:
-    importer_logger.info(str(message), stacklevel=stack_level)
+def info(message: typing.Any, *args, stack_level: int = STACK_LEVEL_DEFAULT, **fields) -> None:
+    if importer_logger.isEnabledFor(logging.INFO):
+        importer_logger.info(BraceMessage(message, args), stacklevel=stack_level, extra=fields)
 
 
-def warning(message: typing.Any, stack_level: int = STACK_LEVEL_DEFAULT) -> None:
-    importer_logger.warning(str(message), stacklevel=stack_level)
+def warning(message: typing.Any, *args, stack_level: int = STACK_LEVEL_DEFAULT, **fields) -> None:
+    if importer_logger.isEnabledFor(logging.WARNING):
+        importer_logger.warning(BraceMessage(message, args), stacklevel=stack_level, extra=fields)
 
 
-def error(message: typing.Any, stack_level: int = STACK_LEVEL_DEFAULT) -> None:
-    importer_logger.error(str(message), stacklevel=stack_level)
+def error(message: typing.Any, *args, stack_level: int = STACK_LEVEL_DEFAULT, **fields) -> None:
+    if importer_logger.isEnabledFor(logging.ERROR):
+        importer_logger.error(BraceMessage(message, args), stacklevel=stack_level, extra=fields)
 
 
-def critical(message: typing.Any, stack_level: int = STACK_LEVEL_DEFAULT) -> None:
-    importer_logger.critical(str(message), stacklevel=stack_level)
+def critical(message: typing.Any, *args, stack_level: int = STACK_LEVEL_DEFAULT, **fields) -> None:
+    if importer_logger.isEnabledFor(logging.CRITICAL):
+        importer_logger.critical(BraceMessage(message, args), stacklevel=stack_level, extra=fields)
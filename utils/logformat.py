@@ -0,0 +1,30 @@
+import json
+import logging
+
+
+# Everything a LogRecord has on its own, anything else on a record was passed in as a structured field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", logging.DEBUG, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, including any structured fields passed to the log functions, e.g.
+    log.debug("Pinned [{}]", message_id, guild_id=guild.id, latency_ms=12.5)
+    Select it in logging.json with {"()": "utils.logformat.JsonFormatter"}.  It lives outside utils.log because
+    logging.json is loaded while utils.log is still being imported.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": "{}/{}:{}".format(record.filename, record.funcName, record.lineno),
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -0,0 +1,136 @@
+import asyncio
+import sqlite3
+import time
+import typing
+
+from utils import db
+from utils import log
+from utils import metrics
+
+
+# Keeps the DB from only ever growing.  Each run:
+#   * deletes rows nothing refers to anymore (Database.prune_orphans)
+#   * optionally moves old attachment pins into the compact archive (Database.archive_pinned_attachments)
+#   * gives the free pages that leaves back to the filesystem, a chunk at a time (Database.incremental_vacuum), and
+#     truncates the WAL, which is when the file actually shrinks (Database.checkpoint)
+#   * refreshes the query planner's statistics (PRAGMA optimize)
+# A DB from before incremental auto vacuum keeps its free pages (they're reused, the file just doesn't shrink) until
+# it's rebuilt with main.py --vacuum.  That's never done from here: a VACUUM holds the write lock for as long as it
+# takes to rewrite the whole file, and pins can't wait that long.
+#
+# Apart from the checkpoint, which can't run inside a transaction, everything goes through the Database's writer like
+# any other write, in chunks, so pins only ever wait behind a small piece of it.
+
+# Discord snowflakes count milliseconds from the start of 2015, in the bits above the lowest 22.
+DISCORD_EPOCH_MS = 1420070400000
+# Pins archived per write
+ARCHIVE_BATCH_SIZE = 5000
+# Free pages given back per write
+VACUUM_BATCH_PAGES = 2048
+# Jobs from channels that aren't a source anymore are left this long before being treated as orphaned.
+STALE_PIN_JOB_SECONDS = 7 * 24 * 60 * 60
+# Seconds after starting before the first run, so it doesn't compete with replaying pins.
+FIRST_RUN_DELAY = 60.0
+
+
+class MaintenanceReport(typing.NamedTuple):
+    # table -> rows deleted
+    pruned: typing.Dict[str, int]
+    archived: int
+    reclaimed_bytes: int
+    seconds: float
+    # unix timestamp
+    finished_at: float
+    stats: db.DatabaseStats
+
+
+# The last run's report, None until there's been one
+LAST_REPORT: typing.Optional[MaintenanceReport] = None
+
+
+def snowflake_at(timestamp: float) -> int:
+    """
+    :param timestamp: unix timestamp
+    :return: the smallest snowflake (e.g. attachment ID) Discord could have made at that time
+    """
+    return max(0, int(timestamp * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+async def run(database: db.Database, archive_after_days: typing.Optional[float] = None) -> MaintenanceReport:
+    """
+    Maintain the DB once.
+
+    :param database: the DB
+    :param archive_after_days: archive pins of attachments older than this, None not to
+    :return: what was done
+    """
+    global LAST_REPORT
+    started = time.perf_counter()
+    pruned = await database.prune_orphans(time.time() - STALE_PIN_JOB_SECONDS)
+
+    archived = 0
+    if archive_after_days is not None:
+        before_attachment_id = snowflake_at(time.time() - archive_after_days * 24 * 60 * 60)
+        while True:
+            moved = await database.archive_pinned_attachments(before_attachment_id, ARCHIVE_BATCH_SIZE)
+            archived += moved
+            if moved < ARCHIVE_BATCH_SIZE:
+                break
+
+    reclaimed_pages = 0
+    while True:
+        freed, left = await database.incremental_vacuum(VACUUM_BATCH_PAGES)
+        reclaimed_pages += freed
+        if not freed or not left:
+            break
+    if not await database.checkpoint():
+        log.info("Couldn't checkpoint all of the WAL, the DB file will shrink at a later checkpoint")
+
+    await database.optimize()
+    stats = await database.get_stats()
+    seconds = time.perf_counter() - started
+    if stats.auto_vacuum != 2:
+        log.warning(
+            "DB doesn't have incremental auto vacuum on, so it can't shrink.  Stop PinBot and run it with --vacuum once"
+        )
+
+    reclaimed_bytes = reclaimed_pages * stats.page_size
+    metrics.DB_MAINTENANCE_SECONDS.observe(seconds)
+    for table, count in pruned.items():
+        if count:
+            metrics.DB_PRUNED_ROWS.inc(table, amount=count)
+    metrics.DB_ARCHIVED_PINS.inc(amount=archived)
+    metrics.DB_RECLAIMED_BYTES.inc(amount=reclaimed_bytes)
+    metrics.DB_FREE_BYTES.set(stats.free_pages * stats.page_size)
+    log.info(
+        "DB maintenance took [{}s]: pruned [{}] orphaned rows, archived [{}] pins, reclaimed [{}MB], DB is [{}MB]",
+        round(seconds, 2), sum(pruned.values()), archived, round(reclaimed_bytes / 1000000, 2),
+        round((stats.file_bytes + stats.wal_bytes) / 1000000, 2), pruned=pruned
+    )
+
+    LAST_REPORT = MaintenanceReport(
+        pruned=pruned, archived=archived, reclaimed_bytes=reclaimed_bytes, seconds=seconds,
+        finished_at=time.time(), stats=stats
+    )
+    return LAST_REPORT
+
+
+async def run_forever(
+    database: db.Database, interval: float, archive_after_days: typing.Optional[float] = None
+) -> None:
+    """
+    Maintain the DB every interval seconds, forever, starting shortly after it's called.  A run that fails is logged
+    and tried again next time.
+
+    :param database: the DB
+    :param interval: seconds between runs
+    :param archive_after_days: archive pins of attachments older than this, None not to
+    :return: None
+    """
+    await asyncio.sleep(min(FIRST_RUN_DELAY, interval))
+    while True:
+        try:
+            await run(database, archive_after_days)
+        except sqlite3.Error as exception:
+            log.error("DB maintenance failed, will try again in [{}s]: {}", interval, exception)
+        await asyncio.sleep(interval)
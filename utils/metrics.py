@@ -0,0 +1,263 @@
+import asyncio
+import bisect
+import math
+import typing
+
+from aiohttp import web
+
+from utils import log
+
+
+# Counters, gauges and histograms in the Prometheus text format, served over HTTP by start_server().
+#
+# Updating a metric is a dict lookup and an addition (a bisect too, for histograms), cheap enough for the hot path.
+# There's no locking, so only update them from the event loop thread.
+#
+# Label values are passed positionally, in the order the metric's labels were declared:
+#   PINS.inc("posted")
+#   SEND_SECONDS.observe(0.2)
+
+LabelValues = typing.Tuple[str, ...]
+
+# Seconds, from a quick DB read up to a slow retry.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        function: typing.Optional[typing.Callable[[], typing.Union[float, typing.Dict[LabelValues, float]]]] = None
+    ):
+        """
+        :param name: the metric name
+        :param documentation: the HELP text
+        :param labels: the label names
+        :param function: if given, called at collection time for the metric's value (or label values -> value), for
+                         things that are already counted somewhere else
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self._values: typing.Dict[LabelValues, float] = {}
+        REGISTRY.append(self)
+
+    def get(self, *label_values: str) -> float:
+        if self.function is not None:
+            values = self._collect_function()
+            return values.get(tuple(label_values), 0)
+        return self._values.get(label_values, 0)
+
+    def _collect_function(self) -> typing.Dict[LabelValues, float]:
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, LabelValues, float]]:
+        values = self._collect_function() if self.function is not None else self._values
+        for label_values, value in sorted(values.items()):
+            yield self.name, label_values, value
+
+    def render(self) -> typing.List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for name, label_values, value in self.samples():
+            lines.append("{}{} {}".format(name, _format_labels(self.labels, label_values), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, the last one being +Inf, sum of observations)
+        self._histograms: typing.Dict[LabelValues, typing.Tuple[typing.List[int], typing.List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        histogram = self._histograms.get(label_values)
+        if histogram is None:
+            histogram = self._histograms[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1][0] += value
+
+    def label_values(self) -> typing.List[LabelValues]:
+        return list(self._histograms)
+
+    def count(self, *label_values: str) -> int:
+        histogram = self._histograms.get(label_values)
+        return sum(histogram[0]) if histogram else 0
+
+    def total(self, *label_values: str) -> float:
+        histogram = self._histograms.get(label_values)
+        return histogram[1][0] if histogram else 0.0
+
+    def quantile(self, quantile: float, *label_values: str) -> typing.Optional[float]:
+        """
+        Estimate a quantile from the buckets, interpolating within the bucket it lands in (like Prometheus'
+        histogram_quantile).
+
+        :param quantile: the quantile, between 0 and 1
+        :return: the estimate, None if nothing's been observed
+        """
+        histogram = self._histograms.get(label_values)
+        if not histogram or not sum(histogram[0]):
+            return None
+
+        counts = histogram[0]
+        rank = quantile * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    # Past the last bucket, the best we can say is "more than that".
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, LabelValues, float]]:
+        for label_values, (counts, total) in sorted(self._histograms.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield "{}_bucket".format(self.name), (*label_values, _format_value(bound)), cumulative
+            yield "{}_sum".format(self.name), label_values, total[0]
+            yield "{}_count".format(self.name), label_values, cumulative
+
+    def render(self) -> typing.List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for name, label_values, value in self.samples():
+            label_names = (*self.labels, "le") if name.endswith("_bucket") else self.labels
+            lines.append("{}{} {}".format(name, _format_labels(label_names, label_values), _format_value(value)))
+        return lines
+
+
+REGISTRY: typing.List[_Metric] = []
+
+# Pin pipeline
+PIN_LATENCY_SECONDS = Histogram(
+    "pinbot_pin_latency_seconds", "Time from the 📌 reaction to the pin being posted to a pin channel"
+)
+DOWNLOAD_SECONDS = Histogram("pinbot_attachment_download_seconds", "Time to download an attachment")
+RESIZE_SECONDS = Histogram("pinbot_resize_seconds", "Time to resize an oversized attachment")
+RESIZE_PASSES = Histogram(
+    "pinbot_resize_passes", "Encodes it took to resize an oversized attachment", buckets=(1, 2, 3, 4, 5, 6, 8, 10)
+)
+SEND_SECONDS = Histogram("pinbot_send_seconds", "Time to post a pin to a pin channel")
+DB_QUERY_SECONDS = Histogram(
+    "pinbot_db_query_seconds", "Time for a DB call, queueing for the writer included", labels=("query",)
+)
+PINS = Counter(
+    "pinbot_pins_total",
+    "Pins by outcome: posted or failed (per pin channel), duplicate (already pinned) or suppressed (the same file "
+    "is already in the pin channel) per attachment and pin channel, linked (too big to upload) per attachment, or "
+    "skipped (nothing pinnable) per message",
+    labels=("outcome",)
+)
+
+# DB maintenance (the DB's size is in main.py)
+DB_MAINTENANCE_SECONDS = Histogram("pinbot_db_maintenance_seconds", "Time a DB maintenance run took")
+DB_PRUNED_ROWS = Counter(
+    "pinbot_db_pruned_rows_total", "Orphaned rows DB maintenance deleted, by table", labels=("table",)
+)
+DB_ARCHIVED_PINS = Counter("pinbot_db_archived_pins_total", "Attachment pins DB maintenance moved to the archive")
+DB_RECLAIMED_BYTES = Counter("pinbot_db_reclaimed_bytes_total", "Free space DB maintenance gave back to the filesystem")
+DB_FREE_BYTES = Gauge("pinbot_db_free_bytes", "Free space inside the DB file, as of the last DB maintenance")
+
+# Event loop
+EVENT_LOOP_LAG_SECONDS = Gauge(
+    "pinbot_event_loop_lag_seconds", "How late the event loop was to wake up the last lag check"
+)
+
+
+def render() -> str:
+    """
+    :return: every metric, in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """
+    Serve /metrics over HTTP.
+
+    :param host: address to listen on
+    :param port: port to listen on
+    :return: the runner, clean it up to stop the server
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Serving metrics on http://{}:{}/metrics", host, port)
+    return runner
+
+
+async def monitor_event_loop_lag(interval: float) -> None:
+    """
+    Measure how late the event loop wakes up from a sleep, i.e. how long something held it up, forever.
+
+    :param interval: seconds between checks
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.set(max(0.0, loop.time() - expected))
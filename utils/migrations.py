@@ -0,0 +1,283 @@
+import sqlite3
+import typing
+
+from utils import log
+
+
+# Every schema change is a migration: (version, description, script).  The version the DB is at is kept in
+# PRAGMA user_version, each migration runs in its own transaction along with the bump to its version, so a DB is
+# never left half migrated.  Never edit a migration that's been released, add a new one.
+MIGRATIONS: typing.List[typing.Tuple[int, str, str]] = [
+    (
+        1,
+        "Initial tables",
+        # IF NOT EXISTS, since DBs made before migrations existed are at user_version 0 but already have these.
+        """
+        CREATE TABLE IF NOT EXISTS channel_connections (
+            channel_key text UNIQUE,
+            source_channel INTEGER,
+            pin_channel INTEGER,
+            registering_user INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS pinned_attachments
+        (
+            attachment_id int  not null,
+            channel_key   TEXT not null
+                constraint pinned_attachments_channel_connections_channel_key_fk
+                    references channel_connections (channel_key)
+                    on delete cascade
+        );
+
+        CREATE TABLE IF NOT EXISTS pinned_embeds
+        (
+            embed_url   TEXT not null,
+            channel_key TEXT not null
+                constraint pinned_embeds_channel_connections_channel_key_fk
+                    references channel_connections (channel_key)
+                    on delete cascade
+        );
+        """
+    ),
+    (
+        2,
+        "Constraints and indexes",
+        # SQLite can't add constraints to an existing table, so the tables are rebuilt.  Rows the constraints would
+        # reject are dropped on the way: connections from a channel to itself, repeats of a source -> pin pair (the
+        # first one registered is kept), repeat pins, and pins whose connection was deleted while foreign keys were
+        # still being ignored.
+        """
+        CREATE TABLE channel_connections_new (
+            channel_key      TEXT    NOT NULL PRIMARY KEY,
+            source_channel   INTEGER NOT NULL,
+            pin_channel      INTEGER,
+            registering_user INTEGER,
+            CHECK (pin_channel IS NULL OR pin_channel != source_channel)
+        );
+        INSERT INTO channel_connections_new(channel_key, source_channel, pin_channel, registering_user)
+            SELECT channel_key, source_channel, pin_channel, registering_user FROM channel_connections
+            WHERE channel_key IS NOT NULL AND source_channel IS NOT NULL
+              AND (pin_channel IS NULL OR pin_channel != source_channel)
+              AND (
+                  pin_channel IS NULL
+                  OR rowid IN (
+                      SELECT MIN(rowid) FROM channel_connections
+                      WHERE pin_channel IS NOT NULL
+                      GROUP BY source_channel, pin_channel
+                  )
+              );
+
+        CREATE TABLE pinned_attachments_new (
+            attachment_id INTEGER NOT NULL CHECK (attachment_id > 0),
+            channel_key   TEXT    NOT NULL
+                CONSTRAINT pinned_attachments_channel_connections_channel_key_fk
+                    REFERENCES channel_connections (channel_key)
+                    ON DELETE CASCADE
+        );
+        INSERT INTO pinned_attachments_new(attachment_id, channel_key)
+            SELECT DISTINCT attachment_id, channel_key FROM pinned_attachments
+            WHERE attachment_id > 0 AND channel_key IN (SELECT channel_key FROM channel_connections_new);
+
+        CREATE TABLE pinned_embeds_new (
+            embed_url   TEXT NOT NULL CHECK (embed_url != ''),
+            channel_key TEXT NOT NULL
+                CONSTRAINT pinned_embeds_channel_connections_channel_key_fk
+                    REFERENCES channel_connections (channel_key)
+                    ON DELETE CASCADE
+        );
+        INSERT INTO pinned_embeds_new(embed_url, channel_key)
+            SELECT DISTINCT embed_url, channel_key FROM pinned_embeds
+            WHERE embed_url != '' AND channel_key IN (SELECT channel_key FROM channel_connections_new);
+
+        DROP TABLE pinned_attachments;
+        DROP TABLE pinned_embeds;
+        DROP TABLE channel_connections;
+        ALTER TABLE channel_connections_new RENAME TO channel_connections;
+        ALTER TABLE pinned_attachments_new RENAME TO pinned_attachments;
+        ALTER TABLE pinned_embeds_new RENAME TO pinned_embeds;
+
+        -- NULLs are distinct in a UNIQUE index, so any number of pending connections can share a source channel.
+        CREATE UNIQUE INDEX channel_connections_source_pin ON channel_connections (source_channel, pin_channel);
+        CREATE UNIQUE INDEX pinned_attachments_attachment_key ON pinned_attachments (attachment_id, channel_key);
+        CREATE UNIQUE INDEX pinned_embeds_url_key ON pinned_embeds (embed_url, channel_key);
+        -- The cascades look up pins by channel_key alone.
+        CREATE INDEX pinned_attachments_channel_key ON pinned_attachments (channel_key);
+        CREATE INDEX pinned_embeds_channel_key ON pinned_embeds (channel_key);
+        """
+    ),
+    (
+        3,
+        "Pinned content hashes",
+        # What's been posted to each pin channel, by content rather than by attachment, for suppressing reposts.
+        # Keyed on the pin channel, since several source channels can pin to the same one.  channel_key is the
+        # connection it was pinned through, so deleting the connection forgets its pins here too.
+        """
+        CREATE TABLE pinned_content (
+            content_hash TEXT    NOT NULL CHECK (content_hash != ''),
+            pin_channel  INTEGER NOT NULL,
+            channel_key  TEXT    NOT NULL
+                CONSTRAINT pinned_content_channel_connections_channel_key_fk
+                    REFERENCES channel_connections (channel_key)
+                    ON DELETE CASCADE
+        );
+        CREATE UNIQUE INDEX pinned_content_hash_pin_channel ON pinned_content (content_hash, pin_channel);
+        CREATE INDEX pinned_content_channel_key ON pinned_content (channel_key);
+        """
+    ),
+    (
+        4,
+        "Pin job queue",
+        # Pins waiting to be made (or retried).  One per message, however many people react before it's done.  Times
+        # are unix timestamps, since they have to mean the same thing after a restart.
+        """
+        CREATE TABLE pin_jobs (
+            job_id          INTEGER PRIMARY KEY,
+            source_channel  INTEGER NOT NULL,
+            message_id      INTEGER NOT NULL,
+            user_id         INTEGER NOT NULL,
+            attempts        INTEGER NOT NULL DEFAULT 0 CHECK (attempts >= 0),
+            created_at      REAL    NOT NULL,
+            next_attempt_at REAL    NOT NULL,
+            last_error      TEXT
+        );
+        CREATE UNIQUE INDEX pin_jobs_message ON pin_jobs (source_channel, message_id);
+        """
+    ),
+    (
+        5,
+        "Backfill checkpoints",
+        # How far !backfill has got through each source channel's history, so it picks up where it left off.
+        # scanned and queued add up over every run.  completed_at is NULL while a run is going (or was cut short).
+        """
+        CREATE TABLE backfill_checkpoints (
+            source_channel  INTEGER NOT NULL PRIMARY KEY,
+            last_message_id INTEGER NOT NULL,
+            scanned         INTEGER NOT NULL DEFAULT 0 CHECK (scanned >= 0),
+            queued          INTEGER NOT NULL DEFAULT 0 CHECK (queued >= 0),
+            updated_at      REAL    NOT NULL,
+            completed_at    REAL
+        );
+        """
+    ),
+    (
+        6,
+        "Pin job guilds",
+        # With several processes sharing the DB, each only replays the jobs of the guilds on its shards.  Jobs queued
+        # before this have no guild, they go to whichever process has shard 0.
+        """
+        ALTER TABLE pin_jobs ADD COLUMN guild_id INTEGER;
+        """
+    ),
+    (
+        7,
+        "Archived attachment pins",
+        # Old attachment pins, compacted by utils.maintenance: each connection's as chunks of at most
+        # db.ARCHIVE_CHUNK_SIZE sorted 64 bit attachment IDs (see db._pack_ids), 8 bytes a pin instead of a row and two
+        # index entries.  Still exact, so get_pinned_attachments checks here too, but only the chunks whose
+        # first_attachment_id to last_attachment_id range covers what it's looking for.  Archiving more only writes new
+        # chunks (and tops up the newest) rather than rewriting everything archived so far.
+        """
+        CREATE TABLE pinned_attachments_archive (
+            chunk_id            INTEGER PRIMARY KEY,
+            channel_key         TEXT    NOT NULL
+                CONSTRAINT pinned_attachments_archive_channel_connections_channel_key_fk
+                    REFERENCES channel_connections (channel_key)
+                    ON DELETE CASCADE,
+            attachment_count    INTEGER NOT NULL CHECK (attachment_count > 0),
+            first_attachment_id INTEGER NOT NULL,
+            last_attachment_id  INTEGER NOT NULL,
+            attachment_ids      BLOB    NOT NULL
+        );
+        CREATE INDEX pinned_attachments_archive_channel_key
+            ON pinned_attachments_archive (channel_key, last_attachment_id);
+        """
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _statements(script: str) -> typing.Iterator[str]:
+    # executescript() commits whatever transaction is open before it starts, which would let go of the migration's
+    # write lock, so scripts are run a statement at a time instead.
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+    if statement.strip():
+        yield statement
+
+
+def migrate(connection: sqlite3.Connection) -> int:
+    """
+    Bring the DB up to the latest schema version.  A DB that's already up to date costs a single PRAGMA read.
+
+    Foreign keys are switched off while migrating, since rebuilding a table means dropping the original, and with
+    foreign keys on that drop would cascade into the pins.  They're switched back on (and checked) afterwards.
+
+    Each migration takes the write lock before it checks the version, so when several processes start on the same DB
+    at once, one migrates and the others wait (up to the busy timeout) and then find there's nothing left to do.
+
+    :param connection: connection to the DB to migrate
+    :return: the schema version the DB is at now
+    """
+    version = get_schema_version(connection)
+    if version >= LATEST_VERSION:
+        return version
+
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    connection.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for migration_version, description, script in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = get_schema_version(connection)
+                if migration_version > version:
+                    log.info("Migrating DB to version [{}]: {}", migration_version, description)
+                    for statement in _statements(script):
+                        connection.execute(statement)
+                    connection.execute("PRAGMA user_version = {}".format(migration_version))
+                    version = migration_version
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+
+        violations = connection.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            log.error("DB has [{}] foreign key violations after migrating", len(violations))
+    finally:
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.isolation_level = isolation_level
+
+    return version
+
+
+def connect(database_path: str, check_same_thread: bool = True, busy_timeout: float = 5.0) -> sqlite3.Connection:
+    """
+    Open a connection to the DB with the pragmas PinBot expects: foreign keys enforced (so deleting a connection
+    cascades to its pins), WAL journaling (readers don't wait on writers, and commits are cheaper) and incremental
+    auto vacuum, so utils.maintenance can hand free pages back to the filesystem.  auto_vacuum only takes on a new DB,
+    older ones have to be switched over by a VACUUM (Database.enable_incremental_vacuum, i.e. main.py --vacuum).
+
+    :param database_path: path to the sqlite DB
+    :param check_same_thread: passed on to sqlite3.connect
+    :param busy_timeout: seconds to wait for another connection (or process) to let go of a lock before giving up
+    :return: the connection
+    """
+    connection = sqlite3.connect(database_path, timeout=busy_timeout, check_same_thread=check_same_thread)
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA foreign_keys = ON")
+    return connection
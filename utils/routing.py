@@ -0,0 +1,159 @@
+import math
+import time
+import typing
+
+
+# (channel_key, pin_channel)
+Route = typing.Tuple[str, int]
+
+
+class RoutingTable:
+    """
+    In-memory copy of channel_connections, so the reaction hot path never has to ask the DB where to pin.
+
+    Loaded at startup, then kept up to date by whoever writes channel_connections in this process (write-through),
+    i.e. the register commands and delete_record.  Other processes sharing the DB write to it too, so it's also
+    reloaded periodically, and a source channel's routes can be reloaded on their own (load_source) once they're
+    older (see age()) than being out of date is allowed to be.  Rows read from the DB before a write-through change
+    never undo it (see writes).  Pending connections (no pin channel yet) are tracked so they can be completed or
+    deleted, but aren't routable.
+    """
+
+    def __init__(self):
+        # source_channel -> routes for that channel, only completed connections
+        self._routes: typing.Dict[int, typing.Tuple[Route, ...]] = {}
+        # source_channel -> {channel_key: pin_channel} for every connection from it, pending ones included
+        self._connections: typing.Dict[int, typing.Dict[str, typing.Optional[int]]] = {}
+        # channel_key -> source_channel
+        self._sources: typing.Dict[str, int] = {}
+        # time.monotonic() when everything, and when each source channel on its own, was last read from the DB
+        self._loaded_at = -math.inf
+        self._source_loaded_at: typing.Dict[int, float] = {}
+        # Write-through changes so far, and what the count was at each source channel's latest one
+        self.writes = 0
+        self._last_writes: typing.Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def __contains__(self, source_channel: int) -> bool:
+        return source_channel in self._routes
+
+    def _rebuild_routes(self, source_channel: int) -> None:
+        connections = self._connections.get(source_channel)
+        if not connections:
+            self._connections.pop(source_channel, None)
+            connections = {}
+        routes = tuple(
+            (channel_key, pin_channel) for channel_key, pin_channel in connections.items() if pin_channel is not None
+        )
+        if routes:
+            self._routes[source_channel] = routes
+        else:
+            self._routes.pop(source_channel, None)
+
+    def _wrote(self, source_channel: int) -> None:
+        self.writes += 1
+        self._last_writes[source_channel] = self.writes
+
+    def load(
+        self, rows: typing.Iterable[typing.Tuple[str, int, typing.Optional[int]]], writes: typing.Optional[int] = None
+    ) -> None:
+        """
+        Replace the table with the given channel_connections rows.
+
+        :param rows: (channel_key, source_channel, pin_channel) rows
+        :param writes: what writes was before the rows were read, so the source channels written through since then
+                       (which the rows may be older than) are kept as they are.  None replaces everything.
+        :return: None
+        """
+        # The source channels written through since the rows were read
+        kept = set() if writes is None else {
+            source_channel for source_channel, last_write in self._last_writes.items() if last_write > writes
+        }
+        connections = {source_channel: self._connections[source_channel] for source_channel in kept
+                       if source_channel in self._connections}
+        for channel_key, source_channel, pin_channel in rows:
+            if source_channel not in kept:
+                connections.setdefault(source_channel, {})[channel_key] = pin_channel
+        self._connections = connections
+        self._sources = {
+            channel_key: source_channel
+            for source_channel, pin_channels in connections.items() for channel_key in pin_channels
+        }
+        self._routes = {}
+        for source_channel in list(connections):
+            self._rebuild_routes(source_channel)
+        self._loaded_at = time.monotonic()
+        self._source_loaded_at = {}
+
+    def load_source(
+        self,
+        source_channel: int,
+        rows: typing.Iterable[typing.Tuple[str, int, typing.Optional[int]]],
+        writes: typing.Optional[int] = None
+    ) -> typing.Tuple[Route, ...]:
+        """
+        Replace one source channel's connections with the given channel_connections rows.
+
+        :param source_channel: the source channel
+        :param rows: (channel_key, source_channel, pin_channel) rows of every connection from it
+        :param writes: what writes was before the rows were read.  If the channel has been written through since, the
+                       rows are ignored.  None replaces them regardless.
+        :return: the channel's routes, like peek()
+        """
+        if writes is None or self._last_writes.get(source_channel, 0) <= writes:
+            for channel_key in self._connections.pop(source_channel, {}):
+                del self._sources[channel_key]
+            for channel_key, _, pin_channel in rows:
+                self._connections.setdefault(source_channel, {})[channel_key] = pin_channel
+                self._sources[channel_key] = source_channel
+            self._rebuild_routes(source_channel)
+            self._source_loaded_at[source_channel] = time.monotonic()
+        return self.peek(source_channel)
+
+    def age(self, source_channel: int) -> float:
+        """
+        :return: seconds since the source channel's connections were last read from the DB, infinite if never
+        """
+        return time.monotonic() - max(self._loaded_at, self._source_loaded_at.get(source_channel, -math.inf))
+
+    def add(self, channel_key: str, source_channel: int, pin_channel: typing.Optional[int] = None) -> None:
+        self._connections.setdefault(source_channel, {})[channel_key] = pin_channel
+        self._sources[channel_key] = source_channel
+        self._rebuild_routes(source_channel)
+        self._wrote(source_channel)
+
+    def set_pin_channel(self, channel_key: str, pin_channel: int) -> None:
+        # Mirrors an UPDATE, so a key that isn't there (e.g. already deleted) is left alone.
+        if channel_key in self._sources:
+            self.add(channel_key, self._sources[channel_key], pin_channel)
+
+    def remove(self, channel_key: str) -> None:
+        source_channel = self._sources.pop(channel_key, None)
+        if source_channel is not None:
+            del self._connections[source_channel][channel_key]
+            self._rebuild_routes(source_channel)
+            self._wrote(source_channel)
+
+    def peek(self, source_channel: int) -> typing.Tuple[Route, ...]:
+        """
+        Get the routes for a source channel, without counting a hit or a miss.
+        """
+        return self._routes.get(source_channel, ())
+
+    def get(self, source_channel: int) -> typing.Tuple[Route, ...]:
+        """
+        Get the routes for a source channel, counting it as a hit or a miss.
+
+        :param source_channel: ID of the channel a reaction came from
+        :return: (channel_key, pin_channel) for every completed connection, empty if it isn't a source channel
+        """
+        routes = self._routes.get(source_channel)
+        if routes is None:
+            self.misses += 1
+            return ()
+        self.hits += 1
+        return routes